@@ -0,0 +1,147 @@
+import os
+import hmac
+import hashlib
+import threading
+import time
+import collections
+import multiprocessing
+import concurrent.futures
+
+import metrics
+
+# scrypt parameters, ~16 MB of memory and tens of ms per hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+SCHEME = 'scrypt'
+
+POOL_SIZE = os.cpu_count() or 1
+MAX_CONCURRENT = 64  # logins/registrations hashing (or waiting for pool) at once
+WAIT_TIMEOUT = 5.0  # seconds a login waits for its turn before server gives up
+SESSION_CACHE_SIZE = 10000
+SESSION_TTL = 600.0
+
+AUTH_SECONDS = metrics.REGISTRY.histogram(
+    'chat_auth_seconds', 'Time spent hashing passwords, waiting for pool included',
+    ('operation',))
+AUTH_RESULTS = metrics.REGISTRY.counter(
+    'chat_auth_results_total', 'Password checks by result', ('result',))
+HASH_TIME = AUTH_SECONDS.labels('hash')
+VERIFY_TIME = AUTH_SECONDS.labels('verify')
+CACHE_HIT = AUTH_RESULTS.labels('cache_hit')
+CORRECT = AUTH_RESULTS.labels('correct')
+WRONG = AUTH_RESULTS.labels('wrong')
+BUSY = AUTH_RESULTS.labels('busy')
+
+
+class AuthBusyError(Exception):
+    pass
+
+
+# functions below run in pool processes, so they have to be module level
+
+def hash_password(password: str) -> str:
+    salt = os.urandom(SALT_SIZE)
+    digest = hashlib.scrypt(password.encode('utf-8'), salt=salt,
+                            n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f'{SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}'
+
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith(SCHEME + '$')
+
+
+def verify_password(password: str, stored: str) -> bool:
+    _, n, r, p, salt, digest = stored.split('$')
+    computed = hashlib.scrypt(password.encode('utf-8'), salt=bytes.fromhex(salt),
+                              n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(computed.hex(), digest)
+
+
+def verify_legacy(password: str, stored: str) -> tuple:
+    # plain text password from before hashing was introduced,
+    # returns (correct, hash to store instead of it)
+    if hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8')):
+        return True, hash_password(password)
+    return False, None
+
+
+class Authenticator:
+    # Runs password hashing in a bounded process pool, so login storms don't
+    # fight with message delivery for the GIL. Recently verified
+    # (username, password) pairs are cached as keyed digests, so reconnecting
+    # clients skip the KDF.
+    def __init__(self, pool_size: int = POOL_SIZE, max_concurrent: int = MAX_CONCURRENT,
+                 cache_size: int = SESSION_CACHE_SIZE, session_ttl: float = SESSION_TTL):
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            pool_size, mp_context=multiprocessing.get_context('spawn'))
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.cache_size = cache_size
+        self.session_ttl = session_ttl
+
+        self.key = os.urandom(32)
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(timeout=WAIT_TIMEOUT):
+            BUSY.inc()
+            raise AuthBusyError('Too many logins in progress')
+
+        try:
+            return self.pool.submit(fn, *args).result()
+
+        finally:
+            self.slots.release()
+
+    def _session_digest(self, username: str, password: str) -> bytes:
+        return hmac.new(self.key, f'{username}\0{password}'.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def _remember(self, username: str, password: str) -> None:
+        with self.lock:
+            self.sessions[username] = (self._session_digest(username, password),
+                                       time.monotonic() + self.session_ttl)
+            self.sessions.move_to_end(username)
+            while len(self.sessions) > self.cache_size:
+                self.sessions.popitem(last=False)
+
+    def _recently_verified(self, username: str, password: str) -> bool:
+        with self.lock:
+            session = self.sessions.get(username)
+
+        if session is None:
+            return False
+
+        digest, expires = session
+        return expires > time.monotonic() and hmac.compare_digest(
+            digest, self._session_digest(username, password))
+
+    def hash(self, username: str, password: str) -> str:
+        with HASH_TIME.time():
+            password_hash = self._run(hash_password, password)
+        self._remember(username, password)
+        return password_hash
+
+    def verify(self, username: str, password: str, stored: str) -> tuple:
+        # returns (correct, new hash to store or None)
+        if self._recently_verified(username, password):
+            CACHE_HIT.inc()
+            return True, None
+
+        with VERIFY_TIME.time():
+            if is_hashed(stored):
+                correct, new_hash = self._run(verify_password, password, stored), None
+            else:
+                correct, new_hash = self._run(verify_legacy, password, stored)
+
+        if correct:
+            CORRECT.inc()
+            self._remember(username, password)
+        else:
+            WRONG.inc()
+        return correct, new_hash
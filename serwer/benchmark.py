@@ -0,0 +1,562 @@
+import os
+import re
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import shutil
+import subprocess
+import logging
+import traceback
+import tracemalloc
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+ENCODING = 'utf-8'
+READ_LIMIT = 1024 * 1024
+
+# chat messages carry send time (ns, perf counter of this process) and sequence number
+PAYLOAD_REGEX = re.compile(r'(\w+): (\d+) (\d+)')
+GREETING_END = "Antime you need help"
+STARTUP_TIMEOUT = 30.0
+PHASE_TIMEOUT = 120.0
+# logins hash passwords in a bounded pool, keep registrations below its limit
+REGISTER_CONCURRENCY = 32
+
+MODES = ('threads', 'asyncio')
+# server's storage engines, memory takes disk I/O out of the picture
+STORAGES = ('sqlite', 'memory')
+QUEUE_MEMORY_MESSAGES = 100000
+# abusers pipeline this command in batches while others chat
+FLOOD_COMMAND = 'SEARCH flood'
+FLOOD_BATCH = 100
+THROTTLED_TEXT = 'Slow down!'
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples: list) -> dict:
+    # latencies in milliseconds
+    if not samples:
+        return {'count': 0}
+
+    samples = sorted(samples)
+
+    def pick(q: float) -> float:
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] / 1e6, 3)
+
+    return {'count': len(samples),
+            'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': round(samples[-1] / 1e6, 3),
+            'mean': round(sum(samples) / len(samples) / 1e6, 3)}
+
+
+def rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 1) if seconds > 0 else 0.0
+
+
+def raise_fd_limit() -> None:
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    except (ImportError, ValueError, OSError) as e:
+        logging.error(f'Cannot raise open files limit. Error: {e}')
+
+
+def process_tree(pid: int) -> list:
+    # pid and all its descendants, linux only
+    pids = [pid]
+    try:
+        tids = os.listdir(f'/proc/{pid}/task')
+
+    except FileNotFoundError:
+        return pids
+
+    for tid in tids:
+        try:
+            with open(f'/proc/{pid}/task/{tid}/children') as f:
+                children = f.read().split()
+
+        except FileNotFoundError:
+            # thread (or whole process) has just exited
+            continue
+
+        for child in children:
+            pids.extend(process_tree(int(child)))
+    return pids
+
+
+def peak_rss_kb(pid: int) -> dict:
+    # VmHWM is the peak resident set size of a process
+    peaks = {}
+    try:
+        for process in process_tree(pid):
+            try:
+                with open(f'/proc/{process}/status') as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            peaks[process] = int(line.split()[1])
+
+            except FileNotFoundError:
+                # exited since process_tree saw it
+                continue
+
+    except OSError as e:
+        logging.error(f'Cannot read peak RSS of server. Error: {e}')
+
+    return {'server_kb': peaks.get(pid, 0), 'total_kb': sum(peaks.values()),
+            'processes': len(peaks)}
+
+
+class DictMessage:
+    # Message layout before it got __slots__, kept for comparison
+    def __init__(self, msg_body: str, final_msg: bool = False):
+        self.msg_body = (msg_body + '\n').encode(ENCODING)
+        self.final_msg = final_msg
+
+    def get_body(self):
+        return self.msg_body
+
+    def is_final(self):
+        return self.final_msg
+
+
+def queue_memory(count: int) -> dict:
+    # bytes taken by one message waiting in client's outbound queue, body
+    # included, measured with tracemalloc in this process for the old dict
+    # based layout, for the slotted Message, and for one Message shared by
+    # all queued entries (room post fanned out to members)
+    sys.path.insert(0, os.path.dirname(SERVER_PATH))
+    from server import Message
+    from outbound import OutboundQueue
+
+    shared = Message(f'#room user: {time.perf_counter_ns()} 0')
+    layouts = {'dict': DictMessage,
+               'slots': Message,
+               'shared': lambda body: shared}
+    results = {'messages': count, 'body_bytes': len(shared.get_body())}
+
+    for name, make in layouts.items():
+        queue = OutboundQueue(limit_bytes=1 << 62)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(count):
+            queue.put(make(f'user{i % 100}: {time.perf_counter_ns()} {i}'))
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        results[f'{name}_bytes_per_message'] = round(used / count, 1)
+        del queue
+
+    return results
+
+
+class SimClient:
+    # One simulated user speaking the text protocol. Chat messages are
+    # reported to the benchmark as they arrive, everything else (replies
+    # to own commands) is put to the replies queue.
+    def __init__(self, bench: 'Benchmark', username: str, password: str):
+        self.bench = bench
+        self.username = username
+        self.password = password
+        self.friends = []
+        self.reader = None
+        self.writer = None
+        self.replies = asyncio.Queue()
+        self.received = 0
+        self.expected = 0
+        self.done = asyncio.Event()
+        self.task = None
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(
+            'localhost', self.bench.port, limit=READ_LIMIT)
+        while GREETING_END not in (await self.reader.readline()).decode(ENCODING):
+            pass
+        self.task = asyncio.create_task(self._reading_task())
+
+    async def _reading_task(self) -> None:
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+
+                line = line.decode(ENCODING).rstrip('\n')
+                match = PAYLOAD_REGEX.fullmatch(line)
+                if match:
+                    self.bench.latencies.append(time.perf_counter_ns() - int(match.group(2)))
+                    self.received += 1
+                    if self.expected and self.received >= self.expected:
+                        self.done.set()
+                elif line:
+                    self.replies.put_nowait(line)
+
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def write(self, line: str) -> None:
+        self.writer.write((line + '\n').encode(ENCODING))
+
+    async def command(self, line: str, reply_text: str) -> str:
+        self.write(line)
+        await self.writer.drain()
+        return await self.expect(reply_text)
+
+    async def expect(self, reply_text: str, count: int = 1) -> str:
+        # waits for count replies containing reply_text, skipping others
+        while True:
+            reply = await self.replies.get()
+            if reply_text in reply:
+                count -= 1
+                if not count:
+                    return reply
+
+    def expect_messages(self, count: int) -> None:
+        self.received = 0
+        self.expected = count
+        if count:
+            self.done.clear()
+        else:
+            self.done.set()
+
+    async def close(self) -> None:
+        try:
+            if self.writer and not self.writer.is_closing():
+                self.write('EXIT')
+                await self.writer.drain()
+                await asyncio.wait_for(self.task, PHASE_TIMEOUT)
+
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+        finally:
+            if self.writer:
+                self.writer.close()
+
+
+class Benchmark:
+    # Starts server.py on a free port with a temporary database and drives
+    # it through phases: registration, concurrent logins (connection setup
+    # rate), friendships, chat between online users (throughput and
+    # delivery latency), STATUS round trips and offline backlog drain.
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.port = free_port()
+        self.tmpdir = tempfile.mkdtemp(prefix='chat-bench-')
+        self.db_path = os.path.join(self.tmpdir, 'bench.db')
+        self.server = None
+        self.latencies = []
+        self.clients = [SimClient(self, f'user{i}', f'password{i}')
+                        for i in range(args.users)]
+        self.abusers = [SimClient(self, f'abuser{i}', f'password{i}')
+                        for i in range(args.abusers)]
+        self.flooded = 0
+
+        for i, client in enumerate(self.clients):
+            for distance in range(1, args.friends // 2 + 1):
+                for j in (i + distance, i - distance):
+                    friend = self.clients[j % args.users]
+                    if friend is not client and friend not in client.friends:
+                        client.friends.append(friend)
+
+    def start_server(self) -> None:
+        log = open(os.path.join(self.tmpdir, 'server.log'), 'w')
+        users = len(self.clients) + len(self.abusers)
+        cmd = [sys.executable, SERVER_PATH, '--port', str(self.port),
+               '--connections', str(max(users, 128)), '--mode', self.args.mode,
+               '--workers', str(self.args.workers), '--db', self.db_path,
+               '--storage', self.args.storage,
+               '--max-connections', str(users + 128),
+               '--command-rate', str(self.args.command_rate),
+               '--byte-rate', str(self.args.byte_rate),
+               # all simulated users share one address
+               '--ip-command-rate', '0', '--ip-byte-rate', '0', '--ip-connect-rate', '0']
+        # own process group, so workers and password hashing pool can be stopped together
+        self.server = subprocess.Popen(cmd, stdout=log, stderr=log, start_new_session=True)
+        log.close()
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.server.poll() is not None:
+                raise RuntimeError(f'Server exited with code {self.server.returncode}')
+            try:
+                with socket.create_connection(('localhost', self.port), timeout=1) as sock:
+                    sock.recv(READ_LIMIT)
+                    sock.sendall(b'EXIT\n')
+                    return
+
+            except OSError:
+                time.sleep(0.1)
+
+        raise RuntimeError('Server did not start in time')
+
+    def stop_server(self) -> dict:
+        rss = peak_rss_kb(self.server.pid)
+        os.killpg(self.server.pid, signal.SIGINT)
+        try:
+            self.server.wait(PHASE_TIMEOUT)
+
+        except subprocess.TimeoutExpired:
+            logging.error('Server did not shut down in time, killing it...')
+        return rss
+
+    async def gather(self, coros, concurrency: int = None) -> None:
+        if concurrency:
+            slots = asyncio.Semaphore(concurrency)
+
+            async def limited(coro):
+                async with slots:
+                    return await coro
+            coros = [limited(coro) for coro in coros]
+
+        await asyncio.wait_for(asyncio.gather(*coros), PHASE_TIMEOUT)
+
+    async def register(self, client: SimClient) -> None:
+        await client.connect()
+        await client.command(f'REGISTER {client.username} {client.password}',
+                             "You've been successfully registered")
+        await client.close()
+
+    async def login(self, client: SimClient) -> None:
+        await client.connect()
+        await client.command(f'LOGIN {client.username} {client.password}',
+                             "You've been logged in")
+
+    async def add_friends(self, client: SimClient) -> None:
+        for friend in client.friends:
+            client.write(f'ADD {friend.username}')
+        await client.writer.drain()
+        await client.expect('Added ', len(client.friends))
+
+    async def chat(self, client: SimClient, count: int, interval: float) -> None:
+        for seq in range(count):
+            friend = client.friends[seq % len(client.friends)]
+            client.write(f'{friend.username}: {time.perf_counter_ns()} {seq}')
+            await client.writer.drain()
+            if interval:
+                await asyncio.sleep(interval)
+
+    async def flood(self, client: SimClient) -> None:
+        # runs until cancelled, as fast as server reads
+        while True:
+            for _ in range(FLOOD_BATCH):
+                client.write(FLOOD_COMMAND)
+            self.flooded += FLOOD_BATCH
+            await client.writer.drain()
+
+    def stop_abusers(self, floods: list) -> int:
+        # returns number of throttle replies they got
+        throttled = 0
+        for task in floods:
+            task.cancel()
+        for client in self.abusers:
+            client.task.cancel()
+            client.writer.close()
+            while not client.replies.empty():
+                throttled += THROTTLED_TEXT in client.replies.get_nowait()
+        return throttled
+
+    async def status(self, client: SimClient, count: int) -> list:
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter_ns()
+            await self.friends_online(client)
+            samples.append(time.perf_counter_ns() - start)
+        return samples
+
+    async def friends_online(self, client: SimClient) -> set:
+        await client.command('STATUS', 'Friends statuses:')
+        online = set()
+        for _ in client.friends:
+            _, username, status = (await client.expect('STATUS: ')).split('\t')
+            if status.endswith('ONLINE'):
+                online.add(username)
+        return online
+
+    async def wait_offline(self, client: SimClient, offline: set) -> None:
+        # with several workers presence reaches other workers a bit later
+        names = {friend.username for friend in offline}
+        while await self.friends_online(client) & names:
+            await asyncio.sleep(0.05)
+
+    async def send_backlog(self, client: SimClient, offline: set, count: int) -> None:
+        addressees = [friend for friend in client.friends if friend in offline]
+        for seq in range(count):
+            for friend in addressees:
+                client.write(f'{friend.username}: {time.perf_counter_ns()} {seq}')
+        await client.writer.drain()
+        await client.expect(' is offline', count * len(addressees))
+
+    async def drain_backlog(self, client: SimClient) -> int:
+        start = time.perf_counter_ns()
+        await self.login(client)
+        await client.done.wait()
+        return time.perf_counter_ns() - start
+
+    async def run_phases(self) -> dict:
+        args = self.args
+        results = {}
+
+        logging.info(f'Registering {args.users} users...')
+        await self.gather((self.register(client) for client in self.clients + self.abusers),
+                          REGISTER_CONCURRENCY)
+
+        logging.info('Logging all users in at once...')
+        start = time.perf_counter()
+        await self.gather(self.login(client) for client in self.clients)
+        elapsed = time.perf_counter() - start
+        results['connection_setup'] = {'connections': len(self.clients),
+                                       'seconds': round(elapsed, 3),
+                                       'per_second': rate(len(self.clients), elapsed)}
+
+        logging.info('Adding friends...')
+        await self.gather(self.add_friends(client) for client in self.clients)
+        await self.gather(self.login(client) for client in self.abusers)
+
+        logging.info(f'Sending {args.messages} messages from every user...')
+        expected = dict.fromkeys(self.clients, 0)
+        for client in self.clients:
+            for seq in range(args.messages):
+                expected[client.friends[seq % len(client.friends)]] += 1
+        for client in self.clients:
+            client.expect_messages(expected[client])
+        self.latencies = []
+        interval = 1 / args.rate if args.rate else 0
+        floods = [asyncio.create_task(self.flood(client)) for client in self.abusers]
+        start = time.perf_counter()
+        await self.gather(self.chat(client, args.messages, interval) for client in self.clients)
+        await self.gather(client.done.wait() for client in self.clients)
+        elapsed = time.perf_counter() - start
+        results['messages'] = {'delivered': len(self.latencies),
+                               'seconds': round(elapsed, 3),
+                               'per_second': rate(len(self.latencies), elapsed),
+                               'latency_ms': percentiles(self.latencies)}
+        if self.abusers:
+            results['abuse'] = {'abusers': len(self.abusers),
+                                'commands_sent': self.flooded,
+                                'throttled_replies': self.stop_abusers(floods)}
+
+        logging.info('Checking friends statuses...')
+        samples = []
+        for client_samples in await asyncio.gather(
+                *(self.status(client, args.status) for client in self.clients)):
+            samples.extend(client_samples)
+        results['status'] = {'latency_ms': percentiles(samples)}
+
+        logging.info(f'Queueing {args.backlog} offline messages per friendship...')
+        offline = self.clients[::2]
+        online = self.clients[1::2]
+        await self.gather(client.close() for client in offline)
+        await self.gather(self.wait_offline(client, set(offline)) for client in online)
+        await self.gather(self.send_backlog(client, set(offline), args.backlog)
+                          for client in online)
+
+        logging.info('Draining offline backlog...')
+        for client in offline:
+            client.expect_messages(args.backlog * sum(friend in online for friend in client.friends))
+        self.latencies = []
+        start = time.perf_counter()
+        drains = await asyncio.wait_for(
+            asyncio.gather(*(self.drain_backlog(client) for client in offline)), PHASE_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        results['backlog'] = {'messages': len(self.latencies),
+                              'seconds': round(elapsed, 3),
+                              'per_second': rate(len(self.latencies), elapsed),
+                              'drain_ms': percentiles(drains)}
+
+        await self.gather(client.close() for client in self.clients)
+        return results
+
+    def run(self) -> dict:
+        raise_fd_limit()
+        results = {}
+        if self.args.queue_memory:
+            logging.info(f'Measuring memory of {self.args.queue_memory} queued messages...')
+            results['queue_memory'] = queue_memory(self.args.queue_memory)
+
+        try:
+            self.start_server()
+            results.update(asyncio.run(self.run_phases()))
+            results['peak_rss'] = self.stop_server()
+
+        finally:
+            if self.server:
+                try:
+                    os.killpg(self.server.pid, signal.SIGKILL)
+
+                except ProcessLookupError:
+                    pass
+                self.server.wait()
+            if not self.args.keep:
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+        config = vars(self.args).copy()
+        config.pop('output')
+        return {'config': config,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chat server benchmark')
+    parser.add_argument('--mode', choices=MODES, default='threads')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--storage', choices=STORAGES, default='sqlite',
+                        help="server's storage engine, memory works with one worker only")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--friends', type=int, default=4,
+                        help='friends of every user, neighbours on a ring')
+    parser.add_argument('--messages', type=int, default=100,
+                        help='chat messages sent by every user')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second per user, 0 sends as fast as possible')
+    parser.add_argument('--status', type=int, default=10,
+                        help='STATUS commands sent by every user')
+    parser.add_argument('--backlog', type=int, default=100,
+                        help='offline messages per friend of every offline user')
+    parser.add_argument('--abusers', type=int, default=0,
+                        help='extra users flooding the server with commands while others chat')
+    parser.add_argument('--command-rate', type=float, default=0,
+                        help="server's commands per second limit of one user, 0 disables")
+    parser.add_argument('--byte-rate', type=float, default=0,
+                        help="server's bytes per second limit of one user, 0 disables")
+    parser.add_argument('--queue-memory', type=int, default=QUEUE_MEMORY_MESSAGES,
+                        help='messages queued to measure bytes per queued message, 0 skips')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep temporary directory with database and server log')
+    parser.add_argument('--output', default='-', help='JSON file, - for stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[{asctime}] {levelname} - {message}',
+                        datefmt='%d/%m/%Y %H:%M:%S', style='{', level=logging.INFO,
+                        stream=sys.stderr)
+
+    try:
+        report = Benchmark(args).run()
+
+    except Exception as e:
+        traceback.print_exc()
+        logging.error(f'Benchmark failed. Error: {e}')
+        sys.exit(1)
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f'Results written to {args.output}...')
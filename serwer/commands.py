@@ -0,0 +1,296 @@
+import re
+import struct
+import time
+
+from framing import ENCODING, USER_ID
+
+# how arguments are carried in binary frames, in order after the opcode
+STRING = 'string'  # 2 byte length and UTF-8, checked against value pattern
+USER = 'user'  # 4 byte user id, handler gets username
+INTEGER = 'integer'  # 8 bytes, optional one is None when 0
+REST = 'rest'  # UTF-8 till the end of frame, single line like in text protocol
+
+LENGTH = struct.Struct('!H')
+INTEGER_VALUE = struct.Struct('!Q')
+
+
+def has_line_break(text: str) -> bool:
+    # text lines can't carry them, binary frames must not either, or text
+    # clients would get forged lines from them
+    return '\n' in text or '\r' in text
+
+
+class Arg:
+    # One declared argument, token must fully match the pattern and value of
+    # its first group (or whole token) is passed to the handler after convert.
+    # Optional arguments get None when missing, TEXT takes the rest of line.
+    # In binary frames argument is stored as its kind says, strings carry
+    # just the value (what the first group matches), so they are checked
+    # with value pattern instead.
+    __slots__ = ('pattern', 'convert', 'optional', 'rest', 'kind', 'value')
+
+    def __init__(self, pattern: str, convert=None, optional: bool = False,
+                 rest: bool = False, kind: str = STRING, value: str = r'\w+'):
+        self.pattern = re.compile(pattern, re.DOTALL)
+        self.convert = convert
+        self.optional = optional
+        self.rest = rest
+        self.kind = REST if rest else kind
+        self.value = re.compile(value)
+
+    def parse(self, token: str):
+        # returns None when token doesn't fit
+        match = self.pattern.fullmatch(token)
+        if match is None:
+            return None
+        value = match.group(1) if self.pattern.groups else token
+        return self.convert(value) if self.convert else value
+
+
+def optional(arg: Arg) -> Arg:
+    return Arg(arg.pattern.pattern, arg.convert, True, arg.rest, arg.kind, arg.value.pattern)
+
+
+NAME = Arg(r'(\w+)')
+FRIEND = Arg(r'(\w+)', kind=USER)  # existing user, by id in binary frames
+ROOM = Arg(r'#(\w+)')
+TARGET = Arg(r'(#?\w+)', value=r'#?\w+')  # user or #room
+NUMBER = Arg(r'(\d+)', int, kind=INTEGER)
+PASSWORD = Arg(r'(\S+)', value=r'\S+')
+TEXT = Arg(r'(.+)', rest=True)  # taken as it is, never matched
+# first token of messages addressed to user or room ('bob: hi', '#dev: hi')
+ADDRESS = Arg(r'(\w+):', kind=USER)
+ROOM_ADDRESS = Arg(r'#(\w+):')
+
+
+class ArgumentError(Exception):
+    pass
+
+
+class Command:
+    __slots__ = ('name', 'keyword', 'method', 'args', 'timer', 'required_after', 'text_from',
+                 'opcode', 'user_text')
+
+    def __init__(self, name: str, keyword: str, method: str, args: tuple, timer=None,
+                 opcode: int = None):
+        self.name = name
+        self.keyword = keyword
+        self.method = method
+        self.args = args
+        self.timer = timer
+        self.opcode = opcode
+        # whether some required argument follows i-th one
+        self.required_after = tuple(
+            any(not later.optional for later in args[i + 1:]) for i in range(len(args)))
+        # index of the only argument left when the rest is just TEXT,
+        # such tails (chat messages) skip the generic loop
+        self.text_from = len(args) - 1 if args and args[-1].rest and not args[-1].convert else None
+        # binary chat message to user id skips the generic loop as well
+        self.user_text = len(args) == 2 and args[0].kind == USER and self.text_from == 1
+
+    def parse(self, rest: str, start: int = 0) -> list:
+        # single pass over the line, every argument from start on takes
+        # the next token (TEXT takes all that's left); optional argument is
+        # skipped when token doesn't fit or when it's needed by required
+        # one after it
+        if start == self.text_from:
+            if not rest:
+                raise ArgumentError(f'{self.name}: missing text')
+            return [rest]
+
+        values = []
+        for i in range(start, len(self.args)):
+            arg = self.args[i]
+            if arg.rest:
+                if not rest:
+                    raise ArgumentError(f'{self.name}: missing text')
+                values.append(arg.convert(rest) if arg.convert else rest)
+                rest = ''
+                continue
+
+            parts = rest.split(None, 1)
+            value = arg.parse(parts[0]) if parts else None
+            remaining = parts[1] if len(parts) > 1 else ''
+
+            if value is not None and arg.optional and not remaining and self.required_after[i]:
+                value = None
+
+            if value is None:
+                if not arg.optional:
+                    raise ArgumentError(f'{self.name}: bad argument {i + 1}')
+                values.append(None)
+                continue
+
+            values.append(value)
+            rest = remaining
+
+        if rest:
+            raise ArgumentError(f'{self.name}: too many arguments')
+        return values
+
+    def unpack(self, payload: bytes, resolve=None, offset: int = 1) -> list:
+        # arguments of binary frame starting at offset (after the opcode),
+        # user ids are turned into usernames with resolve(user_id)
+        if self.user_text and len(payload) > offset + USER_ID.size and resolve:
+            address = resolve(USER_ID.unpack_from(payload, offset)[0])
+            if address is not None:
+                try:
+                    text = payload[offset + USER_ID.size:].decode(ENCODING)
+                    if not has_line_break(text):
+                        return [address, text]
+
+                except UnicodeDecodeError:
+                    pass
+            raise ArgumentError(f'{self.name}: bad argument')
+
+        values = []
+        try:
+            for arg in self.args:
+                if arg.kind == REST:
+                    value = payload[offset:].decode(ENCODING)
+                    offset = len(payload)
+                    if not value:
+                        raise ArgumentError(f'{self.name}: missing text')
+                    if has_line_break(value):
+                        raise ArgumentError(f'{self.name}: bad argument {len(values) + 1}')
+
+                elif arg.kind == USER:
+                    user_id, = USER_ID.unpack_from(payload, offset)
+                    offset += USER_ID.size
+                    value = resolve(user_id) if resolve else None
+                    if value is None:
+                        raise ArgumentError(f'{self.name}: unknown user {user_id}')
+
+                elif arg.kind == INTEGER:
+                    value, = INTEGER_VALUE.unpack_from(payload, offset)
+                    offset += INTEGER_VALUE.size
+                    if not value and arg.optional:
+                        value = None
+
+                else:
+                    size, = LENGTH.unpack_from(payload, offset)
+                    offset += LENGTH.size + size
+                    if offset > len(payload):
+                        raise ArgumentError(f'{self.name}: missing argument {len(values) + 1}')
+                    value = payload[offset - size:offset].decode(ENCODING)
+                    if not arg.value.fullmatch(value):
+                        raise ArgumentError(f'{self.name}: bad argument {len(values) + 1}')
+
+                values.append(value)
+
+        except (struct.error, UnicodeDecodeError):
+            raise ArgumentError(f'{self.name}: bad argument {len(values) + 1}')
+
+        if offset != len(payload):
+            raise ArgumentError(f'{self.name}: too many arguments')
+        return values
+
+
+class CommandRegistry:
+    # Maps first word of the line to the command with a dict lookup, so
+    # adding commands doesn't slow down the others. Commands without keyword
+    # are addressed ones ('bob: hi'), they are tried only when first word
+    # ends with ':'. Handlers are looked up by method name on the object
+    # passed to dispatch, so subclasses can override them.
+    # Binary frames find their command by opcode and skip text parsing, both
+    # end up as the same (command, argument values).
+    # Every call is timed: observed in histogram labeled with command's name
+    # (when given) and passed to hooks as hook(name, seconds).
+    def __init__(self, histogram=None, unknown: str = None):
+        self.histogram = histogram
+        self.keywords = {}
+        self.addressed = []
+        self.opcodes = {}
+        self.hooks = []
+        self.unknown = None
+        if unknown:
+            self.unknown = self._command('unknown', None, unknown, ())
+
+    def _command(self, name: str, keyword: str, method: str, args: tuple,
+                 opcode: int = None) -> Command:
+        timer = self.histogram.labels(name) if self.histogram else None
+        return Command(name, keyword, method, args, timer, opcode)
+
+    def add(self, name: str, keyword: str, method: str, *args: Arg, opcode: int = None) -> None:
+        # keyword None means first argument is the address,
+        # opcode None means command is text only
+        command = self._command(name, keyword, method, args, opcode)
+        if keyword is None:
+            self.addressed.append(command)
+        else:
+            self.keywords[keyword] = command
+        if opcode is not None:
+            self.opcodes[opcode] = command
+
+    def add_hook(self, hook) -> None:
+        self.hooks.append(hook)
+
+    def find(self, line: str) -> tuple:
+        # returns (command, argument values), (None, None) for unknown line
+        parts = line.split(None, 1)
+        if not parts:
+            return None, None
+
+        head = parts[0]
+        rest = parts[1] if len(parts) > 1 else ''
+        try:
+            command = self.keywords.get(head)
+            if command is not None:
+                return command, command.parse(rest)
+
+            if head[-1] == ':':
+                for command in self.addressed:
+                    arg = command.args[0]
+                    match = arg.pattern.fullmatch(head)
+                    if match is not None:
+                        address = arg.convert(match.group(1)) if arg.convert else match.group(1)
+                        if command.text_from == 1 and rest:
+                            # chat message, the hot path
+                            return command, [address, rest]
+                        values = command.parse(rest, 1)
+                        values.insert(0, address)
+                        return command, values
+
+        except ArgumentError:
+            pass
+
+        return None, None
+
+    def unpack(self, payload: bytes, resolve=None) -> tuple:
+        # the same as find for binary frame
+        command = self.opcodes.get(payload[0]) if payload else None
+        if command is None:
+            return None, None
+
+        try:
+            return command, command.unpack(payload, resolve)
+
+        except ArgumentError:
+            return None, None
+
+    def decode(self, frame, resolve=None) -> tuple:
+        # frame is text line or binary payload
+        if isinstance(frame, str):
+            return self.find(frame.rstrip())
+        return self.unpack(frame, resolve)
+
+    def dispatch(self, obj, frame, resolve=None):
+        # returns what handler returned
+        command, values = self.decode(frame, resolve)
+        return self.run(obj, command, values)
+
+    def run(self, obj, command: Command, values: list):
+        # command None (unknown one) goes to unknown handler
+        if command is None:
+            command, values = self.unknown, ()
+
+        start = time.perf_counter()
+        try:
+            return getattr(obj, command.method)(*values)
+
+        finally:
+            elapsed = time.perf_counter() - start
+            if command.timer:
+                command.timer.observe(elapsed)
+            for hook in self.hooks:
+                hook(command.name, elapsed)
@@ -0,0 +1,83 @@
+import threading
+import time
+import logging
+import traceback
+
+import metrics
+from storage import Storage
+from offline_writer import EXPIRED_MESSAGES, QUOTA_EXPIRED
+
+INTERVAL = 60.0  # seconds between compactions
+BATCH_SIZE = 500  # messages deleted per transaction
+# pause between batches, so writers get the write lock in between
+BATCH_PAUSE = 0.01
+VACUUM_PAGES = 1024  # free pages returned to the filesystem per compaction
+
+AGE_EXPIRED = EXPIRED_MESSAGES.labels('age')
+COMPACTIONS = metrics.REGISTRY.counter(
+    'chat_compactions_total', 'Background compactions of offline messages')
+COMPACTION_SECONDS = metrics.REGISTRY.counter(
+    'chat_compaction_seconds_total', 'Time spent in background compactions')
+
+
+class Compactor:
+    # Background retention of offline messages: every interval deletes ones
+    # older than max_age seconds and trims addressees above max_messages
+    # (0 disables either). Deletes go in small batches, each in its own short
+    # transaction, then freed pages are vacuumed and WAL is checkpointed
+    # without blocking anyone, so database file stays compact.
+    def __init__(self, db: Storage, max_age: float = 0, max_messages: int = 0,
+                 interval: float = INTERVAL, batch_size: int = BATCH_SIZE,
+                 vacuum_pages: int = VACUUM_PAGES):
+        self.db = db
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self._compacting_thread,
+                                       name='compactor', daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        # batch in progress is finished first
+        self.stopped.set()
+        self.thread.join()
+
+    def _compacting_thread(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.compact()
+
+            except Exception as e:
+                traceback.print_exc()
+                logging.error(f'Error in compaction. Error: {e}')
+
+    def compact(self) -> None:
+        start = time.perf_counter()
+        if self.max_age:
+            AGE_EXPIRED.inc(self._delete(self.db.delete_expired, time.time() - self.max_age))
+
+        if self.max_messages:
+            for addressee_id in self.db.get_over_quota(self.max_messages):
+                if self.stopped.is_set():
+                    break
+                QUOTA_EXPIRED.inc(self._delete(
+                    self.db.trim_messages, addressee_id, self.max_messages))
+
+        self.db.incremental_vacuum(self.vacuum_pages)
+        self.db.checkpoint()
+        COMPACTIONS.inc()
+        COMPACTION_SECONDS.inc(time.perf_counter() - start)
+
+    def _delete(self, delete, *args) -> int:
+        # delete(*args, limit) is called until it deletes less than a batch,
+        # returns how many were deleted in total
+        total = 0
+        while True:
+            deleted = delete(*args, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size or self.stopped.wait(BATCH_PAUSE):
+                return total
@@ -0,0 +1,353 @@
+import sqlite3
+import queue
+import threading
+import contextlib
+
+import metrics
+import migrations
+from storage import Storage, DuplicateError, BusyError
+
+POOL_SIZE = 8
+JOURNAL_MODE = 'WAL'
+SYNCHRONOUS = 'NORMAL'
+CACHE_SIZE = -8000  # negative value means KiB, so ~8 MB per connection
+CACHED_STATEMENTS = 128
+# WAL file is truncated to this size after checkpoint, so one burst of
+# writes doesn't leave it big forever
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+# seconds a write waits for the lock held by other connection (other
+# worker, compaction) before it fails with BusyError
+BUSY_TIMEOUT = 10.0
+# write transactions take the lock when they begin: deferred one that has
+# read something first can't wait for it and fails at once when another
+# connection writes
+ISOLATION_LEVEL = 'IMMEDIATE'
+
+# statements are kept as constants, so every call passes the very same
+# string and sqlite3 reuses prepared statement from connection's cache
+SELECT_USER_ID = "SELECT user_id FROM users WHERE username = ?;"
+SELECT_USERNAME = "SELECT username FROM users WHERE user_id = ?;"
+SELECT_PASSWORD = "SELECT password FROM users WHERE username = ?;"
+UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE username = ?;"
+INSERT_USER = "INSERT INTO users(username, password) VALUES (?, ?);"
+INSERT_FRIENDSHIP = "INSERT INTO friends(user1, user2) VALUES (?, ?);"
+DELETE_FRIENDSHIP = "DELETE FROM friends WHERE user1 = ? AND user2 = ?;"
+SELECT_USERS = "SELECT user_id, username FROM users;"
+SELECT_FRIENDSHIPS = "SELECT user1, user2 FROM friends;"
+# created is unix time, taken by SQLite so writer doesn't build new rows
+INSERT_MESSAGE = """ INSERT INTO messages(body, addressee, created)
+                     VALUES (?, ?, (julianday('now') - 2440587.5) * 86400.0); """
+SELECT_MESSAGES = """ SELECT message_id, body FROM messages
+                      WHERE addressee = ? AND message_id > ?
+                      ORDER BY message_id ASC
+                      LIMIT ?; """
+DELETE_MESSAGES = "DELETE FROM messages WHERE addressee = ? AND message_id <= ?;"
+COUNT_MESSAGES = "SELECT COUNT(*) FROM messages WHERE addressee = ?;"
+# deletes up to limit oldest messages of addressee above the newest max_count
+# ones (limit -1 means all of them)
+TRIM_MESSAGES = """ DELETE FROM messages WHERE message_id IN (
+                        SELECT message_id FROM messages
+                        WHERE addressee = ? AND message_id <= (
+                            SELECT message_id FROM messages WHERE addressee = ?
+                            ORDER BY message_id DESC
+                            LIMIT 1 OFFSET ?)
+                        ORDER BY message_id ASC
+                        LIMIT ?); """
+# created grows with message_id, so expired messages are at the start of
+# the table: only limit oldest rows are looked at, never the whole table
+DELETE_EXPIRED = """ DELETE FROM messages WHERE message_id IN (
+                         SELECT message_id FROM (
+                             SELECT message_id, created FROM messages
+                             ORDER BY message_id ASC
+                             LIMIT ?)
+                         WHERE created < ?); """
+SELECT_OVER_QUOTA = """ SELECT addressee FROM messages
+                        GROUP BY addressee
+                        HAVING COUNT(*) > ?; """
+INSERT_ROOM = "INSERT INTO rooms(name, owner) VALUES (?, ?);"
+SELECT_ROOM_ID = "SELECT room_id FROM rooms WHERE name = ?;"
+SELECT_ROOM_NAME = "SELECT name FROM rooms WHERE room_id = ?;"
+SELECT_ROOMS = "SELECT room_id, name FROM rooms;"
+INSERT_ROOM_MEMBER = "INSERT INTO room_members(room_id, user_id) VALUES (?, ?);"
+DELETE_ROOM_MEMBER = "DELETE FROM room_members WHERE room_id = ? AND user_id = ?;"
+SELECT_ROOM_MEMBERS = "SELECT room_id, user_id FROM room_members;"
+INSERT_HISTORY = """ INSERT INTO history(sender, user_low, user_high, room_id, body, created)
+                     VALUES (?, ?, ?, ?, ?, ?); """
+# history is read newest first, in pages ending before given message_id
+SELECT_DIRECT_HISTORY = """ SELECT message_id, sender, room_id, body, created FROM history
+                            WHERE user_low = ? AND user_high = ? AND message_id < ?
+                            ORDER BY message_id DESC
+                            LIMIT ?; """
+SELECT_ROOM_HISTORY = """ SELECT message_id, sender, room_id, body, created FROM history
+                          WHERE room_id = ? AND message_id < ?
+                          ORDER BY message_id DESC
+                          LIMIT ?; """
+SEARCH_HISTORY = """ SELECT h.message_id, h.sender, h.room_id, h.body, h.created
+                     FROM history_fts JOIN history AS h ON h.message_id = history_fts.rowid
+                     WHERE history_fts MATCH ? AND history_fts.rowid < ?
+                         AND (h.user_low = ? OR h.user_high = ? OR h.room_id IN
+                              (SELECT room_id FROM room_members WHERE user_id = ?))
+                     ORDER BY history_fts.rowid DESC
+                     LIMIT ?; """
+
+DB_SECONDS = metrics.REGISTRY.histogram(
+    'chat_db_seconds', 'Time spent in database calls, waiting for connection included',
+    ('operation',))
+POOL_WAITS = metrics.REGISTRY.counter(
+    'chat_db_pool_waits_total', 'Times all pooled connections were busy')
+
+
+class Database(Storage):
+    # SQLite engine, pool of connections to one file shared by all workers.
+    def __init__(self, path: str, pool_size: int = POOL_SIZE,
+                 synchronous: str = SYNCHRONOUS, cache_size: int = CACHE_SIZE):
+        self.path = path
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.pool_size = pool_size
+
+        self.pool = queue.Queue(pool_size)
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                               isolation_level=ISOLATION_LEVEL, check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.execute(f'PRAGMA journal_mode = {JOURNAL_MODE};')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous};')
+        conn.execute(f'PRAGMA cache_size = {self.cache_size};')
+        conn.execute(f'PRAGMA journal_size_limit = {JOURNAL_SIZE_LIMIT};')
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self.pool.get_nowait()
+
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.pool_size
+                if create:
+                    self.created += 1
+
+            if create:
+                return self._connect()
+
+            # pool is exhausted, wait for connection to be released
+            POOL_WAITS.inc()
+            return self.pool.get()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            with conn:
+                yield conn
+
+        finally:
+            self.pool.put(conn)
+
+    def migrate(self) -> int:
+        return migrations.migrate(self)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.pool.get_nowait().close()
+
+            except queue.Empty:
+                break
+
+    @metrics.timed(DB_SECONDS)
+    def get_user_id(self, username: str) -> int:
+        with self.connection() as conn:
+            row = conn.execute(SELECT_USER_ID, (username,)).fetchone()
+            return row[0] if row else None
+
+    @metrics.timed(DB_SECONDS)
+    def get_username(self, user_id: int) -> str:
+        with self.connection() as conn:
+            row = conn.execute(SELECT_USERNAME, (user_id,)).fetchone()
+            return row[0] if row else None
+
+    @metrics.timed(DB_SECONDS)
+    def get_password(self, username: str) -> str:
+        with self.connection() as conn:
+            row = conn.execute(SELECT_PASSWORD, (username,)).fetchone()
+            return row[0] if row else None
+
+    @metrics.timed(DB_SECONDS)
+    def set_password(self, username: str, password: str) -> None:
+        with self.connection() as conn:
+            conn.execute(UPDATE_PASSWORD, (password, username))
+
+    @metrics.timed(DB_SECONDS)
+    def add_user(self, username: str, password: str) -> int:
+        try:
+            with self.connection() as conn:
+                return conn.execute(INSERT_USER, (username, password)).lastrowid
+
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(f'User {username} already exists') from e
+
+    @metrics.timed(DB_SECONDS)
+    def get_users(self) -> list:
+        with self.connection() as conn:
+            return conn.execute(SELECT_USERS).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def get_friendships(self) -> list:
+        with self.connection() as conn:
+            return conn.execute(SELECT_FRIENDSHIPS).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def add_friend(self, user_id: int, friend_id: int) -> None:
+        try:
+            with self.connection() as conn:
+                conn.execute(INSERT_FRIENDSHIP, (user_id, friend_id))
+
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(f'User {user_id} already has friend {friend_id}') from e
+
+    @metrics.timed(DB_SECONDS)
+    def delete_friend(self, user_id: int, friend_id: int) -> None:
+        with self.connection() as conn:
+            conn.execute(DELETE_FRIENDSHIP, (user_id, friend_id))
+
+    @metrics.timed(DB_SECONDS)
+    def add_room(self, name: str, owner_id: int) -> int:
+        try:
+            with self.connection() as conn:
+                room_id = conn.execute(INSERT_ROOM, (name, owner_id)).lastrowid
+                conn.execute(INSERT_ROOM_MEMBER, (room_id, owner_id))
+                return room_id
+
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(f'Room {name} already exists') from e
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_id(self, name: str) -> int:
+        with self.connection() as conn:
+            row = conn.execute(SELECT_ROOM_ID, (name,)).fetchone()
+            return row[0] if row else None
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_name(self, room_id: int) -> str:
+        with self.connection() as conn:
+            row = conn.execute(SELECT_ROOM_NAME, (room_id,)).fetchone()
+            return row[0] if row else None
+
+    @metrics.timed(DB_SECONDS)
+    def get_rooms(self) -> list:
+        with self.connection() as conn:
+            return conn.execute(SELECT_ROOMS).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_members(self) -> list:
+        with self.connection() as conn:
+            return conn.execute(SELECT_ROOM_MEMBERS).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def add_room_member(self, room_id: int, user_id: int) -> None:
+        try:
+            with self.connection() as conn:
+                conn.execute(INSERT_ROOM_MEMBER, (room_id, user_id))
+
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(f'User {user_id} is already in room {room_id}') from e
+
+    @metrics.timed(DB_SECONDS)
+    def delete_room_member(self, room_id: int, user_id: int) -> None:
+        with self.connection() as conn:
+            conn.execute(DELETE_ROOM_MEMBER, (room_id, user_id))
+
+    @metrics.timed(DB_SECONDS)
+    def store_messages(self, messages: list, history: list = (), trim: tuple = (),
+                       max_messages: int = 0) -> int:
+        # all in one transaction
+        trimmed = 0
+        try:
+            with self.connection() as conn:
+                conn.executemany(INSERT_MESSAGE, messages)
+                for addressee_id in trim:
+                    trimmed += conn.execute(TRIM_MESSAGES, (
+                        addressee_id, addressee_id, max_messages, -1)).rowcount
+                conn.executemany(INSERT_HISTORY, [
+                    (sender_id, None, None, room_id, body, created)
+                    if addressee_id is None else
+                    (sender_id, min(sender_id, addressee_id), max(sender_id, addressee_id),
+                     None, body, created)
+                    for sender_id, addressee_id, room_id, body, created in history])
+
+        except sqlite3.OperationalError as e:
+            # 'database is locked', 'database table is locked'
+            if 'locked' in str(e):
+                raise BusyError(str(e)) from e
+            raise
+        return trimmed
+
+    @metrics.timed(DB_SECONDS)
+    def get_direct_history(self, user_id: int, other_id: int, before_id: int,
+                           limit: int) -> list:
+        with self.connection() as conn:
+            return conn.execute(SELECT_DIRECT_HISTORY, (
+                min(user_id, other_id), max(user_id, other_id), before_id, limit)).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_history(self, room_id: int, before_id: int, limit: int) -> list:
+        with self.connection() as conn:
+            return conn.execute(SELECT_ROOM_HISTORY, (room_id, before_id, limit)).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def search_history(self, user_id: int, query: str, before_id: int, limit: int) -> list:
+        # query is FTS5 expression
+        with self.connection() as conn:
+            return conn.execute(SEARCH_HISTORY, (
+                query, before_id, user_id, user_id, user_id, limit)).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def get_messages(self, addressee_id: int, after_id: int, limit: int) -> list:
+        with self.connection() as conn:
+            return conn.execute(SELECT_MESSAGES,
+                                (addressee_id, after_id, limit)).fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    def delete_messages(self, addressee_id: int, up_to_id: int) -> None:
+        with self.connection() as conn:
+            conn.execute(DELETE_MESSAGES, (addressee_id, up_to_id))
+
+    @metrics.timed(DB_SECONDS)
+    def count_messages(self, addressee_id: int) -> int:
+        with self.connection() as conn:
+            return conn.execute(COUNT_MESSAGES, (addressee_id,)).fetchone()[0]
+
+    @metrics.timed(DB_SECONDS)
+    def trim_messages(self, addressee_id: int, max_messages: int, limit: int) -> int:
+        with self.connection() as conn:
+            return conn.execute(TRIM_MESSAGES, (
+                addressee_id, addressee_id, max_messages, limit)).rowcount
+
+    @metrics.timed(DB_SECONDS)
+    def delete_expired(self, created_before: float, limit: int) -> int:
+        with self.connection() as conn:
+            return conn.execute(DELETE_EXPIRED, (limit, created_before)).rowcount
+
+    @metrics.timed(DB_SECONDS)
+    def get_over_quota(self, max_messages: int) -> list:
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute(SELECT_OVER_QUOTA, (max_messages,))]
+
+    @metrics.timed(DB_SECONDS)
+    def incremental_vacuum(self, pages: int) -> None:
+        # returns up to pages free pages to the filesystem, no-op unless
+        # auto_vacuum is INCREMENTAL; pragma frees one page per step and
+        # only executescript steps it to the end
+        with self.connection() as conn:
+            conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+
+    @metrics.timed(DB_SECONDS)
+    def checkpoint(self) -> tuple:
+        # copies WAL into database without waiting for readers or writers,
+        # returns (busy, WAL pages, checkpointed pages)
+        with self.connection() as conn:
+            return conn.execute('PRAGMA wal_checkpoint(PASSIVE);').fetchone()
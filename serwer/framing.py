@@ -0,0 +1,179 @@
+import struct
+import zlib
+
+ENCODING = 'utf-8'
+DELIMITER = b'\n'
+MAX_FRAME_SIZE = 64 * 1024
+
+
+class LineFramer:
+    # Splits incoming byte stream into newline delimited frames.
+    # One read may carry many frames (all of them are returned at once)
+    # or just a part of one (kept in the buffer until the rest arrives).
+    # Frames longer than max_frame_size are dropped and reported as None.
+    BINARY = False
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.discarding = False
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        frames = []
+        start = 0
+
+        while True:
+            end = self.buffer.find(DELIMITER, start)
+            if end == -1:
+                break
+
+            if self.discarding:
+                # tail of too long frame
+                self.discarding = False
+            elif end - start > self.max_frame_size:
+                frames.append(None)
+            else:
+                frames.append(
+                    self.buffer[start:end].decode(ENCODING, errors='replace'))
+
+            start = end + 1
+
+        del self.buffer[:start]
+
+        if len(self.buffer) > self.max_frame_size:
+            if not self.discarding:
+                frames.append(None)
+            self.discarding = True
+            self.buffer.clear()
+
+        return frames
+
+    # msg is Message, encoded once for all text peers
+    def encode(self, msg) -> bytes:
+        return msg.get_body()
+
+    # reply is text already encoded and newline terminated
+    def reply(self, reply: bytes) -> bytes:
+        return reply
+
+
+# Binary protocol, negotiated by client instead of its first text command:
+# it sends HELLO (BINARY_MAGIC, version, flags) right after the greeting and
+# skips greeting text until server's HELLO reply (the same magic, version
+# and flags server accepted), everything after that is binary frames.
+# Frame is 4 byte big endian length of what follows (top bit set when it's
+# zlib compressed) and payload: opcode byte and its arguments.
+BINARY_MAGIC = b'\xffCHAT'  # 0xff never starts UTF-8 text
+BINARY_VERSION = 1
+HELLO = struct.Struct('!5sBB')
+ZLIB_FLAG = 0x01  # peer accepts compressed frames
+HEADER = struct.Struct('!I')
+COMPRESSED = 0x80000000
+COMPRESSED_BYTE = 0x80  # top bit as seen in the first byte of header
+# payloads at least that long are compressed for peers accepting it
+COMPRESS_THRESHOLD = 1024
+
+# opcodes of frames sent by server, client commands have their own ones
+REPLY = 0x40  # text reply or notice
+CHAT = 0x41  # message from other user or room, text 'alice: hi'
+USER = 0x42  # user id (4 bytes) and username, e.g. own id after login
+PING = 0x43  # server checks if client is alive, it answers with PONG
+USER_ID = struct.Struct('!I')
+COMPRESS_LEVEL = 1  # fast, chat text compresses well anyway
+
+
+def negotiate(data: bytes, compress_threshold: int = COMPRESS_THRESHOLD) -> tuple:
+    # picks protocol by the first bytes client sent after greeting, returns
+    # (framer, reply, the rest of data), framer is None while data may still
+    # turn out to be HELLO. Compression is used when both sides want it
+    # (compress_threshold 0 means server doesn't)
+    if len(data) < HELLO.size and BINARY_MAGIC.startswith(data[:len(BINARY_MAGIC)]):
+        return None, b'', data
+
+    if not data.startswith(BINARY_MAGIC):
+        return LineFramer(), b'', data
+
+    _, version, flags = HELLO.unpack_from(data)
+    flags &= ZLIB_FLAG if compress_threshold else 0
+    framer = BinaryFramer(compress_threshold=compress_threshold if flags else 0)
+    return framer, HELLO.pack(BINARY_MAGIC, BINARY_VERSION, flags), data[HELLO.size:]
+
+
+class BinaryFramer:
+    # Splits incoming byte stream into length-prefixed frames, returned as
+    # payloads (opcode and arguments, already decompressed). Frames longer
+    # than max_frame_size (compressed or not) are skipped and reported as
+    # None, ones that fail to decompress come as empty payload.
+    # Outgoing frames are compressed when they are at least
+    # compress_threshold bytes long (0 disables).
+    BINARY = True
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE, compress_threshold: int = 0):
+        self.max_frame_size = max_frame_size
+        self.compress_threshold = compress_threshold
+        self.buffer = bytearray()
+        # bytes of too long frame that haven't arrived yet
+        self.discarding = 0
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        frames = []
+        start = min(self.discarding, len(self.buffer))
+        self.discarding -= start
+
+        while len(self.buffer) - start >= HEADER.size:
+            header, = HEADER.unpack_from(self.buffer, start)
+            size = header & ~COMPRESSED
+            if size > self.max_frame_size:
+                frames.append(None)
+                start += HEADER.size
+                skipped = min(size, len(self.buffer) - start)
+                self.discarding = size - skipped
+                start += skipped
+                continue
+
+            end = start + HEADER.size + size
+            if end > len(self.buffer):
+                break
+
+            payload = bytes(self.buffer[start + HEADER.size:end])
+            frames.append(self._decompress(payload) if header & COMPRESSED else payload)
+            start = end
+
+        del self.buffer[:start]
+        return frames
+
+    def _decompress(self, payload: bytes):
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, self.max_frame_size)
+
+        except zlib.error:
+            return b''
+
+        if decompressor.unconsumed_tail:
+            return None
+        return payload
+
+    def pack(self, opcode: int, data: bytes) -> bytes:
+        payload = bytes((opcode,)) + data
+        if self.compress_threshold and len(payload) >= self.compress_threshold:
+            compressed = zlib.compress(payload, COMPRESS_LEVEL)
+            if len(compressed) < len(payload):
+                return HEADER.pack(len(compressed) | COMPRESSED) + compressed
+        return HEADER.pack(len(payload)) + payload
+
+    # msg is Message with its OPCODE, payload() and frame slot, where the
+    # first frame made is kept: fan-out encodes (and compresses) it once,
+    # only peers that don't accept compressed frames may need their own
+    def encode(self, msg) -> bytes:
+        frame = msg.frame
+        if frame is None or (frame[0] & COMPRESSED_BYTE and not self.compress_threshold):
+            frame = self.pack(msg.OPCODE, msg.payload())
+            if msg.frame is None:
+                msg.frame = frame
+        return frame
+
+    def reply(self, reply: bytes) -> bytes:
+        return self.pack(REPLY, reply[:-1])
@@ -0,0 +1,120 @@
+import threading
+import logging
+
+from storage import Storage
+
+
+class SocialGraph:
+    # Process wide cache of usernames and friendships.
+    # Writes go to the database first and then to memory (write-through)
+    # under the lock. Single lookups rely on dict/set operations being
+    # atomic, so the hot path (is_friend) never takes the lock.
+    def __init__(self, db: Storage):
+        self.db = db
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.names = {}
+        self.friends = {}
+        # reverse index, user_id -> ids of users having him in friends list
+        self.watchers = {}
+        # on_change(user_id, friend_id, added) is called after every friendship
+        # change, so other processes can update their copies
+        self.on_change = None
+
+    def load(self) -> None:
+        with self.lock:
+            for user_id, username in self.db.get_users():
+                self.ids[username] = user_id
+                self.names[user_id] = username
+
+            for user1, user2 in self.db.get_friendships():
+                self.friends.setdefault(user1, set()).add(user2)
+                self.watchers.setdefault(user2, set()).add(user1)
+
+        logging.info(f'Loaded {len(self.ids)} users to social graph...')
+
+    def user_id(self, username: str) -> int:
+        user_id = self.ids.get(username)
+        if user_id is None:
+            # user might have been added behind cache's back
+            user_id = self.db.get_user_id(username)
+            if user_id is not None:
+                with self.lock:
+                    self.ids[username] = user_id
+                    self.names[user_id] = username
+
+        return user_id
+
+    def add_user(self, username: str, password: str) -> int:
+        with self.lock:
+            user_id = self.db.add_user(username, password)
+            self.ids[username] = user_id
+            self.names[user_id] = username
+            return user_id
+
+    def username(self, user_id: int) -> str:
+        username = self.names.get(user_id)
+        if username is None:
+            username = self.db.get_username(user_id)
+            if username is not None:
+                with self.lock:
+                    self.ids[username] = user_id
+                    self.names[user_id] = username
+
+        return username
+
+    def is_friend(self, user_id: int, friend_id: int) -> bool:
+        return friend_id in self.friends.get(user_id, ())
+
+    def add_friend(self, user_id: int, friend_id: int) -> None:
+        with self.lock:
+            self.db.add_friend(user_id, friend_id)
+            self.friends.setdefault(user_id, set()).add(friend_id)
+            self.watchers.setdefault(friend_id, set()).add(user_id)
+
+        if self.on_change:
+            self.on_change(user_id, friend_id, True)
+
+    def delete_friend(self, user_id: int, friend_id: int) -> None:
+        with self.lock:
+            self.db.delete_friend(user_id, friend_id)
+            self.friends.get(user_id, set()).discard(friend_id)
+            self.watchers.get(friend_id, set()).discard(user_id)
+
+        if self.on_change:
+            self.on_change(user_id, friend_id, False)
+
+    # updates memory only, change is already in the database
+    def apply_friendship(self, user_id: int, friend_id: int, added: bool) -> None:
+        with self.lock:
+            if friend_id not in self.names:
+                username = self.db.get_username(friend_id)
+                if username is None:
+                    return
+                self.ids[username] = friend_id
+                self.names[friend_id] = username
+
+            if user_id not in self.names:
+                username = self.db.get_username(user_id)
+                if username is None:
+                    return
+                self.ids[username] = user_id
+                self.names[user_id] = username
+
+            if added:
+                self.friends.setdefault(user_id, set()).add(friend_id)
+                self.watchers.setdefault(friend_id, set()).add(user_id)
+            else:
+                self.friends.get(user_id, set()).discard(friend_id)
+                self.watchers.get(friend_id, set()).discard(user_id)
+
+    def get_friends(self, user_id: int) -> list:
+        with self.lock:
+            return [self.names[friend_id]
+                    for friend_id in self.friends.get(user_id, ())]
+
+    def get_watchers(self, user_id: int) -> list:
+        # names of users having user_id in their friends lists
+        with self.lock:
+            return [self.names[watcher_id]
+                    for watcher_id in self.watchers.get(user_id, ())]
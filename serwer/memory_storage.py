@@ -0,0 +1,449 @@
+import bisect
+import collections
+import json
+import logging
+import operator
+import os
+import re
+import threading
+import time
+
+import metrics
+from database import DB_SECONDS
+from storage import Storage, DuplicateError
+
+SNAPSHOT_ENCODING = 'utf-8'
+WORD = re.compile(r'\w+')
+PHRASE = re.compile(r'"((?:[^"]|"")*)"')
+
+# snapshot records, one JSON list per line starting with its kind
+USER = 'user'  # user_id, username, password
+PASSWORD = 'password'  # username, password
+FRIEND = 'friend'  # user_id, friend_id
+UNFRIEND = 'unfriend'  # user_id, friend_id
+ROOM = 'room'  # room_id, name, owner_id
+MEMBER = 'member'  # room_id, user_id
+LEAVE = 'leave'  # room_id, user_id
+MESSAGES = 'messages'  # [[message_id, body, addressee_id, created], ...]
+DELETE = 'delete'  # addressee_id, message_id: all up to it are gone
+EXPIRE = 'expire'  # message_id: all up to it are gone, for every addressee
+HISTORY = 'history'  # [[message_id, sender_id, user_low, user_high, room_id, body, created], ...]
+
+message_key = operator.itemgetter(0)
+
+
+def tokens(text: str) -> list:
+    # words as FTS5 default tokenizer sees them, case folded
+    return WORD.findall(text.lower())
+
+
+def contains(words: list, phrase: list) -> bool:
+    if not phrase:
+        return True
+    for i in range(len(words) - len(phrase) + 1):
+        if words[i:i + len(phrase)] == phrase:
+            return True
+    return False
+
+
+class MemoryStorage(Storage):
+    # Engine keeping everything in dicts and lists of one process, no disk
+    # I/O unless snapshot_path is given. Snapshot is append-only log of
+    # changes (one JSON line each, flushed but not fsynced), replayed on
+    # start and then rewritten with what's left, so it doesn't keep
+    # deleted messages forever. It belongs to one process: other workers
+    # or hot restart successor won't see the changes.
+    # Offline messages of every addressee are sorted by id and only ever
+    # deleted from the front (delivery, trimming, expiry), so all of them
+    # are slices of lists. History search scans all history, newest first.
+    def __init__(self, snapshot_path: str = None):
+        self.snapshot_path = snapshot_path
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+        self.user_ids = {}
+        self.usernames = {}
+        self.passwords = {}
+        self.friendships = set()
+        self.room_ids = {}
+        self.room_names = {}
+        self.members = set()
+        # message_id -> (addressee_id, body, created), in id order, so
+        # the oldest are the first ones
+        self.messages = collections.OrderedDict()
+        # addressee_id -> sorted ids of their messages
+        self.inboxes = {}
+        self.history = []
+        # (user_low, user_high) or room_id -> history rows, oldest first
+        self.conversations = {}
+        self.rooms_history = {}
+        self.last_user_id = 0
+        self.last_room_id = 0
+        self.last_message_id = 0
+        self.last_history_id = 0
+
+    def migrate(self) -> int:
+        if self.snapshot_path:
+            self._load()
+        return 0
+
+    def close(self) -> None:
+        with self.lock:
+            if self.snapshot:
+                self.snapshot.close()
+                self.snapshot = None
+
+    # snapshot
+
+    def _load(self) -> None:
+        records = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding=SNAPSHOT_ENCODING) as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # last write was cut off by a crash
+                        logging.warning(f'Ignoring incomplete snapshot record: {line!r}')
+                        break
+                    self._apply(json.loads(line))
+                    records += 1
+
+        logging.info(f'Loaded {records} snapshot records, {len(self.usernames)} users, '
+                     f'{len(self.messages)} offline messages...')
+        self._rewrite()
+
+    def _rewrite(self) -> None:
+        # current state as fresh log, swapped in atomically
+        path = self.snapshot_path + '.tmp'
+        with open(path, 'w', encoding=SNAPSHOT_ENCODING) as f:
+            for user_id, username in self.usernames.items():
+                self._dump(f, (USER, user_id, username, self.passwords[username]))
+            for user_id, friend_id in self.friendships:
+                self._dump(f, (FRIEND, user_id, friend_id))
+            for room_id, name in self.room_names.items():
+                self._dump(f, (ROOM, room_id, name, None))
+            for room_id, user_id in self.members:
+                self._dump(f, (MEMBER, room_id, user_id))
+            self._dump(f, (MESSAGES, [(message_id, body, addressee_id, created)
+                                      for message_id, (addressee_id, body, created)
+                                      in self.messages.items()]))
+            self._dump(f, (HISTORY, self.history))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(path, self.snapshot_path)
+        self.snapshot = open(self.snapshot_path, 'a', encoding=SNAPSHOT_ENCODING)
+
+    @staticmethod
+    def _dump(f, record: tuple) -> None:
+        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+        f.write('\n')
+
+    def _log(self, *record) -> None:
+        # called with lock held, after change is applied
+        if self.snapshot:
+            self._dump(self.snapshot, record)
+            self.snapshot.flush()
+
+    def _apply(self, record: list) -> None:
+        kind, args = record[0], record[1:]
+        if kind == USER:
+            self._add_user(*args)
+        elif kind == PASSWORD:
+            self.passwords[args[0]] = args[1]
+        elif kind == FRIEND:
+            self.friendships.add(tuple(args))
+        elif kind == UNFRIEND:
+            self.friendships.discard(tuple(args))
+        elif kind == ROOM:
+            self._add_room(*args)
+        elif kind == MEMBER:
+            self.members.add(tuple(args))
+        elif kind == LEAVE:
+            self.members.discard(tuple(args))
+        elif kind == MESSAGES:
+            for message_id, body, addressee_id, created in args[0]:
+                self._add_message(message_id, body, addressee_id, created)
+        elif kind == DELETE:
+            self._delete_messages(*args)
+        elif kind == EXPIRE:
+            self._expire(args[0])
+        elif kind == HISTORY:
+            for row in args[0]:
+                self._add_history(*row)
+        else:
+            raise ValueError(f'Unknown snapshot record {kind}')
+
+    # changes, called with lock held (or during load)
+
+    def _add_user(self, user_id: int, username: str, password: str) -> None:
+        self.user_ids[username] = user_id
+        self.usernames[user_id] = username
+        self.passwords[username] = password
+        self.last_user_id = max(self.last_user_id, user_id)
+
+    def _add_room(self, room_id: int, name: str, owner_id: int) -> None:
+        self.room_ids[name] = room_id
+        self.room_names[room_id] = name
+        if owner_id is not None:
+            self.members.add((room_id, owner_id))
+        self.last_room_id = max(self.last_room_id, room_id)
+
+    def _add_message(self, message_id: int, body: str, addressee_id: int,
+                     created: float) -> None:
+        self.messages[message_id] = (addressee_id, body, created)
+        self.inboxes.setdefault(addressee_id, []).append(message_id)
+        self.last_message_id = max(self.last_message_id, message_id)
+
+    def _delete_messages(self, addressee_id: int, up_to_id: int) -> int:
+        inbox = self.inboxes.get(addressee_id)
+        if not inbox:
+            return 0
+        count = bisect.bisect_right(inbox, up_to_id)
+        for message_id in inbox[:count]:
+            del self.messages[message_id]
+        del inbox[:count]
+        if not inbox:
+            del self.inboxes[addressee_id]
+        return count
+
+    def _expire(self, up_to_id: int) -> None:
+        while self.messages:
+            message_id = next(iter(self.messages))
+            if message_id > up_to_id:
+                break
+            self._delete_messages(self.messages[message_id][0], message_id)
+
+    def _add_history(self, message_id: int, sender_id: int, user_low: int, user_high: int,
+                     room_id: int, body: str, created: float) -> None:
+        row = (message_id, sender_id, user_low, user_high, room_id, body, created)
+        self.history.append(row)
+        if room_id is None:
+            self.conversations.setdefault((user_low, user_high), []).append(row)
+        else:
+            self.rooms_history.setdefault(room_id, []).append(row)
+        self.last_history_id = max(self.last_history_id, message_id)
+
+    # users and friendships
+
+    @metrics.timed(DB_SECONDS)
+    def get_user_id(self, username: str) -> int:
+        return self.user_ids.get(username)
+
+    @metrics.timed(DB_SECONDS)
+    def get_username(self, user_id: int) -> str:
+        return self.usernames.get(user_id)
+
+    @metrics.timed(DB_SECONDS)
+    def get_password(self, username: str) -> str:
+        return self.passwords.get(username)
+
+    @metrics.timed(DB_SECONDS)
+    def set_password(self, username: str, password: str) -> None:
+        with self.lock:
+            if username in self.passwords:
+                self.passwords[username] = password
+                self._log(PASSWORD, username, password)
+
+    @metrics.timed(DB_SECONDS)
+    def add_user(self, username: str, password: str) -> int:
+        with self.lock:
+            if username in self.user_ids:
+                raise DuplicateError(f'User {username} already exists')
+            user_id = self.last_user_id + 1
+            self._add_user(user_id, username, password)
+            self._log(USER, user_id, username, password)
+            return user_id
+
+    @metrics.timed(DB_SECONDS)
+    def get_users(self) -> list:
+        with self.lock:
+            return list(self.usernames.items())
+
+    @metrics.timed(DB_SECONDS)
+    def get_friendships(self) -> list:
+        with self.lock:
+            return list(self.friendships)
+
+    @metrics.timed(DB_SECONDS)
+    def add_friend(self, user_id: int, friend_id: int) -> None:
+        with self.lock:
+            if (user_id, friend_id) in self.friendships:
+                raise DuplicateError(f'User {user_id} already has friend {friend_id}')
+            self.friendships.add((user_id, friend_id))
+            self._log(FRIEND, user_id, friend_id)
+
+    @metrics.timed(DB_SECONDS)
+    def delete_friend(self, user_id: int, friend_id: int) -> None:
+        with self.lock:
+            if (user_id, friend_id) in self.friendships:
+                self.friendships.remove((user_id, friend_id))
+                self._log(UNFRIEND, user_id, friend_id)
+
+    # rooms
+
+    @metrics.timed(DB_SECONDS)
+    def add_room(self, name: str, owner_id: int) -> int:
+        with self.lock:
+            if name in self.room_ids:
+                raise DuplicateError(f'Room {name} already exists')
+            room_id = self.last_room_id + 1
+            self._add_room(room_id, name, owner_id)
+            self._log(ROOM, room_id, name, owner_id)
+            return room_id
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_id(self, name: str) -> int:
+        return self.room_ids.get(name)
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_name(self, room_id: int) -> str:
+        return self.room_names.get(room_id)
+
+    @metrics.timed(DB_SECONDS)
+    def get_rooms(self) -> list:
+        with self.lock:
+            return list(self.room_names.items())
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_members(self) -> list:
+        with self.lock:
+            return list(self.members)
+
+    @metrics.timed(DB_SECONDS)
+    def add_room_member(self, room_id: int, user_id: int) -> None:
+        with self.lock:
+            if (room_id, user_id) in self.members:
+                raise DuplicateError(f'User {user_id} is already in room {room_id}')
+            self.members.add((room_id, user_id))
+            self._log(MEMBER, room_id, user_id)
+
+    @metrics.timed(DB_SECONDS)
+    def delete_room_member(self, room_id: int, user_id: int) -> None:
+        with self.lock:
+            if (room_id, user_id) in self.members:
+                self.members.remove((room_id, user_id))
+                self._log(LEAVE, room_id, user_id)
+
+    # offline messages and history
+
+    @metrics.timed(DB_SECONDS)
+    def store_messages(self, messages: list, history: list = (), trim: tuple = (),
+                       max_messages: int = 0) -> int:
+        created = time.time()
+        with self.lock:
+            rows = []
+            for body, addressee_id in messages:
+                self.last_message_id += 1
+                self._add_message(self.last_message_id, body, addressee_id, created)
+                rows.append((self.last_message_id, body, addressee_id, created))
+            if rows:
+                self._log(MESSAGES, rows)
+
+            rows = []
+            for sender_id, addressee_id, room_id, body, entry_created in history:
+                self.last_history_id += 1
+                if addressee_id is None:
+                    row = (self.last_history_id, sender_id, None, None, room_id, body,
+                           entry_created)
+                else:
+                    row = (self.last_history_id, sender_id, min(sender_id, addressee_id),
+                           max(sender_id, addressee_id), None, body, entry_created)
+                self._add_history(*row)
+                rows.append(row)
+            if rows:
+                self._log(HISTORY, rows)
+
+            return sum(self._trim(addressee_id, max_messages, -1) for addressee_id in trim)
+
+    @metrics.timed(DB_SECONDS)
+    def get_messages(self, addressee_id: int, after_id: int, limit: int) -> list:
+        with self.lock:
+            inbox = self.inboxes.get(addressee_id, ())
+            start = bisect.bisect_right(inbox, after_id)
+            return [(message_id, self.messages[message_id][1])
+                    for message_id in inbox[start:start + limit]]
+
+    @metrics.timed(DB_SECONDS)
+    def delete_messages(self, addressee_id: int, up_to_id: int) -> None:
+        with self.lock:
+            if self._delete_messages(addressee_id, up_to_id):
+                self._log(DELETE, addressee_id, up_to_id)
+
+    @metrics.timed(DB_SECONDS)
+    def count_messages(self, addressee_id: int) -> int:
+        return len(self.inboxes.get(addressee_id, ()))
+
+    @metrics.timed(DB_SECONDS)
+    def trim_messages(self, addressee_id: int, max_messages: int, limit: int) -> int:
+        with self.lock:
+            return self._trim(addressee_id, max_messages, limit)
+
+    def _trim(self, addressee_id: int, max_messages: int, limit: int) -> int:
+        inbox = self.inboxes.get(addressee_id, ())
+        count = len(inbox) - max_messages
+        if limit >= 0:
+            count = min(count, limit)
+        if count <= 0:
+            return 0
+        up_to_id = inbox[count - 1]
+        self._delete_messages(addressee_id, up_to_id)
+        self._log(DELETE, addressee_id, up_to_id)
+        return count
+
+    @metrics.timed(DB_SECONDS)
+    def delete_expired(self, created_before: float, limit: int) -> int:
+        with self.lock:
+            expired = []
+            for message_id, (_, _, created) in self.messages.items():
+                if created >= created_before or len(expired) == limit:
+                    break
+                expired.append(message_id)
+
+            if expired:
+                self._expire(expired[-1])
+                self._log(EXPIRE, expired[-1])
+            return len(expired)
+
+    @metrics.timed(DB_SECONDS)
+    def get_over_quota(self, max_messages: int) -> list:
+        with self.lock:
+            return [addressee_id for addressee_id, inbox in self.inboxes.items()
+                    if len(inbox) > max_messages]
+
+    @staticmethod
+    def _page(rows: list, before_id: int, limit: int) -> list:
+        end = bisect.bisect_left(rows, before_id, key=message_key)
+        return [(message_id, sender_id, room_id, body, created)
+                for message_id, sender_id, _, _, room_id, body, created
+                in reversed(rows[max(0, end - limit):end])]
+
+    @metrics.timed(DB_SECONDS)
+    def get_direct_history(self, user_id: int, other_id: int, before_id: int,
+                           limit: int) -> list:
+        with self.lock:
+            rows = self.conversations.get((min(user_id, other_id), max(user_id, other_id)), [])
+            return self._page(rows, before_id, limit)
+
+    @metrics.timed(DB_SECONDS)
+    def get_room_history(self, room_id: int, before_id: int, limit: int) -> list:
+        with self.lock:
+            return self._page(self.rooms_history.get(room_id, []), before_id, limit)
+
+    @metrics.timed(DB_SECONDS)
+    def search_history(self, user_id: int, query: str, before_id: int, limit: int) -> list:
+        phrases = [tokens(phrase.replace('""', '"')) for phrase in PHRASE.findall(query)]
+        found = []
+        with self.lock:
+            rooms = {room_id for room_id, member_id in self.members if member_id == user_id}
+            end = bisect.bisect_left(self.history, before_id, key=message_key)
+            for i in range(end - 1, -1, -1):
+                message_id, sender_id, user_low, user_high, room_id, body, created = \
+                    self.history[i]
+                if user_low != user_id and user_high != user_id and room_id not in rooms:
+                    continue
+                words = tokens(body)
+                if all(contains(words, phrase) for phrase in phrases):
+                    found.append((message_id, sender_id, room_id, body, created))
+                    if len(found) == limit:
+                        break
+        return found
@@ -0,0 +1,284 @@
+import bisect
+import functools
+import threading
+import time
+import http.server
+import logging
+
+# 1-2-5 series from 1 us to 10 s, values above land in +Inf bucket
+LATENCY_BUCKETS = tuple(m * 10.0 ** e for e in range(-6, 1) for m in (1, 2, 5)) + (10.0,)
+SIZE_BUCKETS = tuple(float(m * 10 ** e) for e in range(0, 4) for m in (1, 2, 5)) + (10000.0,)
+QUANTILES = (0.5, 0.99)
+SCRAPE_HOST = '127.0.0.1'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def get(self) -> float:
+        return self.value
+
+
+class _GaugeValue:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function) -> None:
+        # value is computed only when metrics are rendered
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self) -> tuple:
+        with self.lock:
+            counts = list(self.counts)
+            return counts, self.sum, sum(counts)
+
+    def quantile(self, q: float, counts: list = None) -> float:
+        # linear interpolation inside the bucket holding the q-th observation
+        if counts is None:
+            counts = self.snapshot()[0]
+        total = sum(counts)
+        if not total:
+            return 0.0
+
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: _HistogramValue):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    # Family of values sharing name and label names. Children are created on
+    # first use of their label values and cached, hot paths should look them
+    # up once and keep the child.
+    TYPE = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.kwargs = kwargs
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            # metrics without labels are used directly
+            child = self.children[()] = self._new_child()
+            for attr in ('inc', 'set', 'set_function', 'observe', 'time', 'get'):
+                if hasattr(child, attr):
+                    setattr(self, attr, getattr(child, attr))
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.TYPE}']
+        for values, child in sorted(self.children.items()):
+            lines.append(
+                f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}')
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def _new_child(self):
+        return _HistogramValue(self.kwargs.get('buckets', LATENCY_BUCKETS))
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.TYPE}']
+        quantiles = []
+
+        for values, child in sorted(self.children.items()):
+            counts, total, count = child.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(child.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+
+            for q in QUANTILES:
+                labels = _format_labels(self.labelnames, values, f'quantile="{q}"')
+                quantiles.append(
+                    f'{self.name}_quantile{labels} {child.quantile(q, counts):.6g}')
+
+        # estimated from buckets, handy when reading STATS by hand
+        lines.append(f'# HELP {self.name}_quantile Estimated quantiles of {self.name}')
+        lines.append(f'# TYPE {self.name}_quantile gauge')
+        return lines + quantiles
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics):
+            try:
+                lines.extend(metric.render())
+
+            except Exception as e:
+                logging.error(f'Cannot render metric {metric.name}. Error: {e}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram: Histogram):
+    # decorator, observes duration of every call labeled with function's name
+    def decorator(fn):
+        child = histogram.labels(fn.__name__)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+
+            finally:
+                child.observe(time.perf_counter() - start)
+
+        return wrapper
+    return decorator
+
+
+class _ScrapeHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ScrapeServer(http.server.ThreadingHTTPServer):
+    # restarted server binds the port while the old one is still draining
+    allow_reuse_port = True
+
+
+def start_http_server(port: int, registry: Registry = REGISTRY,
+                      host: str = SCRAPE_HOST) -> http.server.ThreadingHTTPServer:
+    # serves registry in Prometheus text format, bound to localhost only
+    handler = type('ScrapeHandler', (_ScrapeHandler,), {'registry': registry})
+    server = _ScrapeServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
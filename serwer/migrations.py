@@ -0,0 +1,149 @@
+import logging
+
+# imported by database, so Database is only referred to in annotations
+import database
+
+# every migration is (version, script), versions must be increasing
+# NEVER edit already released migration, add new one instead
+MIGRATIONS = [
+    (1, """ CREATE TABLE IF NOT EXISTS users(
+                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                password TEXT NOT NULL,
+                CONSTRAINT username_constraint UNIQUE (username)
+            );
+            CREATE TABLE IF NOT EXISTS friends(
+                user1 INTEGER,
+                user2 INTEGER,
+                CONSTRAINT fk_column
+                    FOREIGN KEY (user1, user2)
+                    REFERENCES users (user_id, user_id)
+            );
+            CREATE TABLE IF NOT EXISTS messages(
+                message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                body TEXT,
+                addressee INTEGER,
+                CONSTRAINT fk_column
+                    FOREIGN KEY (addressee)
+                    REFERENCES users (user_id)
+            ); """),
+
+    # composite key on friends (duplicates dropped on copy),
+    # reverse lookup index and index for per addressee message scans
+    (2, """ CREATE TABLE friends_new(
+                user1 INTEGER NOT NULL REFERENCES users (user_id),
+                user2 INTEGER NOT NULL REFERENCES users (user_id),
+                PRIMARY KEY (user1, user2)
+            ) WITHOUT ROWID;
+            INSERT OR IGNORE INTO friends_new(user1, user2)
+                SELECT user1, user2 FROM friends
+                WHERE user1 IS NOT NULL AND user2 IS NOT NULL;
+            DROP TABLE friends;
+            ALTER TABLE friends_new RENAME TO friends;
+            CREATE INDEX friends_reverse_idx ON friends (user2, user1);
+            CREATE INDEX messages_addressee_idx
+                ON messages (addressee, message_id); """),
+
+    # group chat rooms, members are scanned per room when posting
+    # and per user when loading
+    (3, """ CREATE TABLE rooms(
+                room_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                owner INTEGER NOT NULL REFERENCES users (user_id)
+            );
+            CREATE TABLE room_members(
+                room_id INTEGER NOT NULL REFERENCES rooms (room_id),
+                user_id INTEGER NOT NULL REFERENCES users (user_id),
+                PRIMARY KEY (room_id, user_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX room_members_user_idx ON room_members (user_id, room_id); """),
+
+    # append-only log of all messages, direct ones are keyed by the pair of
+    # users (lower id first), so conversation is one index range either way;
+    # FTS index over bodies is kept in sync by triggers
+    (4, """ CREATE TABLE history(
+                message_id INTEGER PRIMARY KEY,
+                sender INTEGER NOT NULL REFERENCES users (user_id),
+                user_low INTEGER REFERENCES users (user_id),
+                user_high INTEGER REFERENCES users (user_id),
+                room_id INTEGER REFERENCES rooms (room_id),
+                body TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX history_users_idx ON history (user_low, user_high, message_id);
+            CREATE INDEX history_room_idx ON history (room_id, message_id);
+            CREATE VIRTUAL TABLE history_fts USING fts5(
+                body, content='history', content_rowid='message_id');
+            CREATE TRIGGER history_fts_insert AFTER INSERT ON history BEGIN
+                INSERT INTO history_fts(rowid, body) VALUES (new.message_id, new.body);
+            END;
+            CREATE TRIGGER history_fts_delete AFTER DELETE ON history BEGIN
+                INSERT INTO history_fts(history_fts, rowid, body)
+                    VALUES ('delete', old.message_id, old.body);
+            END; """),
+
+    # offline messages get creation time for retention, ones already
+    # waiting count as created now
+    (5, """ ALTER TABLE messages ADD COLUMN created REAL;
+            UPDATE messages SET created = (julianday('now') - 2440587.5) * 86400.0; """),
+]
+
+CREATE_VERSION_TABLE = """ CREATE TABLE IF NOT EXISTS schema_version(
+                               version INTEGER NOT NULL
+                           ); """
+SELECT_VERSION = "SELECT MAX(version) FROM schema_version;"
+# lets compaction give free pages back in small steps (PRAGMA incremental_vacuum),
+# switching existing database needs one full VACUUM
+INCREMENTAL_VACUUM = 2
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0]
+
+
+def current_version(db: 'database.Database') -> int:
+    with db.connection() as conn:
+        conn.execute(CREATE_VERSION_TABLE)
+        version, = conn.execute(SELECT_VERSION).fetchone()
+        return version or 0
+
+
+def migrate(db: 'database.Database') -> int:
+    version = current_version(db)
+    if version >= latest_version():
+        logging.info(f'Database schema is up to date (version {version})...')
+        return version
+
+    with db.connection() as conn:
+        for migration_version, script in MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            logging.info(
+                f'Migrating database to version {migration_version}...')
+            try:
+                conn.executescript(
+                    f"BEGIN; {script} "
+                    f"INSERT INTO schema_version(version) VALUES ({migration_version}); "
+                    f"COMMIT;")
+
+            except Exception:
+                conn.rollback()
+                raise
+
+            version = migration_version
+
+        enable_incremental_vacuum(conn)
+
+    return version
+
+
+def enable_incremental_vacuum(conn) -> None:
+    mode, = conn.execute('PRAGMA auto_vacuum;').fetchone()
+    if mode == INCREMENTAL_VACUUM:
+        return
+
+    # rewrites whole file once, done before any client is served
+    logging.info('Rebuilding database for incremental vacuum...')
+    conn.execute(f'PRAGMA auto_vacuum = {INCREMENTAL_VACUUM};')
+    conn.execute('VACUUM;')
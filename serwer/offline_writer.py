@@ -0,0 +1,229 @@
+import collections
+import queue
+import threading
+import time
+import logging
+import traceback
+
+import metrics
+from storage import Storage, BusyError
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 1000
+FLUSH_INTERVAL = 0.005  # seconds writer waits for batch to fill up
+# counts of queued messages known to writer are forgotten above this
+# many addressees and counted again when needed
+MAX_COUNTED = 100000
+# batch is tried again that many times while storage is busy, waiting
+# RETRY_DELAY seconds at first, twice as long after every attempt
+WRITE_RETRIES = 8
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 2.0
+
+# sender is notified right away, message may be lost if process crashes
+# before its batch is committed
+ASYNC_DURABILITY = 'async'
+# sender is notified only after message's batch was committed
+SYNC_DURABILITY = 'sync'
+
+# queue items are tuples starting with their kind
+MESSAGE = 'message'  # offline message for one or more users
+HISTORY = 'history'  # entry of message history
+
+BATCH_MESSAGES = metrics.REGISTRY.histogram(
+    'chat_offline_batch_messages', 'Offline messages inserted per transaction',
+    buckets=metrics.SIZE_BUCKETS)
+HISTORY_ENTRIES = metrics.REGISTRY.counter(
+    'chat_history_entries_total', 'Messages appended to history')
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'chat_offline_queue_depth', 'Offline messages waiting for writer')
+EXPIRED_MESSAGES = metrics.REGISTRY.counter(
+    'chat_offline_expired_total', 'Offline messages deleted by retention', ('reason',))
+QUOTA_EXPIRED = EXPIRED_MESSAGES.labels('quota')
+WRITE_RETRIES_TOTAL = metrics.REGISTRY.counter(
+    'chat_offline_write_retries_total', 'Batches tried again because storage was busy')
+OVERFLOWED = metrics.REGISTRY.counter(
+    'chat_offline_overflow_total', 'Items put aside because writer queue was full')
+
+
+class OfflineWriter:
+    # Write-behind stage for offline messages and message history. Both are
+    # put into bounded queue and one thread inserts them in batches, one
+    # transaction per batch.
+    # Addressees are kept to max_messages newest messages (0 disables) in the
+    # same transaction. Writer remembers how many messages each addressee
+    # has instead of counting them every time: delivery only makes it too
+    # high (costing a trim that deletes nothing), messages stored by other
+    # workers are left to compaction.
+    # Callers never wait for the queue (they may be running event loop):
+    # when it's full items go to unbounded overflow, writer moves them to
+    # the queue in order as it empties.
+    def __init__(self, db: Storage, durability: str = ASYNC_DURABILITY,
+                 queue_size: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL, max_messages: int = 0):
+        self.db = db
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_messages = max_messages
+        self.counts = {}
+        self.queue = queue.Queue(queue_size)
+        # once overflow isn't empty everything goes there, so order is kept
+        self.overflow = collections.deque()
+        self.lock = threading.Lock()
+        QUEUE_DEPTH.set_function(lambda: self.queue.qsize() + len(self.overflow))
+
+        self.thread = threading.Thread(target=self._writing_thread,
+                                       name='offline-writer')
+        self.thread.start()
+
+    def store(self, body: str, addressee_id: int, on_stored=None) -> None:
+        # on_stored(success) is called from writer thread after commit
+        self._put((MESSAGE, body, (addressee_id,), on_stored))
+
+    def store_many(self, body: str, addressee_ids: list, on_stored=None) -> None:
+        # same message for many users (room post), one queue entry for all
+        self._put((MESSAGE, body, tuple(addressee_ids), on_stored))
+
+    def append_history(self, sender_id: int, addressee_id: int, room_id: int,
+                       body: str) -> None:
+        # either addressee_id or room_id is set
+        self._put((HISTORY, sender_id, addressee_id, room_id, body, time.time()))
+
+    def flush(self) -> None:
+        # blocks until everything stored so far is committed
+        done = threading.Event()
+        self.after_flush(done.set)
+        done.wait()
+
+    def after_flush(self, callback) -> None:
+        # callback() is called from writer thread once everything
+        # stored so far is committed
+        self._put(callback)
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self._put(None)
+            self.thread.join()
+
+    def _put(self, item) -> None:
+        with self.lock:
+            if not self.overflow:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+
+                except queue.Full:
+                    pass
+
+            self.overflow.append(item)
+        OVERFLOWED.inc()
+
+    def _refill(self) -> None:
+        # oldest items of overflow go to the queue while there's room
+        with self.lock:
+            while self.overflow:
+                try:
+                    self.queue.put_nowait(self.overflow[0])
+
+                except queue.Full:
+                    return
+
+                self.overflow.popleft()
+
+    def _writing_thread(self) -> None:
+        finish = False
+        while not finish:
+            # queue is never left empty while anything waits in overflow
+            self._refill()
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    timeout = deadline - time.monotonic()
+                    if timeout > 0:
+                        batch.append(self.queue.get(timeout=timeout))
+                    else:
+                        batch.append(self.queue.get_nowait())
+
+                except queue.Empty:
+                    break
+
+            finish = batch[-1] is None
+            self._write(batch)
+
+    def _over_quota(self, rows: list) -> list:
+        # addressees that will have more than max_messages after rows are in
+        if len(self.counts) > MAX_COUNTED:
+            self.counts.clear()
+
+        over = []
+        for addressee_id, added in collections.Counter(
+                addressee_id for _, addressee_id in rows).items():
+            count = self.counts.get(addressee_id)
+            if count is None:
+                count = self.db.count_messages(addressee_id)
+            count += added
+            if count > self.max_messages:
+                over.append(addressee_id)
+                count = self.max_messages
+            self.counts[addressee_id] = count
+
+        return over
+
+    def _store(self, rows: list, history: list, trim: list) -> int:
+        # the last attempt's error goes to the caller
+        delay = RETRY_DELAY
+        for _ in range(WRITE_RETRIES):
+            try:
+                return self.db.store_messages(rows, history, trim, self.max_messages)
+
+            except BusyError as e:
+                WRITE_RETRIES_TOTAL.inc()
+                logging.warning(f'Storage is busy, writing batch again in {delay:.2f}s. Error: {e}')
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+        return self.db.store_messages(rows, history, trim, self.max_messages)
+
+    def _write(self, batch: list) -> None:
+        messages = [item[1:] for item in batch
+                    if isinstance(item, tuple) and item[0] == MESSAGE]
+        history = [item[1:] for item in batch
+                   if isinstance(item, tuple) and item[0] == HISTORY]
+        success = True
+
+        try:
+            if messages or history:
+                rows = [(body, addressee_id) for body, addressee_ids, _ in messages
+                        for addressee_id in addressee_ids]
+                trim = ()
+                if rows:
+                    BATCH_MESSAGES.observe(len(rows))
+                    if self.max_messages:
+                        trim = self._over_quota(rows)
+                QUOTA_EXPIRED.inc(self._store(rows, history, trim))
+                HISTORY_ENTRIES.inc(len(history))
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Cannot store {len(messages)} offline messages. Error: {e}')
+            success = False
+
+        for item in batch:
+            if callable(item):
+                try:
+                    item()
+
+                except Exception as e:
+                    logging.error(f'Error in offline writer flush callback: {e}')
+
+        for _, _, on_stored in messages:
+            if on_stored:
+                try:
+                    on_stored(success)
+
+                except Exception as e:
+                    logging.error(f'Error in offline writer callback: {e}')
@@ -0,0 +1,145 @@
+import collections
+import threading
+import queue
+
+LIMIT_BYTES = 1024 * 1024
+
+# what happens with message from other user that doesn't fit into queue
+SPILL_POLICY = 'spill'  # store it as offline message, deliver later
+DROP_OLDEST_POLICY = 'drop-oldest'  # make room by dropping oldest messages
+DISCONNECT_POLICY = 'disconnect'  # store it and disconnect slow client
+POLICIES = (SPILL_POLICY, DROP_OLDEST_POLICY, DISCONNECT_POLICY)
+
+
+class OutboundQueue:
+    # Thread safe FIFO of Messages limited by total size of their bodies
+    # instead of their count. on_put is called (outside the lock) after every
+    # put, so event loop based consumers can be woken up. on_high_water(bytes)
+    # is called when queue grows above 3/4 of the limit (again only after it
+    # went down to half of it).
+    def __init__(self, limit_bytes: int = LIMIT_BYTES, on_put=None, on_high_water=None):
+        self.limit_bytes = limit_bytes
+        self.high_water = limit_bytes * 3 // 4
+        self.low_water = limit_bytes // 2
+        self.on_put = on_put
+        self.on_high_water = on_high_water
+
+        self.items = collections.deque()
+        self.bytes = 0
+        self.closed = False
+        self.above_high_water = False
+        self.cond = threading.Condition()
+
+    def qsize(self) -> int:
+        return len(self.items)
+
+    def full(self) -> bool:
+        return self.bytes >= self.limit_bytes
+
+    def fits(self, msg) -> bool:
+        # whether put(msg, block=False) would take it now
+        return not self.items or self.bytes + len(msg.get_body()) <= self.limit_bytes
+
+    def below_low_water(self) -> bool:
+        return self.bytes < self.low_water
+
+    def put(self, msg, block: bool = True, force: bool = False) -> bool:
+        # returns False when msg was not queued: queue is closed or there's
+        # no room and block is False. Final messages and force ignore the limit.
+        size = len(msg.get_body())
+        with self.cond:
+            if not (force or msg.is_final()):
+                while not self.closed and self.items and self.bytes + size > self.limit_bytes:
+                    if not block:
+                        return False
+                    self.cond.wait()
+
+            if self.closed:
+                return False
+
+            crossed = self._append(msg, size)
+
+        self._notify(crossed)
+        return True
+
+    def put_drop_oldest(self, msg) -> int:
+        # returns number of dropped messages
+        size = len(msg.get_body())
+        dropped = 0
+        with self.cond:
+            if self.closed:
+                return 0
+
+            while self.items and self.bytes + size > self.limit_bytes:
+                if self.items[0].is_final():
+                    break
+                old = self.items.popleft()
+                self.bytes -= len(old.get_body())
+                dropped += 1
+
+            crossed = self._append(msg, size)
+
+        self._notify(crossed)
+        return dropped
+
+    def _append(self, msg, size: int) -> bool:
+        # returns whether queue has just crossed high-water mark
+        self.items.append(msg)
+        self.bytes += size
+        self.cond.notify_all()
+
+        if not self.above_high_water and self.bytes >= self.high_water:
+            self.above_high_water = True
+            return True
+        return False
+
+    def _notify(self, crossed: bool) -> None:
+        if crossed and self.on_high_water:
+            self.on_high_water(self.bytes)
+        if self.on_put:
+            self.on_put()
+
+    def get(self, timeout: float = None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items, timeout):
+                raise queue.Empty
+            return self._pop()
+
+    def get_nowait(self):
+        with self.cond:
+            if not self.items:
+                raise queue.Empty
+            return self._pop()
+
+    def _pop(self):
+        msg = self.items.popleft()
+        self.bytes -= len(msg.get_body())
+        self.cond.notify_all()
+
+        if self.above_high_water and self.bytes <= self.low_water:
+            self.above_high_water = False
+        return msg
+
+    def close(self) -> None:
+        # wakes up blocked producers, all further puts are rejected
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def drain(self, tail: tuple = ()) -> list:
+        # closes the queue and returns everything that waited in it,
+        # consumer gets only tail (e.g. goodbye and final message) instead
+        with self.cond:
+            items = list(self.items)
+            self.items.clear()
+            self.bytes = 0
+            self.above_high_water = False
+            self.closed = True
+
+            for msg in tail:
+                self.items.append(msg)
+                self.bytes += len(msg.get_body())
+            self.cond.notify_all()
+
+        self._notify(False)
+        return items
@@ -0,0 +1,264 @@
+import threading
+import time
+import logging
+import traceback
+
+import metrics
+from graph import SocialGraph
+from outbound import SPILL_POLICY
+
+# events are collected for this long and sent to each watcher as one message
+BATCH_INTERVAL = 0.05
+# sessions of one user on one process, the oldest is replaced by a new one
+MAX_SESSIONS = 8
+ONLINE = 'ONLINE'
+OFFLINE = 'OFFLINE'
+
+EVENTS = metrics.REGISTRY.counter(
+    'chat_presence_events_total', 'Presence changes sent to watching friends')
+BATCHES = metrics.REGISTRY.counter(
+    'chat_presence_batches_total', 'Messages carrying presence changes')
+
+
+class Spill:
+    # Messages of user that didn't fit into his sessions' queues, stored
+    # once in offline table for all of them. Sessions move them back to all
+    # queues page by page (only one at a time), spill is over when table
+    # is empty and nothing was stored meanwhile.
+    __slots__ = ('stored', 'busy')
+
+    def __init__(self):
+        self.stored = 0
+        self.busy = False
+
+
+class Presence:
+    # Registry of users connected to this process (username -> tuple of
+    # Clients, one per session, oldest first) and to other workers
+    # (username -> tuple of worker ids). Tuples are replaced, never changed,
+    # so lookups don't need the lock and one-session users cost no more
+    # than before. Users who have someone in their friends list watch him,
+    # when he goes online (first session anywhere) or offline (last one
+    # gone) they get an event, only if they are online themselves. Events
+    # for one watcher are coalesced and sent together every BATCH_INTERVAL
+    # seconds to all his sessions.
+    def __init__(self, graph: SocialGraph, batch_interval: float = BATCH_INTERVAL,
+                 max_sessions: int = MAX_SESSIONS):
+        self.graph = graph
+        self.batch_interval = batch_interval
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.local = {}
+        self.remote = {}
+        # username -> Spill, users whose messages wait in offline table
+        self.spills = {}
+        self.session_count = 0
+        # on_change(username, online) is called when user connects to or
+        # leaves this process, so other processes can be told
+        self.on_change = None
+
+        # watcher username -> {friend username: state}, latest state wins
+        self.pending = {}
+        self.pending_cond = threading.Condition(self.lock)
+        self.closed = False
+        self.thread = threading.Thread(target=self._flushing_thread,
+                                       name='presence', daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            self.pending_cond.notify()
+        self.thread.join()
+
+    def deliver(self, username: str, msg_body: str, msg=None):
+        # message from other user to all his sessions on this process,
+        # encoded once (fan-out to many users passes msg on); closed
+        # sessions are skipped while some other one is live. Returns the
+        # message, None when user has no session here
+        sessions = self.local.get(username)
+        if not sessions:
+            return None
+
+        live = [client for client in sessions if not client.msg_queue.closed]
+        if not live or live[0].OVERFLOW_POLICY != SPILL_POLICY:
+            for client in live or sessions[:1]:
+                msg = client.deliver(msg_body, msg)
+            return msg
+
+        # every session gets the message or none does, then it's stored
+        # once; later ones follow it while the spill lasts, so order is kept
+        if msg is None:
+            msg = live[0].chat_message(msg_body)
+        if username not in self.spills and all(client.msg_queue.fits(msg) for client in live):
+            for client in live:
+                client.msg_queue.put(msg, force=True)
+            return msg
+
+        with self.lock:
+            spill = self.spills.get(username)
+            if spill is None:
+                spill = self.spills[username] = Spill()
+            spill.stored += 1
+            live[0].spill(msg_body)
+        return msg
+
+    def live_sessions(self, username: str) -> list:
+        return [client for client in self.local.get(username, ())
+                if not client.msg_queue.closed]
+
+    def is_spilled(self, username: str) -> bool:
+        return username in self.spills
+
+    def begin_unspill(self, username: str):
+        # returns how many messages were spilled so far, None when user
+        # has no spill or some other session is moving it
+        with self.lock:
+            spill = self.spills.get(username)
+            if spill is None or spill.busy:
+                return None
+            spill.busy = True
+            return spill.stored
+
+    def end_unspill(self, username: str, stored: int, empty: bool) -> bool:
+        # empty means offline table had nothing left after everything
+        # stored before begin_unspill was flushed; returns True when
+        # spill is over
+        with self.lock:
+            spill = self.spills.get(username)
+            if spill is None:
+                return True
+            spill.busy = False
+            if empty and spill.stored == stored:
+                del self.spills[username]
+                return True
+            return False
+
+    def usernames(self) -> list:
+        with self.lock:
+            return list(self.local)
+
+    def clients(self) -> list:
+        # sessions of all users
+        with self.lock:
+            return [client for sessions in self.local.values() for client in sessions]
+
+    def count(self) -> int:
+        return len(self.local)
+
+    def is_online(self, username: str) -> bool:
+        return username in self.local or username in self.remote
+
+    def remote_workers(self, username: str) -> tuple:
+        # workers user has sessions on, empty when none
+        return self.remote.get(username, ())
+
+    def add(self, client) -> tuple:
+        # returns whether it's user's only live session on this process
+        # (others replaced included) and sessions it replaced: ones already
+        # closed are just forgotten, the oldest above max_sessions are
+        # returned, so caller disconnects them
+        username = client.username
+        with self.lock:
+            was_online = self.is_online(username)
+            sessions = self.local.get(username, ())
+            live = tuple(session for session in sessions if not session.msg_queue.closed)
+            replaced = []
+            if self.max_sessions and len(live) >= self.max_sessions:
+                replaced = list(live[:len(live) - self.max_sessions + 1])
+                live = live[len(replaced):]
+            first = not live
+            self.local[username] = live + (client,)
+            self.session_count += len(live) + 1 - len(sessions)
+            if not was_online:
+                self._changed(username, ONLINE)
+
+        if not sessions and self.on_change:
+            self.on_change(username, True)
+        return first, replaced
+
+    def remove(self, client) -> bool:
+        # returns False when client was already removed (or replaced
+        # by newer session of the same user)
+        username = client.username
+        with self.lock:
+            sessions = self.local.get(username, ())
+            if client not in sessions:
+                return False
+            sessions = tuple(session for session in sessions if session is not client)
+            self.session_count -= 1
+            if sessions:
+                self.local[username] = sessions
+            else:
+                del self.local[username]
+                # what's left is the backlog of the next login
+                self.spills.pop(username, None)
+                if not self.is_online(username):
+                    self._changed(username, OFFLINE)
+
+        if not sessions and self.on_change:
+            self.on_change(username, False)
+        return True
+
+    def set_remote(self, username: str, worker_id: int, online: bool) -> None:
+        with self.lock:
+            was_online = self.is_online(username)
+            workers = self.remote.get(username, ())
+            if online == (worker_id in workers):
+                return
+
+            if online:
+                self.remote[username] = workers + (worker_id,)
+            elif len(workers) > 1:
+                self.remote[username] = tuple(w for w in workers if w != worker_id)
+            else:
+                del self.remote[username]
+
+            if was_online != self.is_online(username):
+                self._changed(username, ONLINE if online else OFFLINE)
+
+    # called with lock held
+    def _changed(self, username: str, state: str) -> None:
+        user_id = self.graph.user_id(username)
+        if user_id is None:
+            return
+
+        for watcher in self.graph.get_watchers(user_id):
+            if watcher in self.local:
+                self.pending.setdefault(watcher, {})[username] = state
+
+        if self.pending:
+            self.pending_cond.notify()
+
+    def _flushing_thread(self) -> None:
+        while True:
+            with self.lock:
+                self.pending_cond.wait_for(lambda: self.pending or self.closed)
+                if self.closed:
+                    return
+
+            # let more changes gather, e.g. when many users connect at once
+            time.sleep(self.batch_interval)
+
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                batch = [(watcher, self.local.get(watcher), changes)
+                         for watcher, changes in pending.items()]
+
+            for watcher, sessions, changes in batch:
+                if sessions:
+                    self._send(watcher, sessions, changes)
+
+    def _send(self, watcher: str, sessions: tuple, changes: dict) -> None:
+        try:
+            # encoded by the first session, the rest share it
+            msg = '\n'.join(
+                f'Friend {username} is now {state}' for username, state in changes.items())
+            for client in sessions:
+                msg = client.send_msg_nowait(msg)
+            EVENTS.inc(len(changes))
+            BATCHES.inc()
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(f'Cannot send presence changes to {watcher}. Error: {e}')
@@ -0,0 +1,130 @@
+import threading
+import time
+
+import metrics
+
+# buckets hold this many seconds worth of tokens, so short bursts pass
+BURST_SECONDS = 2.0
+# idle buckets are dropped when there's more of them than this
+MAX_IDLE_BUCKETS = 10000
+
+THROTTLED = metrics.REGISTRY.counter(
+    'chat_throttled_total', 'Commands refused and reads delayed by rate limits', ('limit',))
+THROTTLED_SECONDS = metrics.REGISTRY.counter(
+    'chat_throttled_seconds_total', 'Time reading from clients was paused by rate limits')
+
+
+class TokenBucket:
+    # Refilled with rate tokens per second up to burst. Buckets are shared by
+    # connections of one user or address and updated without lock: racing
+    # threads may lose an update now and then, which only lets a few more
+    # tokens through, while commands don't pay for the lock.
+    __slots__ = ('limiter', 'rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, limiter: 'RateLimiter'):
+        self.limiter = limiter
+        self.rate = limiter.rate
+        self.burst = limiter.burst
+        self.tokens = limiter.burst
+        self.updated = time.monotonic()
+
+    def take(self, amount: float = 1.0) -> bool:
+        # False when there's not enough tokens, nothing is taken then
+        now = time.monotonic()
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.updated = now
+
+        if tokens < amount:
+            self.tokens = tokens
+            return False
+
+        self.tokens = tokens - amount
+        return True
+
+    def borrow(self, amount: float) -> float:
+        # always takes amount (bucket may go below zero, e.g. when data has
+        # already been received), returns seconds until it's paid back
+        now = time.monotonic()
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+        self.updated = now
+        self.tokens = tokens
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+    def idle(self, now: float) -> bool:
+        # full bucket is no different from a new one
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    # One limit (e.g. commands of a user) with a bucket per key (username
+    # or address), so all connections of the key share it.
+    def __init__(self, name: str, rate: float, burst: float = None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst if burst else rate * BURST_SECONDS
+        self.throttled = THROTTLED.labels(name)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.prune_at = MAX_IDLE_BUCKETS
+
+    def bucket(self, key: str) -> TokenBucket:
+        # None when limit is disabled
+        if not self.rate:
+            return None
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.prune_at:
+                    self._prune()
+                bucket = self.buckets[key] = TokenBucket(self)
+            return bucket
+
+    # called with lock held
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, bucket in self.buckets.items() if bucket.idle(now)]:
+            del self.buckets[key]
+        # busy buckets stay, next pruning waits until there's as many new ones
+        self.prune_at = len(self.buckets) + MAX_IDLE_BUCKETS
+
+
+class Throttle:
+    # Limits applied to one connection: buckets of its address from
+    # the start, buckets of its user added at login.
+    __slots__ = ('commands', 'bytes')
+
+    def __init__(self, commands: tuple = (), bytes: tuple = ()):
+        self.commands = tuple(bucket for bucket in commands if bucket)
+        self.bytes = tuple(bucket for bucket in bytes if bucket)
+
+    def extend(self, commands: tuple = (), bytes: tuple = ()) -> None:
+        self.commands += tuple(bucket for bucket in commands if bucket)
+        self.bytes += tuple(bucket for bucket in bytes if bucket)
+
+    def allow_command(self) -> bool:
+        for i, bucket in enumerate(self.commands):
+            if not bucket.take():
+                # command is refused, buckets checked before get
+                # their token back
+                for taken in self.commands[:i]:
+                    taken.tokens += 1
+                bucket.limiter.throttled.inc()
+                return False
+
+        return True
+
+    def read_delay(self, size: int) -> float:
+        # seconds to wait before reading more from the connection
+        delay = 0.0
+        for bucket in self.bytes:
+            wait = bucket.borrow(size)
+            if wait:
+                bucket.limiter.throttled.inc()
+                delay = max(delay, wait)
+
+        if delay:
+            THROTTLED_SECONDS.inc(delay)
+        return delay
@@ -0,0 +1,114 @@
+import threading
+import logging
+
+from storage import Storage, DuplicateError
+
+
+class RoomExistsError(Exception):
+    pass
+
+
+class Rooms:
+    # Process wide cache of chat rooms and their members, kept the same
+    # way as SocialGraph: database first, then memory under the lock.
+    # Posting only reads member sets, so it never takes the lock.
+    def __init__(self, db: Storage):
+        self.db = db
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.names = {}
+        # room_id -> set of member user ids
+        self.members = {}
+        # on_change(room_id, user_id, joined) is called after every
+        # membership change, so other processes can update their copies
+        self.on_change = None
+
+    def load(self) -> None:
+        with self.lock:
+            for room_id, name in self.db.get_rooms():
+                self.ids[name] = room_id
+                self.names[room_id] = name
+                self.members[room_id] = set()
+
+            for room_id, user_id in self.db.get_room_members():
+                self.members.setdefault(room_id, set()).add(user_id)
+
+        logging.info(f'Loaded {len(self.ids)} rooms...')
+
+    def room_id(self, name: str) -> int:
+        room_id = self.ids.get(name)
+        if room_id is None:
+            # room might have been created by other worker
+            room_id = self.db.get_room_id(name)
+            if room_id is not None:
+                with self.lock:
+                    self.ids[name] = room_id
+                    self.names[room_id] = name
+                    self.members.setdefault(room_id, set())
+
+        return room_id
+
+    def create(self, name: str, owner_id: int) -> int:
+        with self.lock:
+            try:
+                room_id = self.db.add_room(name, owner_id)
+
+            except DuplicateError:
+                raise RoomExistsError(f'Room {name} already exists')
+
+            self.ids[name] = room_id
+            self.names[room_id] = name
+            self.members[room_id] = {owner_id}
+
+        if self.on_change:
+            self.on_change(room_id, owner_id, True)
+        return room_id
+
+    def name(self, room_id: int) -> str:
+        name = self.names.get(room_id)
+        if name is None:
+            name = self.db.get_room_name(room_id)
+            if name is not None:
+                with self.lock:
+                    self.ids[name] = room_id
+                    self.names[room_id] = name
+
+        return name
+
+    def is_member(self, room_id: int, user_id: int) -> bool:
+        return user_id in self.members.get(room_id, ())
+
+    def join(self, room_id: int, user_id: int) -> None:
+        with self.lock:
+            self.db.add_room_member(room_id, user_id)
+            self.members.setdefault(room_id, set()).add(user_id)
+
+        if self.on_change:
+            self.on_change(room_id, user_id, True)
+
+    def leave(self, room_id: int, user_id: int) -> None:
+        with self.lock:
+            self.db.delete_room_member(room_id, user_id)
+            self.members.get(room_id, set()).discard(user_id)
+
+        if self.on_change:
+            self.on_change(room_id, user_id, False)
+
+    # updates memory only, change is already in the database
+    def apply_membership(self, room_id: int, user_id: int, joined: bool) -> None:
+        with self.lock:
+            if room_id not in self.names:
+                name = self.db.get_room_name(room_id)
+                if name is None:
+                    return
+                self.ids[name] = room_id
+                self.names[room_id] = name
+
+            if joined:
+                self.members.setdefault(room_id, set()).add(user_id)
+            else:
+                self.members.get(room_id, set()).discard(user_id)
+
+    def get_members(self, room_id: int) -> list:
+        with self.lock:
+            return list(self.members.get(room_id, ()))
@@ -0,0 +1,294 @@
+import os
+import queue
+import socket
+import struct
+import threading
+import logging
+import traceback
+
+from graph import SocialGraph
+from rooms import Rooms
+from presence import Presence
+from offline_writer import OfflineWriter
+
+# Workers talk to each other with datagrams over unix domain sockets,
+# every datagram carries records 'KIND<TAB>sender<TAB>arg...' encoded in
+# utf-8, each preceded by its length, so nothing in message text can end
+# a record; message text is always the last field, tabs in it are kept
+HELLO = 'H'  # worker has started, peers announce their users to it
+PRESENCE = 'P'  # user went online/offline on sending worker
+DELIVER = 'D'  # message for user connected to receiving worker
+FRIENDSHIP = 'F'  # friendship added/deleted, peers update their graphs
+ROOM_POST = 'R'  # room post for comma separated users connected to receiving worker
+MEMBERSHIP = 'M'  # user joined/left room, peers update their rooms
+FLUSH = 'W'  # peer commits offline messages it has queued, then answers FLUSHED
+FLUSHED = 'w'
+USERS_SEPARATOR = ','
+SEPARATOR = '\t'
+RECORD_LENGTH = struct.Struct('!I')
+ENCODING = 'utf-8'
+RECV_SIZE = 256 * 1024
+# records queued for one peer are packed into datagrams of up to this size
+DATAGRAM_SIZE = 64 * 1024
+# kernel keeps only a few datagrams queued for receiver (net.unix.max_dgram_qlen),
+# sender waits for room in slices of this long, so it notices router was closed
+SEND_TIMEOUT = 1.0
+# seconds flush_peers waits for answers, peer that is gone is never waited
+# for longer
+FLUSH_TIMEOUT = 1.0
+
+
+def socket_path(socket_dir: str, worker_id: int) -> str:
+    return os.path.join(socket_dir, f'worker-{worker_id}.sock')
+
+
+class Router:
+    # Lets worker processes sharing one listening port find and reach users
+    # connected to other workers. Each worker keeps its own copy of
+    # remote presence (username -> worker ids) in Presence, updated by broadcasts.
+    # Datagrams are sent by separate thread from an unbounded outbox, so
+    # callers (event loop included) never wait for busy peer, and nothing
+    # is dropped when peer's receive queue is momentarily full.
+    def __init__(self, worker_id: int, workers: int, socket_dir: str, presence: Presence,
+                 graph: SocialGraph, rooms: Rooms, offline_writer: OfflineWriter):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.presence = presence
+        self.graph = graph
+        self.rooms = rooms
+        self.offline_writer = offline_writer
+        self.closed = False
+        # flush id -> [peers yet to answer, event set when all have]
+        self.lock = threading.Lock()
+        self.flushes = {}
+        self.flush_id = 0
+
+        self.path = socket_path(socket_dir, worker_id)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.outbox = queue.Queue()
+        self.thread = threading.Thread(target=self._receiving_thread,
+                                       name='router', daemon=True)
+        self.sender = threading.Thread(target=self._sending_thread,
+                                       name='router-sender', daemon=True)
+
+    def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock.bind(self.path)
+        self.sock.settimeout(SEND_TIMEOUT)
+        self.send_sock.settimeout(SEND_TIMEOUT)
+        self.thread.start()
+        self.sender.start()
+
+        self._broadcast(HELLO)
+        logging.info(f'Router of worker {self.worker_id} started...')
+
+    def close(self) -> None:
+        # messages still waiting in outbox are stored as offline ones
+        self.closed = True
+        self.outbox.put(None)
+        self.sender.join()
+        self.send_sock.close()
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def deliver(self, username: str, msg_body: str) -> bool:
+        # to every other worker user has sessions on, returns False
+        # when there's none
+        workers = self.presence.remote_workers(username)
+        for worker_id in workers:
+            self._send(worker_id, DELIVER, username, msg_body)
+        return bool(workers)
+
+    def post(self, worker_id: int, usernames: list, msg_body: str) -> None:
+        # one record for all room members connected to the same worker
+        self._send(worker_id, ROOM_POST, USERS_SEPARATOR.join(usernames), msg_body)
+
+    def flush_peers(self, timeout: float = FLUSH_TIMEOUT) -> bool:
+        # blocks until offline messages other workers have queued so far are
+        # committed, so user who has just logged in here gets them with his
+        # backlog. Returns False when some peer didn't answer in time
+        with self.lock:
+            self.flush_id += 1
+            flush_id = self.flush_id
+            waiting = self.flushes[flush_id] = [self.workers - 1, threading.Event()]
+
+        self._broadcast(FLUSH, str(flush_id))
+        try:
+            return waiting[1].wait(timeout)
+
+        finally:
+            with self.lock:
+                del self.flushes[flush_id]
+
+    def _flushed(self, flush_id: int) -> None:
+        with self.lock:
+            waiting = self.flushes.get(flush_id)
+            if waiting:
+                waiting[0] -= 1
+                if waiting[0] <= 0:
+                    waiting[1].set()
+
+    def announce(self, username: str, online: bool) -> None:
+        self._broadcast(PRESENCE, username, '1' if online else '0')
+
+    def broadcast_friendship(self, user_id: int, friend_id: int, added: bool) -> None:
+        self._broadcast(FRIENDSHIP, str(user_id), str(friend_id), '1' if added else '0')
+
+    def broadcast_membership(self, room_id: int, user_id: int, joined: bool) -> None:
+        self._broadcast(MEMBERSHIP, str(room_id), str(user_id), '1' if joined else '0')
+
+    def _broadcast(self, kind: str, *args) -> None:
+        for worker_id in range(self.workers):
+            if worker_id != self.worker_id:
+                self._send(worker_id, kind, *args)
+
+    def _send(self, worker_id: int, kind: str, *args) -> None:
+        self.outbox.put((worker_id, kind, args))
+
+    def _sending_thread(self) -> None:
+        finish = False
+        while not finish:
+            # everything waiting in outbox goes out at once, one datagram
+            # per peer instead of one per record
+            items = [self.outbox.get()]
+            while True:
+                try:
+                    items.append(self.outbox.get_nowait())
+
+                except queue.Empty:
+                    break
+
+            finish = None in items
+            peers = {}
+            for item in items:
+                if item is not None:
+                    worker_id, kind, args = item
+                    peers.setdefault(worker_id, []).append((kind, args))
+
+            for worker_id, records in peers.items():
+                try:
+                    self._send_records(worker_id, records)
+
+                except Exception as e:
+                    traceback.print_exc()
+                    logging.error(
+                        f'Error in router sender of worker {self.worker_id}. Error: {e}')
+
+    def _send_records(self, worker_id: int, records: list) -> None:
+        datagram = []
+        size = 0
+        first = 0  # index of the first record in datagram
+        for i, (kind, args) in enumerate(records):
+            record = SEPARATOR.join((kind, str(self.worker_id)) + args).encode(ENCODING)
+            datagram.append(RECORD_LENGTH.pack(len(record)))
+            datagram.append(record)
+            size += RECORD_LENGTH.size + len(record)
+
+            if size >= DATAGRAM_SIZE or i == len(records) - 1:
+                if self.closed or not self._sendto(worker_id, b''.join(datagram)):
+                    # messages for users of unreachable peer are kept for later
+                    for kind, args in records[first:i + 1]:
+                        if kind == DELIVER:
+                            self._store_offline([args[0]], args[1])
+                        elif kind == ROOM_POST:
+                            self._store_offline(args[0].split(USERS_SEPARATOR), args[1])
+                datagram = []
+                size = 0
+                first = i + 1
+
+    def _sendto(self, worker_id: int, datagram: bytes) -> bool:
+        path = socket_path(self.socket_dir, worker_id)
+        while True:
+            try:
+                self.send_sock.sendto(datagram, path)
+                return True
+
+            except socket.timeout:
+                # peer's queue is full, it is busy but alive
+                if self.closed:
+                    return False
+
+            except OSError as e:
+                # peer not started yet or already gone, it will say HELLO when it's up
+                logging.debug(f'Cannot reach worker {worker_id}. Error: {e}')
+                return False
+
+    def _store_offline(self, usernames: list, msg_body: str) -> None:
+        user_ids = [user_id for user_id in map(self.graph.user_id, usernames)
+                    if user_id is not None]
+        if user_ids:
+            self.offline_writer.store_many(msg_body, user_ids)
+
+    def _receiving_thread(self) -> None:
+        while True:
+            try:
+                datagram = self.sock.recv(RECV_SIZE)
+
+            except socket.timeout:
+                continue
+
+            except OSError:
+                # socket closed
+                return
+
+            offset = 0
+            while offset < len(datagram):
+                size, = RECORD_LENGTH.unpack_from(datagram, offset)
+                offset += RECORD_LENGTH.size + size
+                try:
+                    self._handle(datagram[offset - size:offset].decode(ENCODING))
+
+                except Exception as e:
+                    traceback.print_exc()
+                    logging.error(f'Error in router of worker {self.worker_id}. Error: {e}')
+
+    def _handle(self, record: str) -> None:
+        kind, sender, rest = (record.split(SEPARATOR, 2) + [''])[:3]
+        sender = int(sender)
+
+        if kind == DELIVER:
+            username, msg_body = rest.split(SEPARATOR, 1)
+            if self.presence.deliver(username, msg_body) is None:
+                # user has just left, keep message for later
+                self._store_offline([username], msg_body)
+
+        elif kind == ROOM_POST:
+            usernames, msg_body = rest.split(SEPARATOR, 1)
+            # message is encoded once and shared by members' queues
+            msg = None
+            left = []
+            for username in usernames.split(USERS_SEPARATOR):
+                delivered = self.presence.deliver(username, msg_body, msg)
+                if delivered is None:
+                    left.append(username)
+                else:
+                    msg = delivered
+            if left:
+                self._store_offline(left, msg_body)
+
+        elif kind == PRESENCE:
+            username, online = rest.split(SEPARATOR)
+            self.presence.set_remote(username, sender, online == '1')
+
+        elif kind == FRIENDSHIP:
+            user_id, friend_id, added = rest.split(SEPARATOR)
+            self.graph.apply_friendship(int(user_id), int(friend_id), added == '1')
+
+        elif kind == MEMBERSHIP:
+            room_id, user_id, joined = rest.split(SEPARATOR)
+            self.rooms.apply_membership(int(room_id), int(user_id), joined == '1')
+
+        elif kind == FLUSH:
+            # answered from writer thread after commit, router keeps receiving
+            self.offline_writer.after_flush(lambda: self._send(sender, FLUSHED, rest))
+
+        elif kind == FLUSHED:
+            self._flushed(int(rest))
+
+        elif kind == HELLO:
+            for username in self.presence.usernames():
+                self._send(sender, PRESENCE, username, '1')
@@ -1,101 +1,537 @@
-import sqlite3
 import socket
 import queue
-import re
+import asyncio
+import argparse
 import os
+import sys
+import signal
+import select
+import subprocess
+import functools
 import threading
+import time
+import tempfile
+import shutil
+import multiprocessing
+import concurrent.futures
 import logging
 import traceback
 
+import metrics
+from storage import Storage, DuplicateError, STORAGES, SQLITE_STORAGE, MEMORY_STORAGE
+from database import Database
+from memory_storage import MemoryStorage
+from graph import SocialGraph
+from rooms import Rooms, RoomExistsError
+from framing import LineFramer, negotiate, MAX_FRAME_SIZE, USER_ID, REPLY, CHAT, USER, \
+    PING, COMPRESS_THRESHOLD as FRAME_COMPRESS_THRESHOLD
+from commands import CommandRegistry, optional, NAME, FRIEND, ROOM, TARGET, NUMBER, \
+    PASSWORD, TEXT, ADDRESS, ROOM_ADDRESS
+from outbound import OutboundQueue, LIMIT_BYTES as OUTBOUND_LIMIT, POLICIES, \
+    SPILL_POLICY, DROP_OLDEST_POLICY, DISCONNECT_POLICY
+from offline_writer import OfflineWriter, ASYNC_DURABILITY, SYNC_DURABILITY
+from compaction import Compactor
+from ratelimit import RateLimiter, Throttle
+from router import Router
+from presence import Presence, MAX_SESSIONS as SESSIONS_LIMIT
+from auth import Authenticator, AuthBusyError, POOL_SIZE as AUTH_POOL_SIZE, \
+    MAX_CONCURRENT as MAX_LOGINS
+
 DB_PATH = os.path.dirname(os.path.abspath(__file__)) + '/users.db'
-BUFF_SIZE = 1024
-QUEUE_SIZE = 1000
+STORAGE = SQLITE_STORAGE
+# append-only log kept by memory storage, None keeps nothing on disk
+SNAPSHOT_PATH = None
+BUFF_SIZE = 64 * 1024
 ENCODING = 'utf-8'
+# buffers one sendmsg takes, more fail with EMSGSIZE
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
 
 DB_ERROR = 1
 SOCKET_ERROR = 2
 KEYBOARD_ERROR = 3
 
+THREADS_MODE = 'threads'
+ASYNCIO_MODE = 'asyncio'
+
+# hot restart: successor finds inherited listening socket and the pipe
+# to report it's accepting connections in these environment variables
+LISTEN_FD_ENV = 'CHAT_LISTEN_FD'
+READY_FD_ENV = 'CHAT_READY_FD'
+RESTART_SIGNAL = getattr(signal, 'SIGUSR2', None)
+# seconds successor has to start before it's killed and restart is given up
+RESTART_TIMEOUT = 30.0
+
+COMMAND_SECONDS = metrics.REGISTRY.histogram(
+    'chat_command_seconds', 'Time spent handling client commands', ('command',))
+CONNECTIONS = metrics.REGISTRY.counter(
+    'chat_connections_total', 'Accepted connections')
+RECEIVED_BYTES = metrics.REGISTRY.counter(
+    'chat_received_bytes_total', 'Bytes received from clients')
+SENT_BYTES = metrics.REGISTRY.counter(
+    'chat_sent_bytes_total', 'Bytes sent to clients')
+SENT_MESSAGES = metrics.REGISTRY.counter(
+    'chat_sent_messages_total', 'Messages written to client sockets')
+SEND_BATCHES = metrics.REGISTRY.counter(
+    'chat_send_batches_total', 'Socket writes carrying messages')
+ROUTES = metrics.REGISTRY.counter(
+    'chat_routed_messages_total', 'Chat messages by the way they reached addressee', ('route',))
+LOCAL_ROUTE = ROUTES.labels('local')
+WORKER_ROUTE = ROUTES.labels('worker')
+OFFLINE_ROUTE = ROUTES.labels('offline')
+ROOM_POSTS = metrics.REGISTRY.counter(
+    'chat_room_posts_total', 'Messages posted to rooms')
+ROOM_FANOUT = metrics.REGISTRY.histogram(
+    'chat_room_fanout_members', 'Members a room post was delivered or stored for',
+    buckets=metrics.SIZE_BUCKETS)
+OVERFLOWS = metrics.REGISTRY.counter(
+    'chat_outbound_overflows_total', 'Messages that did not fit into outbound queue', ('policy',))
+HIGH_WATER_HITS = metrics.REGISTRY.counter(
+    'chat_outbound_high_water_total', 'Times outbound queue filled up to its high-water mark')
+ONLINE_USERS = metrics.REGISTRY.gauge(
+    'chat_online_users', 'Users connected to this process')
+ONLINE_SESSIONS = metrics.REGISTRY.gauge(
+    'chat_online_sessions', 'Logged in connections to this process, users may have several')
+QUEUED_MESSAGES = metrics.REGISTRY.gauge(
+    'chat_outbound_queued_messages', 'Messages waiting in all outbound queues')
+QUEUED_BYTES = metrics.REGISTRY.gauge(
+    'chat_outbound_queued_bytes', 'Bytes waiting in all outbound queues')
+MAX_QUEUED_BYTES = metrics.REGISTRY.gauge(
+    'chat_outbound_max_queued_bytes', 'Bytes waiting in the longest outbound queue')
+REAPED = metrics.REGISTRY.counter(
+    'chat_reaped_connections_total', 'Connections closed by server for inactivity', ('reason',))
+IDLE_REAPED = REAPED.labels('idle')
+HANDSHAKE_REAPED = REAPED.labels('handshake')
+REJECTED = metrics.REGISTRY.counter(
+    'chat_rejected_connections_total', 'Connections closed right after accept', ('reason',))
+FULL_REJECTED = REJECTED.labels('full')
+THROTTLED_REJECTED = REJECTED.labels('throttled')
+DRAINED_MESSAGES = metrics.REGISTRY.counter(
+    'chat_drained_messages_total', 'Queued messages saved as offline ones on shutdown')
+REPLACED_SESSIONS = metrics.REGISTRY.counter(
+    'chat_replaced_sessions_total', 'Oldest sessions closed when user opened too many')
+
 
 class Message:
+    # Immutable once created, so one Message (and its encoded body) can sit
+    # in many queues at once: room posts and static replies are encoded once.
+    # Binary frame is made by the first binary client's sender and kept
+    # for the others.
+    # Slots keep thousands of queued messages per busy user small.
+    __slots__ = ('msg_body', 'final_msg', 'frame')
+    OPCODE = REPLY
+
     def __init__(self, msg_body: str, final_msg: bool = False):
         self.msg_body = (msg_body + '\n').encode(ENCODING)
         self.final_msg = final_msg
+        self.frame = None
 
     def get_body(self):
         return self.msg_body
 
+    # what binary frame carries after the opcode
+    def payload(self) -> bytes:
+        return self.msg_body[:-1]
+
     def is_final(self):
         return self.final_msg
 
 
+class ChatMessage(Message):
+    # Message from other user, unlike replies it's saved when server
+    # shuts down before it was sent
+    __slots__ = ()
+    OPCODE = CHAT
+
+
+class PingMessage(Message):
+    __slots__ = ()
+    OPCODE = PING
+
+
+class UserMessage(Message):
+    # username and id of a user, binary clients address users by id
+    __slots__ = ('user_id', 'username')
+    OPCODE = USER
+
+    def __init__(self, user_id: int, username: str):
+        super().__init__(f'User {username} has id {user_id}.')
+        self.user_id = user_id
+        self.username = username
+
+    def payload(self) -> bytes:
+        return USER_ID.pack(self.user_id) + self.username.encode(ENCODING)
+
+
+# tells sender to finish, carries nothing
+FINAL_MSG = Message('', True)
+
+
+def send_buffers(sock: socket.socket, buffers: list) -> None:
+    # one scatter-gather syscall for whole batch (or every IOV_MAX
+    # buffers of it), repeated only when kernel accepted just a part of it
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        while sent:
+            size = len(buffers[0])
+            if sent >= size:
+                sent -= size
+                del buffers[0]
+            else:
+                buffers[0] = memoryview(buffers[0])[sent:]
+                sent = 0
+
+
 class Client:
     HELP_MSG = ("Avaiable commands:\n"
                 "* 'USERNAME: text' - to send message,\n"
                 "* 'ADD username' - to add user to friends list,\n"
                 "* 'DELETE username' - to remove user from friends list,\n"
                 "* 'STATUS' - to show online users,\n"
+                "* 'CREATE #room' - to create room and join it,\n"
+                "* 'JOIN #room' - to join room,\n"
+                "* 'LEAVE #room' - to leave room,\n"
+                "* '#room: text' - to post message to room,\n"
+                "* 'HISTORY username|#room [before_id] [limit]' - to show older messages,\n"
+                "* 'SEARCH [before_id] text' - to search your messages,\n"
+                "* 'WHOIS username' - to show user's id,\n"
+                "* 'PING' - to check connection (server replies 'PONG'),\n"
                 "* 'HELP' - to show avaiable commands,\n"
                 "* 'EXIT' - to exit from the server.\n")
-
-    SEND_REGEX = re.compile(r'(\w+):\s+(.*)', re.DOTALL)
-    ADD_FRIEND_REGEX = re.compile(r'ADD\s+(\w+)\s*')
-    DELETE_FRIEND_REGEX = re.compile(r'DELETE\s+(\w+)\s*')
-    STATUS_REGEX = re.compile(r'STATUS\s*')
-    HELP_REGEX = re.compile(r'HELP\s*')
-    EXIT_REGEX = re.compile(r'EXIT\s*')
-
-    def __init__(self, online_dict: dict, client_sock: socket.socket, username: str):
-        self.online_dict = online_dict
+    HELP_REPLY = Message(HELP_MSG)
+
+    # command name (metrics label), first word, handler method, arguments
+    # and opcode in binary protocol
+    COMMANDS = CommandRegistry(COMMAND_SECONDS, unknown='_unknown_command')
+    COMMANDS.add('send', None, '_send_msg_to', ADDRESS, TEXT, opcode=0x01)
+    COMMANDS.add('post', None, '_post_to_room', ROOM_ADDRESS, TEXT, opcode=0x02)
+    COMMANDS.add('add', 'ADD', '_add_friend', FRIEND, opcode=0x03)
+    COMMANDS.add('delete', 'DELETE', '_delete_friend', FRIEND, opcode=0x04)
+    COMMANDS.add('status', 'STATUS', '_check_status', opcode=0x05)
+    COMMANDS.add('help', 'HELP', '_send_help', opcode=0x06)
+    COMMANDS.add('exit', 'EXIT', '_exit', opcode=0x07)
+    COMMANDS.add('create', 'CREATE', '_create_room', ROOM, opcode=0x08)
+    COMMANDS.add('join', 'JOIN', '_join_room', ROOM, opcode=0x09)
+    COMMANDS.add('leave', 'LEAVE', '_leave_room', ROOM, opcode=0x0a)
+    COMMANDS.add('history', 'HISTORY', '_send_history', TARGET, optional(NUMBER),
+                 optional(NUMBER), opcode=0x0b)
+    COMMANDS.add('search', 'SEARCH', '_search_history', optional(NUMBER), TEXT, opcode=0x0c)
+    COMMANDS.add('ping', 'PING', '_pong', opcode=0x0d)
+    COMMANDS.add('pong', 'PONG', '_heartbeat', opcode=0x0e)
+    COMMANDS.add('stats', 'STATS', '_send_stats', opcode=0x0f)
+    COMMANDS.add('whois', 'WHOIS', '_whois', NAME, opcode=0x10)
+
+    # static replies are encoded once
+    TOO_LONG_MSG = Message(f"Message too long! Limit is {MAX_FRAME_SIZE} bytes.")
+    UNKNOWN_MSG = Message("Unknown command. Type 'HELP' to show avaiable commands!")
+    EXIT_MSG = Message('Exiting from the server.\n')
+    PING_MSG = PingMessage('PING')
+    PONG_MSG = Message('PONG')
+    NO_MESSAGES_MSG = Message('No messages found.')
+    END_OF_HISTORY_MSG = Message('End of history.')
+    SHUTDOWN_MSG = Message('Server is shutting down. Log in later to get undelivered messages.')
+    RESTART_MSG = Message('Server is restarting. Log in again to get undelivered messages.')
+    THROTTLED_MSG = Message('Slow down! You are sending too fast, commands are being dropped.')
+    REPLACED_MSG = Message('You have logged in from too many places, closing the oldest session.')
+
+    # sender flushes everything waiting in the queue at once, up to these limits
+    SEND_BATCH_COUNT = 256
+    SEND_BATCH_BYTES = 64 * 1024
+    # how long (in seconds) sender waits for more messages before flushing
+    SEND_LINGER = 0
+    # offline messages are read, sent and deleted in pages of this size
+    BACKLOG_PAGE_SIZE = 500
+    # messages returned by HISTORY/SEARCH by default and at most, they are
+    # read and sent in pages of HISTORY_PAGE_SIZE
+    HISTORY_LIMIT = 50
+    MAX_HISTORY_LIMIT = 1000
+    HISTORY_PAGE_SIZE = 100
+    # newer than any message, when client doesn't give before_id
+    LAST_MESSAGE_ID = 2 ** 63 - 1
+    # limit of bytes waiting to be sent to client and what to do with
+    # messages from other users when client doesn't keep up
+    OUTBOUND_LIMIT_BYTES = OUTBOUND_LIMIT
+    OVERFLOW_POLICY = SPILL_POLICY
+    # users allowed to read server metrics with STATS
+    ADMINS = frozenset()
+
+    def __init__(self, presence: Presence, db: Storage, graph: SocialGraph, rooms: Rooms,
+                 offline_writer: OfflineWriter, router: Router, client_sock: socket.socket,
+                 username: str, framer=None, pending: list = None,
+                 throttle: Throttle = None):
+        self.presence = presence
+        self.db = db
+        self.graph = graph
+        self.rooms = rooms
+        self.offline_writer = offline_writer
+        # None unless server runs several worker processes
+        self.router = router
         self.client_sock = client_sock
         self.username = username
-        self.msg_queue = queue.Queue(QUEUE_SIZE)
-
-        self.load_msg()
-
-    def load_msg(self) -> None:
-        try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ SELECT body
-                        FROM messages
-                        WHERE addressee = (
-                            SELECT user_id FROM users WHERE username = (?)
-                        )
-                        ORDER BY message_id ASC; """,
-                    (self.username,)
-                )
-                query_result = cursor.fetchall()
-
-                for msg in query_result:
-                    msg_body, = msg
-                    self.msg_queue.put(Message(msg_body))
-
-                cursor.execute(
-                    """ DELETE FROM messages
-                        WHERE addressee = (
-                            SELECT user_id FROM users WHERE username = (?)
-                        ); """,
-                    (self.username,)
-                )
-                conn.commit()
+        self.user_id = graph.user_id(username)
+        # frames received during handshake are kept with the framer
+        # (LineFramer or BinaryFramer, as negotiated), so commands
+        # pipelined right after LOGIN are not lost
+        self.framer = framer if framer else LineFramer()
+        self.pending = pending if pending else []
+        # rate limits of user and address, refused commands are reported
+        # once until one gets through again
+        self.throttle = throttle
+        self.throttled = False
+        self.sent_msgs = 0
+        self.sent_batches = 0
+        self.dropped_msgs = 0
+        self.msg_queue = self._create_queue()
+        # monotonic time of the last data received from client and of
+        # the last heartbeat sent to it, read by server's reaper
+        self.last_seen = time.monotonic()
+        self.pinged_at = 0.0
+        # set when server shuts down, connection is then closed by sender
+        self.draining = False
+        # offline messages are streamed only by the first session of user,
+        # later ones would send them again
+        self.first_session = True
+
+    def _create_queue(self) -> OutboundQueue:
+        return OutboundQueue(self.OUTBOUND_LIMIT_BYTES,
+                             on_high_water=self._on_high_water)
+
+    def _on_high_water(self, queued_bytes: int) -> None:
+        HIGH_WATER_HITS.inc()
+        logging.warning(
+            f'{self.username} is a slow consumer, {queued_bytes} bytes are waiting '
+            f'(limit {self.OUTBOUND_LIMIT_BYTES}, policy {self.OVERFLOW_POLICY})...')
+
+    def _backlog_pages(self):
+        # yields encoded bodies for each page of offline messages, page is
+        # deleted only once caller asks for the next one, that is after
+        # it has been written to the socket
+        last_id = 0
+        while True:
+            last_id, buffers = self._backlog_page(last_id)
+            if not buffers:
+                return
+
+            yield buffers
+            self._backlog_page_sent(last_id, buffers)
+
+    def _backlog_page(self, last_id: int) -> tuple:
+        # returns (id of page's last message, encoded bodies) for the page
+        # after last_id, bodies are empty when there's no more
+        rows = self.db.get_messages(self.user_id, last_id, self.BACKLOG_PAGE_SIZE)
+        if not rows:
+            return last_id, []
+
+        if self.framer.BINARY:
+            buffers = [self.framer.pack(CHAT, body.encode(ENCODING)) for _, body in rows]
+        else:
+            buffers = [(body + '\n').encode(ENCODING) for _, body in rows]
+        return rows[-1][0], buffers
+
+    def _backlog_page_sent(self, last_id: int, buffers: list) -> None:
+        self.db.delete_messages(self.user_id, last_id)
+        self.sent_msgs += len(buffers)
+        self.sent_batches += 1
+        SENT_MESSAGES.inc(len(buffers))
+        SENT_BYTES.inc(sum(map(len, buffers)))
+
+    def _flush_writers(self) -> None:
+        # commits offline messages queued so far by this worker's writer,
+        # and by other workers' ones, they store messages for users logged in here too
+        self.offline_writer.flush()
+        if self.router is not None and not self.router.flush_peers():
+            logging.warning(f'Not every worker flushed offline messages for {self.username}...')
+
+    def _deliver_backlog(self) -> None:
+        try:
+            # messages sent just before we logged in may still wait for writers
+            self._flush_writers()
+
+            for buffers in self._backlog_pages():
+                send_buffers(self.client_sock, buffers)
+
+        except OSError:
+            raise
 
         except Exception as e:
             traceback.print_exc()
             logging.error(
-                f'Cannot put msg to queue in user {self.username}. Error: {e}')
+                f'Cannot deliver offline messages to {self.username}. Error: {e}')
+
+    # replies to client's own commands, waits for room in the queue;
+    # msg_body is text or Message encoded in advance
+    def send_msg(self, msg_body, final_msg: bool = False) -> None:
+        if not isinstance(msg_body, Message):
+            msg_body = Message(msg_body, final_msg)
+        self.msg_queue.put(msg_body)
+
+    # for callers that must never block on this client (e.g. background
+    # threads), returns encoded message so it can be sent to other sessions
+    def send_msg_nowait(self, msg_body) -> Message:
+        if not isinstance(msg_body, Message):
+            msg_body = Message(msg_body)
+        self.msg_queue.put(msg_body, force=True)
+        return msg_body
+
+    # messages from other users, never blocks the sender. Returns encoded
+    # message, so fan-out to many clients can pass it on and encode it once.
+    # Spill policy is applied by Presence to all sessions of user at once
+    def deliver(self, msg_body: str, msg: Message = None) -> Message:
+        if msg is None:
+            msg = ChatMessage(msg_body)
+        if self.msg_queue.put(msg, block=False):
+            return msg
+
+        OVERFLOWS.labels(self.OVERFLOW_POLICY).inc()
+        if self.msg_queue.closed or self.OVERFLOW_POLICY == SPILL_POLICY:
+            self.offline_writer.store(msg_body, self.user_id)
+
+        elif self.OVERFLOW_POLICY == DROP_OLDEST_POLICY:
+            self.dropped_msgs += self.msg_queue.put_drop_oldest(msg)
+
+        elif self.OVERFLOW_POLICY == DISCONNECT_POLICY:
+            self.offline_writer.store(msg_body, self.user_id)
+            logging.warning(
+                f'Disconnecting {self.username}, outbound queue limit exceeded...')
+            self.msg_queue.close()
+            self._disconnect()
+        return msg
+
+    def chat_message(self, msg_body: str) -> Message:
+        return ChatMessage(msg_body)
+
+    # message for user whose sessions can't take it now, called by Presence
+    def spill(self, msg_body: str) -> None:
+        OVERFLOWS.labels(SPILL_POLICY).inc()
+        self.offline_writer.store(msg_body, self.user_id)
+
+    def _disconnect(self) -> None:
+        try:
+            self.client_sock.shutdown(socket.SHUT_RDWR)
+
+        except OSError:
+            pass
+
+    # called from reaper thread, sender and receiver notice broken
+    # connection and finish as on any other disconnect
+    def reap(self) -> None:
+        self._disconnect()
+
+    # called when server shuts down: queue is closed (deliver stores later
+    # messages offline), messages from other users that waited in it are
+    # returned as (body, user_id) rows to be saved, notice is the last
+    # thing client gets before sender closes the connection. Reading stops
+    # first: once the queue is drained sender may close the socket any moment
+    def drain(self, notice: Message) -> list:
+        self.draining = True
+        self._stop_reading()
+        msgs = self.msg_queue.drain((notice, FINAL_MSG))
+        return [(bytes(msg.get_body()[:-1]).decode(ENCODING), self.user_id)
+                for msg in msgs if isinstance(msg, ChatMessage)]
+
+    def _stop_reading(self) -> None:
+        try:
+            self.client_sock.shutdown(socket.SHUT_RD)
 
-    def send_msg(self, msg_body: str, final_msg: bool = False) -> None:
-        self.msg_queue.put(Message(msg_body, final_msg))
+        except OSError:
+            pass
+
+    def ping(self) -> None:
+        self.pinged_at = time.monotonic()
+        self.send_msg_nowait(self.PING_MSG)
+
+    def _redeliver_spilled(self) -> bool:
+        # called by sender when queue is empty: once every session of user
+        # has room, a page of spilled messages is moved to all their queues
+        # and deleted. Returns True when sender should check its queue again
+        stored = self.presence.begin_unspill(self.username)
+        if stored is None:
+            return False
+
+        moved = empty = False
+        try:
+            # the fullest session moves the page once it empties
+            sessions = self.presence.live_sessions(self.username)
+            if all(client.msg_queue.below_low_water() for client in sessions):
+                self.offline_writer.flush()
+                rows = self.db.get_messages(self.user_id, 0, self.BACKLOG_PAGE_SIZE)
+                for _, body in rows:
+                    msg = ChatMessage(body)
+                    for client in sessions:
+                        client.msg_queue.put(msg, force=True)
+                if rows:
+                    self.db.delete_messages(self.user_id, rows[-1][0])
+                moved, empty = bool(rows), not rows
+
+        finally:
+            over = self.presence.end_unspill(self.username, stored, empty)
+
+        # more could have been spilled while the table was read
+        return moved or (empty and not over)
+
+    def _collect_batch(self, msg: Message) -> tuple:
+        # returns bodies of msg and messages already waiting in the queue
+        # and whether the final message was reached
+        buffers = []
+        size = 0
+
+        while not msg.is_final():
+            body = self.framer.encode(msg)
+            buffers.append(body)
+            size += len(body)
+
+            if len(buffers) >= self.SEND_BATCH_COUNT or size >= self.SEND_BATCH_BYTES:
+                break
+
+            try:
+                msg = self.msg_queue.get_nowait()
+
+            except queue.Empty:
+                break
+
+        self.sent_msgs += len(buffers)
+        if buffers:
+            self.sent_batches += 1
+            SENT_MESSAGES.inc(len(buffers))
+            SEND_BATCHES.inc()
+            SENT_BYTES.inc(size)
+        return buffers, msg.is_final()
+
+    def _log_send_stats(self) -> None:
+        if self.sent_batches:
+            logging.info(
+                f'{self.username} got {self.sent_msgs} messages in {self.sent_batches} batches '
+                f'(avg {self.sent_msgs / self.sent_batches:.1f} per batch)...')
+        if self.dropped_msgs:
+            logging.warning(
+                f'{self.dropped_msgs} messages to {self.username} were dropped...')
 
     def _sending_thread(self) -> None:
         try:
-            msg = self.msg_queue.get()
+            if self.first_session:
+                self._deliver_backlog()
+
+            final = False
+            while not final:
+                if (self.msg_queue.qsize() == 0 and self.presence.is_spilled(self.username)
+                        and self._redeliver_spilled()):
+                    continue
 
-            while not msg.is_final():
-                self.client_sock.sendall(msg.get_body())
                 msg = self.msg_queue.get()
+                if self.SEND_LINGER and not msg.is_final():
+                    time.sleep(self.SEND_LINGER)
+
+                buffers, final = self._collect_batch(msg)
+                if buffers:
+                    send_buffers(self.client_sock, buffers)
 
         except Exception as e:
             traceback.print_exc()
@@ -103,195 +539,157 @@ class Client:
                 f'Error in sending thread of {self.username}. Error: {e}')
 
         finally:
+            self.msg_queue.close()
+            self._log_send_stats()
+            # wakes up receiver still waiting in recv, closing alone doesn't
+            self._disconnect()
             self.client_sock.close()
 
     def _receiving_thread(self) -> None:
         try:
-            finish = False
+            finish = self._handle_frames(self.pending)
             while not finish:
-                msg = self.client_sock.recv(BUFF_SIZE).decode(ENCODING)
+                data = self.client_sock.recv(BUFF_SIZE)
 
-                if msg == '':
+                if data == b'':
                     raise RuntimeError('Socket connection broken')
 
-                finish = self._handle_msg(msg.rstrip())
+                self.last_seen = time.monotonic()
+                RECEIVED_BYTES.inc(len(data))
+                finish = self._handle_frames(self.framer.feed(data))
+
+                if self.throttle and not finish:
+                    # client sending too much waits in kernel buffers
+                    delay = self.throttle.read_delay(len(data))
+                    if delay:
+                        time.sleep(delay)
 
         except Exception as e:
+            if self.draining:
+                # sender is still writing the notice and closes socket itself
+                return
+
             traceback.print_exc()
             logging.error(
                 f'Error in recv thread of {self.username}. Error: {e}')
-            self.msg_queue.put(Message('', True))
+            self.msg_queue.put(FINAL_MSG)
             self.client_sock.close()
 
-    def _handle_msg(self, msg: str) -> bool:
-        # send msg to user
-        match = self.SEND_REGEX.fullmatch(msg)
-        if match:
-            addressee, msg = match.groups()
-            self._send_msg_to(addressee, msg)
-            return False
+    def _handle_frames(self, frames: list) -> bool:
+        for msg in frames:
+            if self.throttle and not self.throttle.allow_command():
+                if not self.throttled:
+                    self.throttled = True
+                    self.send_msg(self.THROTTLED_MSG)
+                continue
 
-        # add friend
-        match = self.ADD_FRIEND_REGEX.fullmatch(msg)
-        if match:
-            friend_name, = match.groups()
-            self._add_friend(friend_name)
-            return False
+            self.throttled = False
+            if msg is None:
+                self.send_msg(self.TOO_LONG_MSG)
+                continue
 
-        # delete friend
-        match = self.DELETE_FRIEND_REGEX.fullmatch(msg)
-        if match:
-            friend_name, = match.groups()
-            self._delete_friend(friend_name)
-            return False
+            if self._handle_msg(msg):
+                return True
 
-        # check status (are firends online)
-        match = self.STATUS_REGEX.fullmatch(msg)
-        if match:
-            self._check_status()
-            return False
+        return False
 
-        # help
-        match = self.HELP_REGEX.fullmatch(msg)
-        if match:
-            self._send_help()
-            return False
+    def _handle_msg(self, msg) -> bool:
+        # msg is text line or binary frame, both decode to the same command,
+        # returns True when client is leaving
+        return bool(self.COMMANDS.dispatch(self, msg, self.graph.username))
 
-        # exit
-        match = self.EXIT_REGEX.fullmatch(msg)
-        if match:
-            self._exit()
-            return True
+    def _unknown_command(self) -> None:
+        self.send_msg(self.UNKNOWN_MSG)
 
-        # unknown command
-        msg = "Unknown command. Type 'HELP' to show avaiable commands!"
-        self.send_msg(msg)
-        return False
+    def _pong(self) -> None:
+        self.send_msg(self.PONG_MSG)
+
+    # answer to server's PING, receiving it is all that matters
+    def _heartbeat(self) -> None:
+        pass
 
     def _send_msg_to(self, addressee: str, msg_body: str) -> None:
         try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ SELECT user_id FROM users 
-                        WHERE username = (?); """,
-                    (addressee,)
-                )
-                query_result = cursor.fetchall()
-
-                if query_result:
-                    addressee_id, = query_result[0]
-                    cursor.execute(
-                        """ SELECT user_id FROM users
-                            WHERE username = (?); """,
-                        (self.username,)
-                    )
-                    user_id, = cursor.fetchall()[0]
-
-                    cursor.execute(
-                        """ SELECT user1 FROM friends
-                            WHERE user1 = (?)
-                            AND user2 = (?); """,
-                        (user_id, addressee_id)
-                    )
-                    query_result = cursor.fetchall()
-
-                    if query_result:
-                        cursor.execute(
-                            """ SELECT user1 FROM friends
-                                WHERE user1 = (?)
-                                AND user2 = (?); """,
-                            (addressee_id, user_id)
-                        )
-                        query_result = cursor.fetchall()
-
-                        if query_result:
-                            # check if addressee is online and send msg
-                            msg = self.username + ': ' + msg_body
-                            if addressee in self.online_dict:
-                                # send msg
-                                self.online_dict[addressee].send_msg(msg)
-                                logging.info(
-                                    f"{self.username} sent message to {addressee}...")
-
+            addressee_id = self.graph.user_id(addressee)
+
+            if addressee_id is not None:
+                if self.graph.is_friend(self.user_id, addressee_id):
+                    if self.graph.is_friend(addressee_id, self.user_id):
+                        self.offline_writer.append_history(
+                            self.user_id, addressee_id, None, msg_body)
+
+                        # every session of addressee gets it, on this
+                        # worker and on others
+                        msg = self.username + ': ' + msg_body
+                        local = self.presence.deliver(addressee, msg) is not None
+                        remote = self.router is not None and self.router.deliver(addressee, msg)
+                        if local:
+                            LOCAL_ROUTE.inc()
+                            logging.info(
+                                f"{self.username} sent message to {addressee}...")
+
+                        if remote:
+                            WORKER_ROUTE.inc()
+                            logging.info(
+                                f"{self.username} sent message to {addressee} via router...")
+
+                        if not (local or remote):
+                            # addressee is offline, add msg to his queue
+                            OFFLINE_ROUTE.inc()
+                            if self.offline_writer.durability == SYNC_DURABILITY:
+                                self.offline_writer.store(
+                                    msg, addressee_id,
+                                    lambda stored: self._confirm_stored(addressee, stored))
                             else:
-                                # addressee is offline
+                                self.offline_writer.store(msg, addressee_id)
                                 self.send_msg(
                                     f"{addressee} is offline. Adding msg to his queue!")
-                                # add msg to his queue
-                                cursor.execute(
-                                    """ INSERT INTO messages(body, addressee) VALUES (
-                                        (?), (?)
-                                    ); """,
-                                    (msg, addressee_id)
-                                )
-                                conn.commit()
-
-                        else:
-                            # addressee doesnt have you in friends list
-                            self.send_msg(
-                                f"{addressee} doesn't have you in his friends list! Cannot send message!")
 
                     else:
-                        # you don't have addressee in friends list
+                        # addressee doesnt have you in friends list
                         self.send_msg(
-                            f"You don't have {addressee} in your friends list! Cannot send message!")
+                            f"{addressee} doesn't have you in his friends list! Cannot send message!")
 
                 else:
-                    # addressee doesn't exist
+                    # you don't have addressee in friends list
                     self.send_msg(
-                        f"User {addressee} doesn't exist! Try again!")
+                        f"You don't have {addressee} in your friends list! Cannot send message!")
+
+            else:
+                # addressee doesn't exist
+                self.send_msg(
+                    f"User {addressee} doesn't exist! Try again!")
 
         except Exception as e:
             traceback.print_exc()
             logging.error(
                 f"Error while sending message from {self.username} to {addressee}. Error: {e}")
 
+    def _confirm_stored(self, addressee: str, stored: bool) -> None:
+        if stored:
+            self.send_msg_nowait(
+                f"{addressee} is offline. Adding msg to his queue!")
+        else:
+            self.send_msg_nowait(
+                f"Cannot save message for {addressee}! Try again later!")
+
     def _add_friend(self, friend_name: str) -> None:
         try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ SELECT user_id FROM users
-                        WHERE username = (?); """,
-                    (friend_name,)
-                )
-                query_result = cursor.fetchall()
-                if query_result:
-                    friend_id, = query_result[0]
-                    cursor.execute(
-                        """ SELECT user_id FROM users
-                            WHERE username = (?); """,
-                        (self.username,)
-                    )
-                    user_id, = cursor.fetchall()[0]
-
-                    cursor.execute(
-                        """ SELECT user1 FROM friends
-                            WHERE user1 = (?)
-                            AND user2 = (?); """,
-                        (user_id, friend_id)
-                    )
-                    query_result = cursor.fetchall()
-
-                    if not query_result:
-                        cursor.execute(
-                            """ INSERT INTO friends(user1, user2) VALUES (
-                                (?), (?)
-                            ); """,
-                            (user_id, friend_id)
-                        )
-                        conn.commit()
-                        msg = f"Added {friend_name} to friends list!"
-                    else:
-                        # you already have friends in your friends list
-                        msg = f"You already have {friend_name} in your friends list!"
+            friend_id = self.graph.user_id(friend_name)
 
+            if friend_id is not None:
+                if not self.graph.is_friend(self.user_id, friend_id):
+                    self.graph.add_friend(self.user_id, friend_id)
+                    msg = f"Added {friend_name} to friends list!"
                 else:
-                    # user 'friend' doesnt exist
-                    msg = f"User {friend_name} doesn't exist!"
+                    # you already have friends in your friends list
+                    msg = f"You already have {friend_name} in your friends list!"
+
+            else:
+                # user 'friend' doesnt exist
+                msg = f"User {friend_name} doesn't exist!"
 
-                self.send_msg(msg)
+            self.send_msg(msg)
 
         except Exception as e:
             traceback.print_exc()
@@ -300,72 +698,221 @@ class Client:
 
     def _delete_friend(self, friend_name: str) -> None:
         try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ SELECT username FROM users
-                        WHERE user_id = (
-                            SELECT user2 FROM friends
-                            WHERE user1 = (
-                                SELECT user_id FROM users WHERE username = (?)
-                            )
-                            AND user2 = (
-                                SELECT user_id FROM users WHERE username = (?)
-                            )
-                        ); """,
-                    (self.username, friend_name)
-                )
-                query_result = cursor.fetchall()
-
-                if query_result:
-                    cursor.execute(
-                        """ DELETE FROM friends
-                            WHERE user1 = (
-                                SELECT user_id FROM users WHERE username = (?)
-                            )
-                            AND user2 = (
-                                SELECT user_id FROM users WHERE username = (?)
-                            ); """,
-                        (self.username, friend_name)
-                    )
-                    conn.commit()
-                    msg = f"Deleted {friend_name} from friends."
+            friend_id = self.graph.user_id(friend_name)
 
-                else:
-                    msg = f"You don't have {friend_name} in your friends list."
+            if friend_id is not None and self.graph.is_friend(self.user_id, friend_id):
+                self.graph.delete_friend(self.user_id, friend_id)
+                msg = f"Deleted {friend_name} from friends."
 
-                self.send_msg(msg)
+            else:
+                msg = f"You don't have {friend_name} in your friends list."
+
+            self.send_msg(msg)
 
         except Exception as e:
             traceback.print_exc()
             logging.error(
                 f"Error while deleting friend of {self.username}. Error: {e}")
 
+    def _post_to_room(self, room: str, text: str) -> None:
+        try:
+            room_id = self.rooms.room_id(room)
+
+            if room_id is None:
+                self.send_msg(f"Room #{room} doesn't exist!")
+                return
+
+            if not self.rooms.is_member(room_id, self.user_id):
+                self.send_msg(f"You are not in #{room}! Join it first.")
+                return
+
+            self.offline_writer.append_history(self.user_id, None, room_id, text)
+
+            msg_body = f'#{room} {self.username}: {text}'
+            # encoded once, the same Message goes to every online member's queue
+            msg = None
+            remote = {}
+            offline = []
+            members = self.rooms.get_members(room_id)
+            for member_id in members:
+                if member_id == self.user_id:
+                    continue
+
+                member = self.graph.username(member_id)
+                delivered = self.presence.deliver(member, msg_body, msg)
+                workers = self.presence.remote_workers(member)
+                if delivered is not None:
+                    msg = delivered
+                for worker_id in workers:
+                    remote.setdefault(worker_id, []).append(member)
+                if delivered is None and not workers:
+                    offline.append(member_id)
+
+            # one record per worker and one write for everyone offline
+            for worker_id, usernames in remote.items():
+                self.router.post(worker_id, usernames, msg_body)
+            if offline:
+                self.offline_writer.store_many(msg_body, offline)
+
+            ROOM_POSTS.inc()
+            ROOM_FANOUT.observe(len(members) - 1)
+            logging.info(
+                f'{self.username} posted to #{room} ({len(members) - 1} members, '
+                f'{len(offline)} offline)...')
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while posting from {self.username} to #{room}. Error: {e}')
+
+    def _create_room(self, room: str) -> None:
+        try:
+            self.rooms.create(room, self.user_id)
+            self.send_msg(f"Created room #{room}!")
+
+        except RoomExistsError:
+            self.send_msg(f"Room #{room} already exists!")
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while creating room #{room} for {self.username}. Error: {e}')
+
+    def _join_room(self, room: str) -> None:
+        try:
+            room_id = self.rooms.room_id(room)
+
+            if room_id is None:
+                msg = f"Room #{room} doesn't exist!"
+            elif self.rooms.is_member(room_id, self.user_id):
+                msg = f"You are already in #{room}!"
+            else:
+                self.rooms.join(room_id, self.user_id)
+                msg = f"Joined room #{room}!"
+
+            self.send_msg(msg)
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while joining #{room} by {self.username}. Error: {e}')
+
+    def _leave_room(self, room: str) -> None:
+        try:
+            room_id = self.rooms.room_id(room)
+
+            if room_id is not None and self.rooms.is_member(room_id, self.user_id):
+                self.rooms.leave(room_id, self.user_id)
+                msg = f"Left room #{room}."
+            else:
+                msg = f"You are not in #{room}."
+
+            self.send_msg(msg)
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while leaving #{room} by {self.username}. Error: {e}')
+
+    def _format_history(self, rows: list) -> str:
+        lines = []
+        for message_id, sender_id, room_id, body, created in rows:
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+            room = f'#{self.rooms.name(room_id)} ' if room_id is not None else ''
+            lines.append(f'[{message_id}] {when} {room}{self.graph.username(sender_id)}: {body}')
+        return '\n'.join(lines)
+
+    def _stream_history(self, fetch, before_id: int, limit: int, more) -> None:
+        # fetch(before_id, limit) returns rows newest first, they are read
+        # and queued page by page (keyset pagination on message_id), so
+        # long histories are never held in memory at once
+        before_id = before_id if before_id is not None else self.LAST_MESSAGE_ID
+        limit = min(limit or self.HISTORY_LIMIT, self.MAX_HISTORY_LIMIT)
+        sent = 0
+
+        while sent < limit:
+            rows = fetch(before_id, min(self.HISTORY_PAGE_SIZE, limit - sent))
+            if not rows:
+                break
+
+            self.send_msg(self._format_history(rows))
+            sent += len(rows)
+            before_id = rows[-1][0]
+
+        if sent == 0:
+            self.send_msg(self.NO_MESSAGES_MSG)
+        elif sent == limit:
+            self.send_msg(f"Type '{more(before_id)}' for older messages.")
+        else:
+            self.send_msg(self.END_OF_HISTORY_MSG)
+
+    def _send_history(self, target: str, before_id: int, limit: int) -> None:
+        try:
+            if target.startswith('#'):
+                room = target[1:]
+                room_id = self.rooms.room_id(room)
+                if room_id is None or not self.rooms.is_member(room_id, self.user_id):
+                    self.send_msg(f"You are not in #{room}.")
+                    return
+
+                fetch = functools.partial(self.db.get_room_history, room_id)
+
+            else:
+                other_id = self.graph.user_id(target)
+                if other_id is None:
+                    self.send_msg(f"User {target} doesn't exist!")
+                    return
+
+                fetch = functools.partial(self.db.get_direct_history, self.user_id, other_id)
+
+            # messages sent a moment ago may still wait for writer
+            self.offline_writer.flush()
+            self._stream_history(fetch, before_id, limit,
+                                 lambda before: f'HISTORY {target} {before} {limit or ""}'.rstrip())
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while sending history of {target} to {self.username}. Error: {e}')
+
+    def _search_history(self, before_id: int, text: str) -> None:
+        try:
+            # every word is quoted, so user's text is never parsed as FTS syntax
+            query = ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+            self.offline_writer.flush()
+            self._stream_history(
+                functools.partial(self.db.search_history, self.user_id, query),
+                before_id, None, lambda before: f'SEARCH {before} {text}')
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while searching history of {self.username}. Error: {e}')
+
+    def _whois(self, username: str) -> None:
+        try:
+            user_id = self.graph.user_id(username)
+            if user_id is not None:
+                self.send_msg(UserMessage(user_id, username))
+            else:
+                self.send_msg(f"User {username} doesn't exist!")
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while looking up {username} for {self.username}. Error: {e}')
+
     def _check_status(self) -> None:
         try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ SELECT username FROM users 
-                        WHERE user_id = (
-                            SELECT user2 FROM friends
-                            WHERE user1 = (
-                                SELECT user_id FROM users WHERE username = (?)
-                            )
-                        ); """,
-                    (self.username,)
-                )
-                query_result = cursor.fetchall()
-
-                msg = 'Friends statuses:\n'
-                for result in query_result:
-                    friend, = result
-                    if friend in self.online_dict:
-                        msg += '*\t' + friend + '\tSTATUS: ONLINE\n'
-                    else:
-                        msg += '*\t' + friend + '\tSTATUS: OFFLINE\n'
+            msg = 'Friends statuses:\n'
+            for friend in self.graph.get_friends(self.user_id):
+                if self.presence.is_online(friend):
+                    msg += '*\t' + friend + '\tSTATUS: ONLINE\n'
+                else:
+                    msg += '*\t' + friend + '\tSTATUS: OFFLINE\n'
 
-                self.send_msg(msg)
+            self.send_msg(msg)
 
         except Exception as e:
             traceback.print_exc()
@@ -374,18 +921,32 @@ class Client:
 
     def _send_help(self) -> None:
         try:
-            self.send_msg(self.HELP_MSG)
+            self.send_msg(self.HELP_REPLY)
 
         except Exception as e:
             traceback.print_exc()
             logging.error(
                 f'Error while sending help msg to {self.username}. Error: {e}')
 
-    def _exit(self) -> None:
+    # admins only, for others it's unknown command
+    def _send_stats(self) -> None:
+        if self.username not in self.ADMINS:
+            self._unknown_command()
+            return
+
         try:
-            msg = 'Exiting from the server.\n'
-            self.send_msg(msg)
-            self.send_msg('', True)
+            self.send_msg(metrics.REGISTRY.render())
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error while sending stats to {self.username}. Error: {e}')
+
+    # returns True, client is leaving
+    def _exit(self) -> bool:
+        try:
+            self.send_msg(self.EXIT_MSG)
+            self.send_msg(FINAL_MSG)
 
         except Exception as e:
             traceback.print_exc()
@@ -394,8 +955,223 @@ class Client:
             self.client_sock.close()
 
         finally:
-            if self.username in self.online_dict:
-                del self.online_dict[self.username]
+            self.presence.remove(self)
+
+        return True
+
+
+class AsyncClient(Client):
+    def __init__(self, presence: Presence, db: Storage, graph: SocialGraph, rooms: Rooms,
+                 offline_writer: OfflineWriter, router: Router, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, username: str,
+                 framer=None, pending: list = None,
+                 throttle: Throttle = None):
+        self.reader = reader
+        self.writer = writer
+        # client is created inside event loop, other threads have to
+        # wake it up through call_soon_threadsafe
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        # set when something was put to the queue
+        self.readable = asyncio.Event()
+        # set by sender after every flush, receiver waits on it when
+        # client doesn't read its replies
+        self.drained = asyncio.Event()
+        # command handled by executor thread, set until it's done
+        self.busy = None
+        super().__init__(presence, db, graph, rooms, offline_writer, router,
+                         writer.get_extra_info('socket'), username, framer, pending,
+                         throttle)
+
+    def _create_queue(self) -> OutboundQueue:
+        return OutboundQueue(self.OUTBOUND_LIMIT_BYTES, on_put=self._wakeup,
+                             on_high_water=self._on_high_water)
+
+    def _wakeup(self) -> None:
+        if threading.get_ident() == self.loop_thread:
+            self.readable.set()
+        else:
+            self.loop.call_soon_threadsafe(self.readable.set)
+
+    async def _get_msg(self) -> Message:
+        while True:
+            try:
+                return self.msg_queue.get_nowait()
+
+            except queue.Empty:
+                self.readable.clear()
+                # check again, something could have been put before clear()
+                if self.msg_queue.qsize() == 0:
+                    await self.readable.wait()
+
+    # replies to own commands never block event loop, receiver stops
+    # reading instead when the queue is full
+    def send_msg(self, msg_body, final_msg: bool = False) -> None:
+        if not isinstance(msg_body, Message):
+            msg_body = Message(msg_body, final_msg)
+        self.msg_queue.put(msg_body, force=True)
+
+    def _disconnect(self) -> None:
+        if threading.get_ident() == self.loop_thread:
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def _stop_reading(self) -> None:
+        if threading.get_ident() == self.loop_thread:
+            self._feed_eof()
+        else:
+            self.loop.call_soon_threadsafe(self._feed_eof)
+
+    def _feed_eof(self) -> None:
+        # transport must not feed reader anything after EOF
+        self.writer.transport.pause_reading()
+        self.reader.feed_eof()
+
+    # commands writing to database (and history, read after writer's
+    # flush) are done by executor thread so event loop doesn't wait for
+    # commit; client's next commands wait for it in _handle_frames_async,
+    # so replies keep their order
+    def _add_friend(self, friend_name: str) -> None:
+        self.busy = self.loop.run_in_executor(None, super()._add_friend, friend_name)
+
+    def _delete_friend(self, friend_name: str) -> None:
+        self.busy = self.loop.run_in_executor(None, super()._delete_friend, friend_name)
+
+    def _create_room(self, room: str) -> None:
+        self.busy = self.loop.run_in_executor(None, super()._create_room, room)
+
+    def _join_room(self, room: str) -> None:
+        self.busy = self.loop.run_in_executor(None, super()._join_room, room)
+
+    def _leave_room(self, room: str) -> None:
+        self.busy = self.loop.run_in_executor(None, super()._leave_room, room)
+
+    def _send_history(self, target: str, before_id: int, limit: int) -> None:
+        self.busy = self.loop.run_in_executor(
+            None, super()._send_history, target, before_id, limit)
+
+    def _search_history(self, before_id: int, text: str) -> None:
+        self.busy = self.loop.run_in_executor(
+            None, super()._search_history, before_id, text)
+
+    async def _handle_frames_async(self, frames: list) -> bool:
+        for msg in frames:
+            if self._handle_frames((msg,)):
+                return True
+
+            if self.busy is not None:
+                await self.busy
+                self.busy = None
+
+        return False
+
+    # like _backlog_pages, but every page is read and deleted by executor
+    # thread, so event loop doesn't wait for database
+    async def _deliver_backlog_async(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._flush_writers)
+
+            last_id = 0
+            while True:
+                last_id, buffers = await loop.run_in_executor(
+                    None, self._backlog_page, last_id)
+                if not buffers:
+                    break
+
+                self.writer.writelines(buffers)
+                await self.writer.drain()
+                await loop.run_in_executor(None, self._backlog_page_sent, last_id, buffers)
+
+        except OSError:
+            raise
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Cannot deliver offline messages to {self.username}. Error: {e}')
+
+    async def _sending_task(self) -> None:
+        try:
+            if self.first_session:
+                await self._deliver_backlog_async()
+
+            final = False
+            while not final:
+                # flush and database calls are done by executor thread
+                if (self.msg_queue.qsize() == 0 and self.presence.is_spilled(self.username)
+                        and await asyncio.get_running_loop().run_in_executor(
+                            None, self._redeliver_spilled)):
+                    continue
+
+                msg = await self._get_msg()
+                if self.SEND_LINGER and not msg.is_final():
+                    await asyncio.sleep(self.SEND_LINGER)
+
+                buffers, final = self._collect_batch(msg)
+                if buffers:
+                    self.writer.writelines(buffers)
+                    await self.writer.drain()
+                self.drained.set()
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(
+                f'Error in sending task of {self.username}. Error: {e}')
+
+        finally:
+            self.msg_queue.close()
+            self.drained.set()
+            self._log_send_stats()
+            self.writer.close()
+
+    async def _receiving_task(self) -> None:
+        try:
+            finish = await self._handle_frames_async(self.pending)
+            while not finish:
+                while self.msg_queue.full() and not self.msg_queue.closed:
+                    self.drained.clear()
+                    await self.drained.wait()
+
+                data = await self.reader.read(BUFF_SIZE)
+
+                if data == b'':
+                    raise RuntimeError('Socket connection broken')
+
+                self.last_seen = time.monotonic()
+                RECEIVED_BYTES.inc(len(data))
+                finish = await self._handle_frames_async(self.framer.feed(data))
+
+                if self.throttle and not finish:
+                    delay = self.throttle.read_delay(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+
+        except Exception as e:
+            if self.draining:
+                return
+
+            logging.error(
+                f'Error in recv task of {self.username}. Error: {e}')
+            self.send_msg(FINAL_MSG)
+
+    # returns True, client is leaving
+    def _exit(self) -> bool:
+        try:
+            self.send_msg(self.EXIT_MSG)
+            self.send_msg(FINAL_MSG)
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(f'Error while exiting {self.username}. Error: {e}')
+
+            self.writer.close()
+
+        finally:
+            self.presence.remove(self)
+
+        return True
 
 
 class Server:
@@ -405,73 +1181,213 @@ class Server:
                 "* 'HELP' - to show avaiable commands,\n"
                 "* 'EXIT' - to exit from the server.\n").encode(ENCODING)
 
-    REGISTER_REGEX = re.compile(r'REGISTER\s+(\w+)\s+(\S+)\s*')
-    LOGIN_REGEX = re.compile(r'LOGIN\s+(\w+)\s+(\S+)\s*')
-    HELP_REGEX = re.compile(r'HELP\s*')
-    EXIT_REGEX = re.compile(r'EXIT\s*')
-
-    def __init__(self, PORT: int, nConnections: int):
+    # handlers return (reply, logged in username or None, close connection flag)
+    COMMANDS = CommandRegistry(COMMAND_SECONDS, unknown='unknown_command')
+    COMMANDS.add('register', 'REGISTER', 'register_command', NAME, PASSWORD, opcode=0x20)
+    COMMANDS.add('login', 'LOGIN', 'login_command', NAME, PASSWORD, opcode=0x21)
+    COMMANDS.add('help', 'HELP', 'help_command', opcode=0x06)
+    COMMANDS.add('exit', 'EXIT', 'exit_command', opcode=0x07)
+
+    GREETING_MSG = ("Welcome to the server!\n"
+                    "Register by typing 'REGISTER username password' or log in by typing 'LOGIN username password'.\n"
+                    "Antime you need help, just type 'HELP' :)\n").encode(ENCODING)
+    UNKNOWN_MSG = "Unknown command. Try again!\nType 'HELP' to show avaiable commands!\n".encode(
+        ENCODING)
+    EXIT_MSG = "You're being disconnected from server...\n".encode(ENCODING)
+    TOO_LONG_MSG = f"Message too long! Limit is {MAX_FRAME_SIZE} bytes.\n".encode(
+        ENCODING)
+    BUSY_MSG = "Server is busy. Try again later!\n".encode(ENCODING)
+    TIMEOUT_MSG = "Login timed out!\n".encode(ENCODING)
+    REGISTERED_MSG = "You've been successfully registered and logged in!\n".encode(ENCODING)
+    USERNAME_TAKEN_MSG = "Username already in use. Try different one.\n".encode(ENCODING)
+    LOGGED_IN_MSG = "You've been logged in\n".encode(ENCODING)
+    WRONG_PASSWORD_MSG = "Wrong password! Try again!\n".encode(ENCODING)
+    WRONG_USERNAME_MSG = "Wrong username! Try again!\n".encode(ENCODING)
+    SERVER_ERROR_MSG = "Server error! Try again!\n".encode(ENCODING)
+    FULL_MSG = "Server is full. Try again later!\n".encode(ENCODING)
+    THROTTLED_MSG = "Slow down! Try again in a moment.\n".encode(ENCODING)
+
+    # seconds client has to log in, 0 disables
+    HANDSHAKE_TIMEOUT = 30.0
+    # logged in clients silent for that long are disconnected, 0 disables.
+    # Off by default: clients that only read and don't answer PING would
+    # be cut off, dead peers are found by TCP keepalive anyway
+    IDLE_TIMEOUT = 0.0
+    # silent clients are sent 'PING' that often, so live ones answer
+    # before IDLE_TIMEOUT, 0 disables
+    HEARTBEAT_INTERVAL = 0.0
+    REAPER_INTERVAL = 1.0
+    # TCP keepalive lets kernel find half-open connections (peer gone
+    # without FIN), dead peer is detected after about
+    # KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT seconds, 0 disables
+    KEEPALIVE_IDLE = 60
+    KEEPALIVE_INTERVAL = 10
+    KEEPALIVE_COUNT = 5
+    # seconds clients get on shutdown to receive what's left for them
+    # before they are cut off
+    DRAIN_TIMEOUT = 5.0
+    # listening socket is polled, so it may be shared with predecessor
+    # or successor running in the other mode (hot restart)
+    ACCEPT_TIMEOUT = 1.0
+    # connections (logged in or not) served by this process at once,
+    # more are closed right after accept, 0 disables. Off by default,
+    # set it below the open files limit
+    MAX_CONNECTIONS = 0
+    # token bucket rates per second, 0 disables: commands and received
+    # bytes of one user, the same for all users of one address and new
+    # connections from one address. Refused commands are dropped with
+    # THROTTLED_MSG, reading from client sending too many bytes is paused.
+    # All limits are off by default: refused commands (chat lines included)
+    # are lost, which clients pipelining commands don't expect, and all
+    # clients of server behind proxy or listening on localhost share one address
+    COMMAND_RATE = 0.0
+    BYTE_RATE = 0.0
+    IP_COMMAND_RATE = 0.0
+    IP_BYTE_RATE = 0.0
+    IP_CONNECT_RATE = 0.0
+    # sessions (logged in connections) of one user on one process, login
+    # above it closes the oldest one, 0 disables
+    MAX_SESSIONS = SESSIONS_LIMIT
+    # clients negotiating binary protocol may ask for zlib compression of
+    # frames at least that many bytes long, 0 disables compression
+    COMPRESS_THRESHOLD = FRAME_COMPRESS_THRESHOLD
+    # offline messages older than that many seconds are deleted and
+    # addressees keep only that many newest ones, 0 disables; the count is
+    # enforced when messages are stored, both are enforced by compaction
+    # running every COMPACTION_INTERVAL seconds (in first worker only)
+    MESSAGE_MAX_AGE = 30 * 24 * 3600.0
+    MAX_MESSAGES_PER_USER = 10000
+    COMPACTION_INTERVAL = 60.0
+
+    def __init__(self, PORT: int, nConnections: int, mode: str = THREADS_MODE,
+                 durability: str = ASYNC_DURABILITY, worker_id: int = 0,
+                 workers: int = 1, socket_dir: str = None, metrics_port: int = None,
+                 listen_fd: int = None, ready_fd: int = None):
         self.PORT = PORT
         self.nConnections = nConnections
-        self.online = {}
+        self.mode = mode
+        self.durability = durability
+        self.worker_id = worker_id
+        self.workers = workers
+        self.socket_dir = socket_dir
+        # every worker serves its own metrics on metrics_port + worker_id
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # hot restart: listening socket inherited from predecessor and pipe
+        # to tell whoever started us that connections are accepted
+        self.listen_fd = listen_fd
+        self.ready_fd = ready_fd
+        self.stopped = threading.Event()
+        # set by first shutdown signal, restart or drain
+        self.stopping = False
+        self.restarting = False
+        self.handed_over = False
+        self.draining = False
+        # logged in connections and sockets still in handshake, both
+        # are waited for or cut off when server drains
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.handshakes = set()
+        # all accepted connections, limited by MAX_CONNECTIONS
+        self.open_connections = 0
+        self.user_commands = RateLimiter('user_commands', self.COMMAND_RATE)
+        self.user_bytes = RateLimiter('user_bytes', self.BYTE_RATE)
+        self.ip_commands = RateLimiter('ip_commands', self.IP_COMMAND_RATE)
+        self.ip_bytes = RateLimiter('ip_bytes', self.IP_BYTE_RATE)
+        self.ip_connects = RateLimiter('ip_connects', self.IP_CONNECT_RATE)
+        self.db = open_storage()
+        self.graph = SocialGraph(self.db)
+        self.rooms = Rooms(self.db)
+        self.presence = Presence(self.graph, max_sessions=self.MAX_SESSIONS)
+        self.offline_writer = None
+        self.compactor = None
+        self.router = None
+        # hashing processes are shared by all workers of the host
+        self.auth = Authenticator(max(1, AUTH_POOL_SIZE // workers))
+        # logins wait for hashing in their own threads, so they don't take
+        # the default executor from history and backlog
+        self.login_executor = None
+        if self.mode == ASYNCIO_MODE:
+            self.login_executor = concurrent.futures.ThreadPoolExecutor(
+                MAX_LOGINS, thread_name_prefix='login')
 
         self.logging_init()
         self.db_init()
         self.server_socket = self.socket_init()
+        self.metrics_init()
+        self.reaper_init()
+        self.signals_init()
 
         try:
-            self.accept_conn()
+            if self.mode == ASYNCIO_MODE:
+                asyncio.run(self.accept_conn_async())
+            else:
+                self.accept_conn()
 
         except KeyboardInterrupt:
             logging.error('Keyboard interrupt detected... Shutting down...')
 
+        except RestartRequested:
+            logging.info('Successor took over... Shutting down...')
+
         finally:
             self.close_server()
 
     def close_server(self):
+        self.stopping = True
+        self.stopped.set()
         logging.info('Closing socket...')
-        self.server_socket.shutdown(socket.SHUT_RDWR)
-        self.server_socket.close()
-
-    def logging_init(self) -> None:
+        if self.server_socket.fileno() != -1:
+            # shutdown would stop successor's copy of the socket as well
+            if not self.handed_over:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            self.server_socket.close()
+        if self.mode != ASYNCIO_MODE:
+            # event loop has drained clients before it finished
+            self.drain()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        self.presence.close()
+        if self.router:
+            self.router.close()
+        if self.compactor:
+            self.compactor.close()
+        if self.offline_writer:
+            logging.info('Flushing offline messages...')
+            self.offline_writer.close()
+        if self.login_executor:
+            self.login_executor.shutdown()
+        self.auth.close()
+        self.db.close()
+
+    @staticmethod
+    def logging_init() -> None:
         logging.basicConfig(format='[{asctime}] {levelname} - {message}',
                             datefmt='%d/%m/%Y %H:%M:%S', style='{', level=0)
 
     def db_init(self) -> None:
         try:
             logging.info('Initializing database...')
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ CREATE TABLE IF NOT EXISTS users(
-                        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT NOT NULL,
-                        password TEXT NOT NULL,
-                        CONSTRAINT username_constraint UNIQUE (username)
-                    ); """
-                )
-                cursor.execute(
-                    """ CREATE TABLE IF NOT EXISTS friends(
-                        user1 INTEGER,
-                        user2 INTEGER,
-                        CONSTRAINT fk_column
-                            FOREIGN KEY (user1, user2)
-                            REFERENCES users (user_id, user_id)
-                    ); """
-                )
-                cursor.execute(
-                    """ CREATE TABLE IF NOT EXISTS messages(
-                        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        body TEXT,
-                        addressee INTEGER,
-                        CONSTRAINT fk_column
-                            FOREIGN KEY (addressee)
-                            REFERENCES users (user_id)
-                    ); """
-                )
-                conn.commit()
+            self.db.migrate()
+            self.graph.load()
+            self.rooms.load()
+            self.offline_writer = OfflineWriter(self.db, self.durability,
+                                                max_messages=self.MAX_MESSAGES_PER_USER)
+            if self.worker_id == 0 and (self.MESSAGE_MAX_AGE or self.MAX_MESSAGES_PER_USER):
+                self.compactor = Compactor(self.db, self.MESSAGE_MAX_AGE,
+                                           self.MAX_MESSAGES_PER_USER, self.COMPACTION_INTERVAL)
             logging.info('Database initialized...')
 
+            if self.workers > 1:
+                self.router = Router(self.worker_id, self.workers, self.socket_dir,
+                                     self.presence, self.graph, self.rooms,
+                                     self.offline_writer)
+                self.graph.on_change = self.router.broadcast_friendship
+                self.rooms.on_change = self.router.broadcast_membership
+                self.presence.on_change = self.router.announce
+                self.router.start()
+
         except Exception as e:
             traceback.print_exc()
             logging.error(
@@ -481,8 +1397,17 @@ class Server:
     def socket_init(self) -> socket.socket:
         try:
             logging.info('Initializing server socket...')
+            if self.listen_fd is not None:
+                server_socket = socket.socket(fileno=self.listen_fd)
+                logging.info('Server socket inherited from predecessor...')
+                return server_socket
+
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.workers > 1:
+                # every worker listens on its own socket, kernel spreads
+                # incoming connections between them
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             server_socket.bind(('localhost', self.PORT))
             server_socket.listen(self.nConnections)
 
@@ -495,21 +1420,280 @@ class Server:
                 f'Error while initializing server socket...\nShutting down...')
             os.sys.exit(SOCKET_ERROR)
 
+    def metrics_init(self) -> None:
+        ONLINE_USERS.set_function(self.presence.count)
+        ONLINE_SESSIONS.set_function(lambda: self.presence.session_count)
+        QUEUED_MESSAGES.set_function(
+            lambda: sum(client.msg_queue.qsize() for client in self.presence.clients()))
+        QUEUED_BYTES.set_function(
+            lambda: sum(client.msg_queue.bytes for client in self.presence.clients()))
+        MAX_QUEUED_BYTES.set_function(
+            lambda: max((client.msg_queue.bytes for client in self.presence.clients()),
+                        default=0))
+
+        if self.metrics_port is None:
+            return
+
+        try:
+            port = self.metrics_port + self.worker_id
+            self.metrics_server = metrics.start_http_server(port)
+            logging.info(f'Serving metrics on {metrics.SCRAPE_HOST}:{port}...')
+
+        except OSError as e:
+            logging.error(f'Cannot serve metrics. Error: {e}')
+
+    def signals_init(self) -> None:
+        # SIGINT and SIGTERM drain server, RESTART_SIGNAL starts successor
+        # first. Workers are restarted by their parent, which passes the
+        # signal on once successor is up. Only main thread may handle
+        # signals, event loop installs its own handlers.
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        signal.signal(signal.SIGINT, self.on_stop_signal)
+        signal.signal(signal.SIGTERM, self.on_stop_signal)
+        if RESTART_SIGNAL:
+            signal.signal(RESTART_SIGNAL, self.on_restart_signal)
+
+    def on_stop_signal(self, signum, frame) -> None:
+        # later signals don't interrupt draining
+        if not self.stopping:
+            self.stopping = True
+            raise KeyboardInterrupt
+
+    def on_restart_signal(self, signum, frame) -> None:
+        # runs in main thread while it waits in accept(), connections coming
+        # meanwhile wait in listen backlog for successor
+        if self.stopping or self.restarting:
+            return
+
+        if self.workers > 1:
+            self.stopping = True
+            self.handed_over = True
+            raise RestartRequested()
+
+        logging.info('Restart requested... Starting successor...')
+        self.restarting = True
+        try:
+            if spawn_successor(self.server_socket.fileno()):
+                self.stopping = True
+                self.handed_over = True
+                raise RestartRequested()
+
+        finally:
+            self.restarting = False
+
+    def drain(self) -> None:
+        clients, rows = self.drain_clients()
+        self.store_drained(rows)
+
+        deadline = time.monotonic() + self.DRAIN_TIMEOUT
+        while self.connections and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.cut_off(clients)
+
+    def drain_clients(self) -> tuple:
+        # stops every client and takes away messages waiting in its queue,
+        # returns clients and messages as rows for store_drained
+        self.draining = True
+        notice = self.drain_notice()
+        clients = self.presence.clients()
+        rows = []
+        for client in clients:
+            rows.extend(client.drain(notice))
+            self.presence.remove(client)
+
+        with self.lock:
+            handshakes = list(self.handshakes)
+        for client_sock in handshakes:
+            # only reading is stopped: client that has just been told it's
+            # logged in is about to be added and still gets the notice
+            try:
+                client_sock.shutdown(socket.SHUT_RD)
+
+            except OSError:
+                pass
+
+        logging.info(f'Draining {len(clients)} clients...')
+        return clients, rows
+
+    def store_drained(self, rows: list) -> None:
+        # all in one transaction, written directly, so they come before
+        # newer ones spilled to offline writer
+        if not rows:
+            return
+
+        try:
+            self.db.store_messages(rows)
+            DRAINED_MESSAGES.inc(len(rows))
+            logging.info(f'Saved {len(rows)} undelivered messages...')
+
+        except Exception as e:
+            traceback.print_exc()
+            logging.error(f'Cannot save undelivered messages. Error: {e}')
+
+    def cut_off(self, clients: list) -> None:
+        if self.connections:
+            logging.warning(f'{self.connections} clients did not finish in time... Disconnecting...')
+            for client in clients:
+                client.reap()
+
+    def drain_notice(self) -> Message:
+        return Client.RESTART_MSG if self.handed_over else Client.SHUTDOWN_MSG
+
+    def add_client(self, client: Client) -> None:
+        with self.lock:
+            self.connections += 1
+        client.first_session, replaced = self.presence.add(client)
+        for old in replaced:
+            self.replace_session(old, client)
+        if self.draining:
+            # logged in just as server started draining
+            self.store_drained(client.drain(self.drain_notice()))
+
+    def replace_session(self, old: Client, client: Client) -> None:
+        # oldest session above MAX_SESSIONS is told why and closed like on
+        # shutdown (its receiver stops right away), then cut off if sender
+        # doesn't finish in DRAIN_TIMEOUT.
+        # Other sessions have got what waited in its queue, unless there's
+        # none, then it's kept for the new one to stream as backlog
+        logging.warning(f'Replacing the oldest session of {old.username}...')
+        REPLACED_SESSIONS.inc()
+        rows = old.drain(Client.REPLACED_MSG)
+        if client.first_session:
+            self.store_drained(rows)
+        timer = threading.Timer(self.DRAIN_TIMEOUT, old.reap)
+        timer.daemon = True
+        timer.start()
+
+    def remove_client(self, client: Client) -> None:
+        self.presence.remove(client)
+        with self.lock:
+            self.connections -= 1
+
+    def admit(self, address: str) -> tuple:
+        # returns (throttle, None) for accepted connection and (None, reply)
+        # for rejected one, accepted ones must be released
+        bucket = self.ip_connects.bucket(address)
+        if bucket and not bucket.take():
+            THROTTLED_REJECTED.inc()
+            return None, self.THROTTLED_MSG
+
+        with self.lock:
+            full = self.MAX_CONNECTIONS and self.open_connections >= self.MAX_CONNECTIONS
+            if not full:
+                self.open_connections += 1
+
+        if full:
+            FULL_REJECTED.inc()
+            return None, self.FULL_MSG
+
+        return Throttle((self.ip_commands.bucket(address),),
+                        (self.ip_bytes.bucket(address),)), None
+
+    def release(self) -> None:
+        with self.lock:
+            self.open_connections -= 1
+
+    def throttle_user(self, throttle: Throttle, username: str) -> Throttle:
+        throttle.extend((self.user_commands.bucket(username),),
+                        (self.user_bytes.bucket(username),))
+        return throttle
+
+    def reaper_init(self) -> None:
+        if self.IDLE_TIMEOUT or self.HEARTBEAT_INTERVAL:
+            threading.Thread(target=self.reaping_thread, name='reaper', daemon=True).start()
+
+    def reaping_thread(self) -> None:
+        while not self.stopped.wait(self.REAPER_INTERVAL):
+            try:
+                self.reap_clients()
+
+            except Exception as e:
+                traceback.print_exc()
+                logging.error(f'Error in reaper. Error: {e}')
+
+    def reap_clients(self) -> None:
+        now = time.monotonic()
+        for client in self.presence.clients():
+            idle = now - client.last_seen
+            if self.IDLE_TIMEOUT and idle > self.IDLE_TIMEOUT:
+                logging.warning(
+                    f'Disconnecting {client.username}, nothing received for {idle:.0f} s...')
+                IDLE_REAPED.inc()
+                client.reap()
+                # registry is cleaned up right away, connection handler
+                # may still wait for socket to be closed
+                self.presence.remove(client)
+
+            elif (self.HEARTBEAT_INTERVAL
+                    and now - max(client.last_seen, client.pinged_at) > self.HEARTBEAT_INTERVAL):
+                client.ping()
+
+    def set_keepalive(self, sock: socket.socket) -> None:
+        if not self.KEEPALIVE_IDLE:
+            return
+
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # fine tuning is platform specific
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.KEEPALIVE_IDLE)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.KEEPALIVE_INTERVAL)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.KEEPALIVE_COUNT)
+
+        except OSError as e:
+            logging.error(f'Cannot set TCP keepalive. Error: {e}')
+
     def accept_conn(self) -> None:
+        self.server_socket.settimeout(self.ACCEPT_TIMEOUT)
+        notify_ready(self.ready_fd)
         while True:
-            client_sock, client_addr = self.server_socket.accept()
+            try:
+                client_sock, client_addr = self.server_socket.accept()
+
+            except socket.timeout:
+                continue
+
+            CONNECTIONS.inc()
+            throttle, reply = self.admit(client_addr[0])
+            if not throttle:
+                logging.warning(f"{client_addr} rejected: {reply.decode(ENCODING).strip()}")
+                self.reject(client_sock, reply)
+                continue
 
             logging.info(f"{client_addr} has connected...")
-            th = threading.Thread(target=self.handle_conn, args=(client_sock,))
+            self.set_keepalive(client_sock)
+            th = threading.Thread(target=self.handle_conn, args=(client_sock, throttle))
             th.start()
 
-    def handle_conn(self, client_sock: socket.socket) -> None:
+    def reject(self, client_sock: socket.socket, reply: bytes) -> None:
+        # never waits for the client, accept loop must go on
+        try:
+            client_sock.setblocking(False)
+            client_sock.send(reply)
+
+        except OSError:
+            pass
+
+        finally:
+            client_sock.close()
+
+    def handle_conn(self, client_sock: socket.socket, throttle: Throttle) -> None:
+        client = None
+        with self.lock:
+            self.handshakes.add(client_sock)
         try:
             client_address = client_sock.getsockname()
-            client = self.client_init(client_sock)
+            try:
+                client = self.client_init(client_sock, throttle)
+
+            finally:
+                with self.lock:
+                    self.handshakes.discard(client_sock)
 
             if client:
-                self.online[client.username] = client
+                self.add_client(client)
                 th_send = threading.Thread(target=client._sending_thread)
                 th_recv = threading.Thread(target=client._receiving_thread)
                 th_send.start()
@@ -517,8 +1701,10 @@ class Server:
                 th_send.join()
                 th_recv.join()
 
-                if client.username in self.online:
-                    del self.online[client.username]
+        except socket.timeout:
+            HANDSHAKE_REAPED.inc()
+            logging.info(f'{client_address} did not log in in time...')
+            self.send_timeout_msg(client_sock)
 
         except Exception as e:
             traceback.print_exc()
@@ -528,125 +1714,593 @@ class Server:
             if client:
                 logging.info(
                     f'{client_address} has been disconnected...')
-                if client.username in self.online:
-                    del self.online[client.username]
+                self.remove_client(client)
             client_sock.close()
+            self.release()
 
-    def client_init(self, client_sock: socket.socket) -> Client:
-        greeting_msg = ("Welcome to the server!\n"
-                        "Register by typing 'REGISTER username password' or log in by typing 'LOGIN username password'.\n"
-                        "Antime you need help, just type 'HELP' :)\n").encode(ENCODING)
-        client_sock.sendall(greeting_msg)
-
+    def send_timeout_msg(self, client_sock: socket.socket) -> None:
+        try:
+            client_sock.settimeout(0)
+            client_sock.send(self.TIMEOUT_MSG)
+
+        except OSError:
+            pass
+
+    def client_init(self, client_sock: socket.socket, throttle: Throttle) -> Client:
+        # socket timeouts are used only until login, later sender and
+        # receiver share the socket and idle clients are left to reaper
+        deadline = time.monotonic() + self.HANDSHAKE_TIMEOUT
+        if self.HANDSHAKE_TIMEOUT:
+            client_sock.settimeout(self.HANDSHAKE_TIMEOUT)
+        client_sock.sendall(self.GREETING_MSG)
+
+        # protocol is chosen by what client sends first
+        framer = None
+        head = b''
         while True:
-            msg = client_sock.recv(BUFF_SIZE).decode(ENCODING)
+            if self.HANDSHAKE_TIMEOUT:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('Handshake timed out')
+                client_sock.settimeout(remaining)
+
+            data = client_sock.recv(BUFF_SIZE)
+
+            if data == b'':
+                raise RuntimeError('Socket connection broken')
+
+            RECEIVED_BYTES.inc(len(data))
+            if framer is None:
+                framer, reply, data = negotiate(head + data, self.COMPRESS_THRESHOLD)
+                if framer is None:
+                    # HELLO split between reads
+                    head = data
+                    continue
+                if reply:
+                    client_sock.sendall(reply)
+                    SENT_BYTES.inc(len(reply))
+
+            frames = framer.feed(data)
+            for i, msg in enumerate(frames):
+                reply, username, finish = self.handle_init_msg(msg, throttle)
+                reply = self.handshake_reply(framer, reply, username)
+                client_sock.sendall(reply)
+                SENT_BYTES.inc(len(reply))
+
+                if username:
+                    client_sock.settimeout(None)
+                    return Client(self.presence, self.db, self.graph, self.rooms,
+                                  self.offline_writer, self.router,
+                                  client_sock, username,
+                                  framer, frames[i + 1:],
+                                  self.throttle_user(throttle, username))
+
+                if finish:
+                    client_sock.close()
+                    return None
+
+            delay = throttle.read_delay(len(data))
+            if delay:
+                time.sleep(delay)
+
+    # returns (reply, logged in username or None, close connection flag)
+    def handle_init_msg(self, msg: str, throttle: Throttle = None) -> tuple:
+        if throttle and not throttle.allow_command():
+            return self.THROTTLED_MSG, None, False
+
+        if msg is None:
+            return self.TOO_LONG_MSG, None, False
+
+        return self.COMMANDS.dispatch(self, msg)
+
+    def handshake_reply(self, framer, reply: bytes, username: str) -> bytes:
+        # framed for the protocol client speaks, binary clients learn
+        # their user id right after logging in
+        reply = framer.reply(reply)
+        if username and framer.BINARY:
+            reply += framer.encode(UserMessage(self.graph.user_id(username), username))
+        return reply
+
+    def register_command(self, username: str, password: str) -> tuple:
+        return self.register_client(username, password) + (False,)
+
+    def login_command(self, username: str, password: str) -> tuple:
+        return self.login_client(username, password) + (False,)
+
+    def help_command(self) -> tuple:
+        return self.HELP_MSG, None, False
+
+    def exit_command(self) -> tuple:
+        return self.EXIT_MSG, None, True
+
+    def unknown_command(self) -> tuple:
+        return self.UNKNOWN_MSG, None, False
+
+    def register_client(self, username: str, password: str) -> tuple:
+        try:
+            if self.graph.user_id(username) is not None:
+                raise DuplicateError(f'User {username} already exists')
 
-            # case register
-            match = self.REGISTER_REGEX.fullmatch(msg)
-            if match:
-                username, password = match.groups()
-                client = self.register_client(client_sock, username, password)
+            self.graph.add_user(username, self.auth.hash(username, password))
+            logging.info(f'Registered {username}')
 
-                if client:
-                    return client
-                else:
-                    continue
+            return self.REGISTERED_MSG, username
 
-            # case login
-            match = self.LOGIN_REGEX.fullmatch(msg)
-            if match:
-                username, password = match.groups()
-                client = self.login_client(client_sock, username, password)
+        except DuplicateError:
+            return self.USERNAME_TAKEN_MSG, None
 
-                if client:
-                    return client
-                else:
-                    continue
+        except AuthBusyError:
+            return self.BUSY_MSG, None
 
-            # case help
-            match = self.HELP_REGEX.fullmatch(msg)
-            if match:
-                self.send_help(client_sock)
-                continue
+    def login_client(self, username: str, password: str) -> tuple:
+        try:
+            query_password = self.db.get_password(username)
 
-            # case exit
-            match = self.EXIT_REGEX.fullmatch(msg)
-            if match:
-                self.exit_client(client_sock)
-                return None
-
-            msg = "Unknown command. Try again!\nType 'HELP' to show avaiable commands!\n".encode(
-                ENCODING)
-            client_sock.sendall(msg)
-
-    def register_client(self, client_sock: socket.socket, username: str, password: str) -> Client:
-        try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ INSERT INTO users(username, password) VALUES (
-                        ?, ?
-                    ); """, (username, password)
-                )
-                conn.commit()
-                logging.info(f'Registered {username}')
-
-                msg = "You've been successfully registered and logged in!\n".encode(
-                    ENCODING)
-                client_sock.sendall(msg)
-                return Client(self.online, client_sock, username)
-
-        except sqlite3.IntegrityError as e:
-            msg = "Username already in use. Try different one.".encode(
-                ENCODING)
-            client_sock.sendall(msg)
-            return None
-
-    def login_client(self, client_sock: socket.socket, username: str, password: str) -> Client:
-        try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """ SELECT password FROM users 
-                        WHERE username = (?); """,
-                    (username,)
-                )
-                query_result = cursor.fetchall()
-
-                if query_result:
-                    query_password, = query_result[0]
-                    if password == query_password:
-                        # correct login
-                        msg = "You've been logged in\n".encode(ENCODING)
-                        client_sock.sendall(msg)
-                        return Client(self.online, client_sock, username)
+            if query_password is not None:
+                correct, new_hash = self.auth.verify(username, password, query_password)
+                if correct:
+                    if new_hash:
+                        # plain text password from older version
+                        self.db.set_password(username, new_hash)
+                        logging.info(f'Upgraded password of {username} to hash')
 
-                    else:
-                        # wrong pass
-                        msg = "Wrong password! Try again!\n".encode(ENCODING)
-                        client_sock.sendall(msg)
+                    # correct login
+                    return self.LOGGED_IN_MSG, username
 
                 else:
-                    # unknow user
-                    msg = "Wrong username! Try again!\n".encode(ENCODING)
-                    client_sock.sendall(msg)
+                    # wrong pass
+                    msg = self.WRONG_PASSWORD_MSG
 
-                return None
+            else:
+                # unknow user
+                msg = self.WRONG_USERNAME_MSG
+
+            return msg, None
+
+        except AuthBusyError:
+            return self.BUSY_MSG, None
 
         except Exception as e:
             traceback.print_exc()
-            logging.error('Error: {e}')
-            return None
+            logging.error(f'Error: {e}')
+            return self.SERVER_ERROR_MSG, None
+
+    async def accept_conn_async(self) -> None:
+        self.raise_fd_limit()
+        self.server_socket.setblocking(False)
+        # set by signals, server stops accepting and drains clients
+        self.stop_event = asyncio.Event()
+        self.async_signals_init()
+        async_server = await asyncio.start_server(
+            self.handle_conn_async, sock=self.server_socket,
+            backlog=self.nConnections, limit=BUFF_SIZE)
+        notify_ready(self.ready_fd)
+
+        try:
+            await self.stop_event.wait()
+
+        finally:
+            # closes listening socket, successor keeps its own copy
+            async_server.close()
+
+        await self.drain_async()
+
+    def async_signals_init(self) -> None:
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop_async)
+        loop.add_signal_handler(signal.SIGTERM, self.stop_async)
+        if RESTART_SIGNAL:
+            loop.add_signal_handler(RESTART_SIGNAL,
+                                    lambda: loop.create_task(self.restart_async()))
+
+    def stop_async(self) -> None:
+        if not self.stopping:
+            logging.error('Shutdown signal received... Shutting down...')
+            self.stopping = True
+            self.stop_event.set()
+
+    async def restart_async(self) -> None:
+        # loop keeps accepting until successor is ready
+        if self.stopping or self.restarting:
+            return
+
+        logging.info('Restart requested... Starting successor...')
+        self.restarting = True
+        try:
+            # workers' parent has started successor already
+            if self.workers > 1 or await asyncio.get_running_loop().run_in_executor(
+                    None, spawn_successor, self.server_socket.fileno()):
+                logging.info('Successor took over... Shutting down...')
+                self.stopping = True
+                self.handed_over = True
+                self.stop_event.set()
+
+        finally:
+            self.restarting = False
 
-    def send_help(self, client_sock: socket.socket) -> None:
-        client_sock.sendall(self.HELP_MSG)
+    async def drain_async(self) -> None:
+        loop = asyncio.get_running_loop()
+        clients, rows = self.drain_clients()
+        await loop.run_in_executor(None, self.store_drained, rows)
+
+        deadline = time.monotonic() + self.DRAIN_TIMEOUT
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.cut_off(clients)
+
+    def raise_fd_limit(self) -> None:
+        # every idle connection holds one descriptor
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                logging.info(f'Raised open files limit to {hard}...')
+
+        except (ImportError, ValueError, OSError) as e:
+            logging.error(f'Cannot raise open files limit. Error: {e}')
+
+    async def handle_conn_async(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        client = None
+        client_address = writer.get_extra_info('peername')
+        CONNECTIONS.inc()
+        throttle, reply = self.admit(client_address[0])
+        if not throttle:
+            logging.warning(f"{client_address} rejected: {reply.decode(ENCODING).strip()}")
+            writer.write(reply)
+            writer.close()
+            return
+
+        logging.info(f"{client_address} has connected...")
+        self.set_keepalive(writer.get_extra_info('socket'))
+
+        try:
+            try:
+                client = await asyncio.wait_for(
+                    self.client_init_async(reader, writer, throttle),
+                    self.HANDSHAKE_TIMEOUT or None)
+
+            except asyncio.TimeoutError:
+                HANDSHAKE_REAPED.inc()
+                logging.info(f'{client_address} did not log in in time...')
+                writer.write(self.TIMEOUT_MSG)
+                return
+
+            if client:
+                self.add_client(client)
+                await asyncio.gather(client._sending_task(),
+                                     client._receiving_task())
+
+        except Exception as e:
+            logging.error(f'Error occured: {e}')
+
+        finally:
+            if client:
+                logging.info(
+                    f'{client_address} has been disconnected...')
+                self.remove_client(client)
+            writer.close()
+            self.release()
+
+    async def client_init_async(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter,
+                                throttle: Throttle) -> AsyncClient:
+        writer.write(self.GREETING_MSG)
+        await writer.drain()
+
+        framer = None
+        head = b''
+        while True:
+            data = await reader.read(BUFF_SIZE)
+
+            if data == b'':
+                raise RuntimeError('Socket connection broken')
+
+            RECEIVED_BYTES.inc(len(data))
+            if framer is None:
+                framer, reply, data = negotiate(head + data, self.COMPRESS_THRESHOLD)
+                if framer is None:
+                    head = data
+                    continue
+                if reply:
+                    writer.write(reply)
+                    SENT_BYTES.inc(len(reply))
+
+            frames = framer.feed(data)
+            for i, msg in enumerate(frames):
+                # REGISTER and LOGIN wait for password hashing, keep it off the loop
+                reply, username, finish = await asyncio.get_running_loop().run_in_executor(
+                    self.login_executor, self.handle_init_msg, msg, throttle)
+                reply = self.handshake_reply(framer, reply, username)
+                writer.write(reply)
+                await writer.drain()
+                SENT_BYTES.inc(len(reply))
+
+                if username:
+                    return AsyncClient(self.presence, self.db, self.graph, self.rooms,
+                                       self.offline_writer, self.router,
+                                       reader, writer,
+                                       username, framer, frames[i + 1:],
+                                       self.throttle_user(throttle, username))
+
+                if finish:
+                    return None
+
+            delay = throttle.read_delay(len(data))
+            if delay:
+                await asyncio.sleep(delay)
+
+
+class RestartRequested(Exception):
+    # raised in main thread once successor accepts connections
+    pass
+
+
+def notify_ready(ready_fd: int) -> None:
+    if ready_fd is None:
+        return
+
+    try:
+        os.write(ready_fd, b'1')
+
+    except OSError as e:
+        logging.error(f'Cannot report server is ready. Error: {e}')
+
+    finally:
+        os.close(ready_fd)
+
+
+def wait_ready(read_fd: int, count: int, timeout: float) -> bool:
+    # waits until count processes report they are ready, False on
+    # timeout or when they all died
+    deadline = time.monotonic() + timeout
+    while count > 0:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        readable, _, _ = select.select([read_fd], [], [], remaining)
+        if readable:
+            data = os.read(read_fd, count)
+            if not data:
+                return False
+            count -= len(data)
+
+    return True
+
+
+def spawn_successor(listen_fd: int = None) -> bool:
+    # starts server again with the same arguments (and code as it is on
+    # disk now). Single process passes its listening socket, workers share
+    # the port through SO_REUSEPORT anyway. Returns True once successor
+    # accepts connections, otherwise it's stopped.
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    env.pop(LISTEN_FD_ENV, None)
+    env[READY_FD_ENV] = str(write_fd)
+    pass_fds = [write_fd]
+    if listen_fd is not None:
+        env[LISTEN_FD_ENV] = str(listen_fd)
+        pass_fds.append(listen_fd)
+
+    try:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+                                   env=env, pass_fds=pass_fds)
+        os.close(write_fd)
+        write_fd = None
+        ready = wait_ready(read_fd, 1, RESTART_TIMEOUT)
+
+    except Exception as e:
+        traceback.print_exc()
+        logging.error(f'Cannot start successor. Error: {e}')
+        return False
+
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+
+    if not ready:
+        logging.error(f'Successor {process.pid} did not start in time... Stopping it...')
+        process.terminate()
+        try:
+            process.wait(RESTART_TIMEOUT)
+
+        except subprocess.TimeoutExpired:
+            process.kill()
+        return False
 
-    def exit_client(self, client_sock: socket.socket) -> None:
-        exit_mgs = "You're being disconnected from server...\n".encode(
-            ENCODING)
-        client_sock.sendall(exit_mgs)
-        client_sock.close()
+    logging.info(f'Successor {process.pid} is accepting connections...')
+    return True
+
+
+def open_storage() -> Storage:
+    if STORAGE == MEMORY_STORAGE:
+        return MemoryStorage(SNAPSHOT_PATH)
+    return Database(DB_PATH)
+
+
+def run_workers(args: argparse.Namespace, ready_fd: int = None) -> None:
+    Server.logging_init()
+
+    # schema is migrated once here, so workers only check its version
+    db = open_storage()
+    db.migrate()
+    db.close()
+
+    # every generation of workers has its own router sockets, so during
+    # hot restart the old one keeps talking only to itself
+    socket_dir = tempfile.mkdtemp(prefix='chat-workers-')
+    read_fd, write_fd = os.pipe()
+    # workers must be forked: settings from command line are set on module
+    # constants and Server/Client attributes of __main__, and the pipe is
+    # inherited, spawned ones would start with defaults and no pipe
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(
+        target=Server, name=f'worker-{worker_id}',
+        args=(args.port, args.connections, args.mode, args.durability,
+              worker_id, args.workers, socket_dir, args.metrics_port),
+        kwargs={'ready_fd': write_fd})
+        for worker_id in range(args.workers)]
+
+    for worker in workers:
+        worker.start()
+
+    os.close(write_fd)
+    try:
+        if wait_ready(read_fd, args.workers, RESTART_TIMEOUT):
+            notify_ready(ready_fd)
+        else:
+            logging.error('Not all workers started in time...')
+
+    finally:
+        os.close(read_fd)
+
+    restarting = []
+
+    def restart(signum, frame):
+        # successor binds the same port with SO_REUSEPORT, old workers
+        # drain once it accepts connections
+        if restarting:
+            return
+
+        logging.info('Restart requested... Starting successor...')
+        restarting.append(True)
+        if spawn_successor():
+            for worker in workers:
+                os.kill(worker.pid, signum)
+        else:
+            restarting.clear()
+
+    if RESTART_SIGNAL:
+        signal.signal(RESTART_SIGNAL, restart)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        for worker in workers:
+            worker.join()
+
+    except KeyboardInterrupt:
+        # workers got SIGINT too when it came from terminal, SIGTERM is
+        # passed on, they drain on either
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+    finally:
+        shutil.rmtree(socket_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
-    Server(40123, 10)
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--port', type=int, default=40123)
+    parser.add_argument('--connections', type=int, default=128,
+                        help='listen backlog, connections waiting to be accepted')
+    parser.add_argument('--mode', choices=(THREADS_MODE, ASYNCIO_MODE),
+                        default=THREADS_MODE)
+    parser.add_argument('--db', default=DB_PATH, help='path to SQLite database')
+    parser.add_argument('--storage', choices=STORAGES, default=STORAGE,
+                        help='where users and messages are kept, memory is lost on exit '
+                             'unless --snapshot is given')
+    parser.add_argument('--snapshot', default=SNAPSHOT_PATH,
+                        help='append-only file memory storage is loaded from and saved to')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port')
+    parser.add_argument('--durability', choices=(ASYNC_DURABILITY, SYNC_DURABILITY),
+                        default=ASYNC_DURABILITY,
+                        help='confirm offline messages before or after commit')
+    parser.add_argument('--outbound-limit-bytes', type=int, default=OUTBOUND_LIMIT,
+                        help='max bytes waiting to be sent to one client')
+    parser.add_argument('--overflow-policy', choices=POLICIES, default=SPILL_POLICY,
+                        help='what to do when slow client exceeds its limit')
+    parser.add_argument('--send-linger-us', type=int, default=0,
+                        help='how long sender waits to batch more messages')
+    parser.add_argument('--send-batch-count', type=int,
+                        default=Client.SEND_BATCH_COUNT)
+    parser.add_argument('--send-batch-bytes', type=int,
+                        default=Client.SEND_BATCH_BYTES)
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on localhost (plus worker id)')
+    parser.add_argument('--admin', action='append', default=[],
+                        help='user allowed to use STATS command, may be repeated')
+    parser.add_argument('--handshake-timeout', type=float, default=Server.HANDSHAKE_TIMEOUT,
+                        help='seconds to log in before connection is closed, 0 disables')
+    parser.add_argument('--idle-timeout', type=float, default=Server.IDLE_TIMEOUT,
+                        help='seconds of client silence before it is disconnected, 0 disables')
+    parser.add_argument('--heartbeat-interval', type=float, default=Server.HEARTBEAT_INTERVAL,
+                        help='send PING to clients silent for that many seconds, 0 disables')
+    parser.add_argument('--keepalive-idle', type=int, default=Server.KEEPALIVE_IDLE,
+                        help='seconds before TCP keepalive probes start, 0 disables')
+    parser.add_argument('--drain-timeout', type=float, default=Server.DRAIN_TIMEOUT,
+                        help='seconds clients get on shutdown before they are cut off')
+    parser.add_argument('--max-connections', type=int, default=Server.MAX_CONNECTIONS,
+                        help='connections served at once by every process, 0 disables')
+    parser.add_argument('--command-rate', type=float, default=Server.COMMAND_RATE,
+                        help='commands per second of one user, 0 disables')
+    parser.add_argument('--byte-rate', type=float, default=Server.BYTE_RATE,
+                        help='bytes per second received from one user, 0 disables')
+    parser.add_argument('--ip-command-rate', type=float, default=Server.IP_COMMAND_RATE,
+                        help='commands per second from one address, 0 disables')
+    parser.add_argument('--ip-byte-rate', type=float, default=Server.IP_BYTE_RATE,
+                        help='bytes per second received from one address, 0 disables')
+    parser.add_argument('--ip-connect-rate', type=float, default=Server.IP_CONNECT_RATE,
+                        help='new connections per second from one address, 0 disables')
+    parser.add_argument('--max-sessions', type=int, default=Server.MAX_SESSIONS,
+                        help='sessions of one user, new login closes the oldest, 0 disables')
+    parser.add_argument('--compress-threshold', type=int, default=Server.COMPRESS_THRESHOLD,
+                        help='binary protocol frames this long are compressed for clients '
+                             'asking for it, 0 disables')
+    parser.add_argument('--message-max-age', type=float, default=Server.MESSAGE_MAX_AGE,
+                        help='seconds offline messages are kept, 0 disables')
+    parser.add_argument('--max-messages-per-user', type=int,
+                        default=Server.MAX_MESSAGES_PER_USER,
+                        help='offline messages kept for one user, oldest are deleted, 0 disables')
+    parser.add_argument('--compaction-interval', type=float, default=Server.COMPACTION_INTERVAL,
+                        help='seconds between deletions of expired offline messages')
+    args = parser.parse_args()
+    if args.storage == MEMORY_STORAGE and args.workers > 1:
+        # every worker would have its own users and messages
+        parser.error('memory storage works with one worker only')
+
+    # set when started by predecessor during hot restart (see spawn_successor)
+    listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    ready_fd = os.environ.pop(READY_FD_ENV, None)
+    listen_fd = int(listen_fd) if listen_fd else None
+    ready_fd = int(ready_fd) if ready_fd else None
+
+    DB_PATH = args.db
+    STORAGE = args.storage
+    SNAPSHOT_PATH = args.snapshot
+    Client.SEND_LINGER = args.send_linger_us / 1_000_000
+    Client.SEND_BATCH_COUNT = args.send_batch_count
+    Client.SEND_BATCH_BYTES = args.send_batch_bytes
+    Client.OUTBOUND_LIMIT_BYTES = args.outbound_limit_bytes
+    Client.OVERFLOW_POLICY = args.overflow_policy
+    Client.ADMINS = frozenset(args.admin)
+    Server.HANDSHAKE_TIMEOUT = args.handshake_timeout
+    Server.IDLE_TIMEOUT = args.idle_timeout
+    Server.HEARTBEAT_INTERVAL = args.heartbeat_interval
+    Server.KEEPALIVE_IDLE = args.keepalive_idle
+    Server.DRAIN_TIMEOUT = args.drain_timeout
+    Server.MAX_CONNECTIONS = args.max_connections
+    Server.COMMAND_RATE = args.command_rate
+    Server.BYTE_RATE = args.byte_rate
+    Server.IP_COMMAND_RATE = args.ip_command_rate
+    Server.IP_BYTE_RATE = args.ip_byte_rate
+    Server.IP_CONNECT_RATE = args.ip_connect_rate
+    Server.MAX_SESSIONS = args.max_sessions
+    Server.COMPRESS_THRESHOLD = args.compress_threshold
+    Server.MESSAGE_MAX_AGE = args.message_max_age
+    Server.MAX_MESSAGES_PER_USER = args.max_messages_per_user
+    Server.COMPACTION_INTERVAL = args.compaction_interval
+
+    if args.workers > 1:
+        run_workers(args, ready_fd)
+    else:
+        Server(args.port, args.connections, args.mode, args.durability,
+               metrics_port=args.metrics_port, listen_fd=listen_fd, ready_fd=ready_fd)
@@ -0,0 +1,173 @@
+import abc
+
+SQLITE_STORAGE = 'sqlite'
+MEMORY_STORAGE = 'memory'
+STORAGES = (SQLITE_STORAGE, MEMORY_STORAGE)
+
+
+class DuplicateError(Exception):
+    # username, room name, friendship or room membership already exists
+    pass
+
+
+class BusyError(Exception):
+    # someone else (other worker, compaction) holds the write lock for too
+    # long, the same write may succeed when tried again
+    pass
+
+
+class Storage(abc.ABC):
+    # Everything server keeps: users, friendships, rooms, offline messages
+    # and message history. Caches, writer and command handlers use only
+    # these methods, so engines can be swapped at startup. All of them
+    # may be called from many threads at once.
+    # Lookups return None when nothing is found, lists are lists of tuples.
+    # Engine has to implement every abstract method, the rest have defaults.
+
+    def migrate(self) -> int:
+        # brings engine up to date before anything else is called,
+        # returns schema version
+        return 0
+
+    def close(self) -> None:
+        pass
+
+    # users and friendships
+
+    @abc.abstractmethod
+    def get_user_id(self, username: str) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_username(self, user_id: int) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_password(self, username: str) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_password(self, username: str, password: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_user(self, username: str, password: str) -> int:
+        # raises DuplicateError when username is taken
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_users(self) -> list:
+        # (user_id, username)
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_friendships(self) -> list:
+        # (user_id, friend_id), friendship is one-sided
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_friend(self, user_id: int, friend_id: int) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_friend(self, user_id: int, friend_id: int) -> None:
+        raise NotImplementedError
+
+    # rooms
+
+    @abc.abstractmethod
+    def add_room(self, name: str, owner_id: int) -> int:
+        # raises DuplicateError when name is taken,
+        # owner becomes the first member
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_room_id(self, name: str) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_room_name(self, room_id: int) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_rooms(self) -> list:
+        # (room_id, name)
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_room_members(self) -> list:
+        # (room_id, user_id)
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_room_member(self, room_id: int, user_id: int) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_room_member(self, room_id: int, user_id: int) -> None:
+        raise NotImplementedError
+
+    # offline messages and history
+
+    @abc.abstractmethod
+    def store_messages(self, messages: list, history: list = (), trim: tuple = (),
+                       max_messages: int = 0) -> int:
+        # messages are (body, addressee_id) pairs, history entries are
+        # (sender_id, addressee_id, room_id, body, created), all stored
+        # at once. Addressees in trim are left with max_messages newest
+        # messages, returns how many were deleted
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_messages(self, addressee_id: int, after_id: int, limit: int) -> list:
+        # (message_id, body), oldest first
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_messages(self, addressee_id: int, up_to_id: int) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count_messages(self, addressee_id: int) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def trim_messages(self, addressee_id: int, max_messages: int, limit: int) -> int:
+        # deletes up to limit (-1 means all) oldest messages above
+        # max_messages newest ones, returns how many were deleted
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_expired(self, created_before: float, limit: int) -> int:
+        # deletes up to limit messages created before given unix time,
+        # less than limit deleted means there's no more
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_over_quota(self, max_messages: int) -> list:
+        # addressees with more than max_messages messages
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_direct_history(self, user_id: int, other_id: int, before_id: int,
+                           limit: int) -> list:
+        # (message_id, sender_id, room_id, body, created), newest first
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_room_history(self, room_id: int, before_id: int, limit: int) -> list:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search_history(self, user_id: int, query: str, before_id: int, limit: int) -> list:
+        # query is made of quoted phrases ("hello" "big world"), all have to
+        # match; only user's conversations and rooms are searched
+        raise NotImplementedError
+
+    # maintenance, called by compaction
+
+    def incremental_vacuum(self, pages: int) -> None:
+        pass
+
+    def checkpoint(self) -> tuple:
+        pass
@@ -0,0 +1,80 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+# server modules import each other as top-level ones
+SERWER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERWER_DIR)
+
+SERVER_PATH = os.path.join(SERWER_DIR, 'server.py')
+STARTUP_TIMEOUT = 10.0
+EXIT_TIMEOUT = 15.0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, *args: str) -> subprocess.Popen:
+    # returns once server accepts connections
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--port', str(port), *args],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return process
+
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail('server did not start')
+            time.sleep(0.1)
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(EXIT_TIMEOUT)
+
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def read_all(sock: socket.socket, timeout: float = EXIT_TIMEOUT) -> bytes:
+    # everything until server closes connection
+    sock.settimeout(timeout)
+    data = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def read_until(sock: socket.socket, text: bytes, timeout: float = 5.0) -> bytes:
+    sock.settimeout(timeout)
+    data = b''
+    while text not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def connect(port: int, line: str = None) -> socket.socket:
+    sock = socket.create_connection(('localhost', port))
+    read_until(sock, b"'HELP' :)\n")
+    if line:
+        sock.sendall(line.encode() + b'\n')
+    return sock
@@ -0,0 +1,41 @@
+import pytest
+
+from server import Client
+
+
+def find(line: str) -> tuple:
+    command, values = Client.COMMANDS.find(line)
+    return (command.name if command else None), values
+
+
+def test_optional_numbers_are_filled_from_the_left():
+    assert find('HISTORY bob') == ('history', ['bob', None, None])
+    assert find('HISTORY bob 5') == ('history', ['bob', 5, None])
+    assert find('HISTORY #dev 5 10') == ('history', ['#dev', 5, 10])
+
+
+def test_optional_number_is_skipped_when_text_needs_it():
+    assert find('SEARCH 42') == ('search', [None, '42'])
+    assert find('SEARCH 5 hello') == ('search', [5, 'hello'])
+    assert find('SEARCH hello world') == ('search', [None, 'hello world'])
+
+
+def test_addressed_messages():
+    assert find('#dev: hi') == ('post', ['dev', 'hi'])
+    assert find('dev: hi') == ('send', ['dev', 'hi'])
+    assert find('bob: hi: there') == ('send', ['bob', 'hi: there'])
+
+
+@pytest.mark.parametrize('line', ['bob:', 'bob: ', '#dev:', 'SEARCH', 'ADD', 'JOIN dev'])
+def test_missing_or_bad_arguments_are_unknown(line):
+    assert find(line) == (None, None)
+
+
+@pytest.mark.parametrize('line', ['STATUS now', 'ADD bob alice', 'HISTORY bob 5 10 3'])
+def test_extra_arguments_are_unknown(line):
+    assert find(line) == (None, None)
+
+
+def test_keywords_are_case_sensitive():
+    assert find('help') == (None, None)
+    assert find('') == (None, None)
@@ -0,0 +1,61 @@
+import signal
+
+import pytest
+
+from conftest import EXIT_TIMEOUT, free_port, start_server, stop_server
+from conftest import read_all, read_until, connect
+
+
+@pytest.fixture(params=['threads', 'asyncio'])
+def server(request, tmp_path):
+    port = free_port()
+    process = start_server(port, '--mode', request.param, '--db', str(tmp_path / 'users.db'))
+    yield process, port
+    stop_server(process)
+
+
+def test_idle_clients_do_not_hang_shutdown(server):
+    process, port = server
+    alice = connect(port, 'REGISTER alice pw')
+    bob = connect(port, 'REGISTER bob pw')
+    for sock in (alice, bob):
+        assert b'registered' in read_until(sock, b'logged in!\n')
+    # connected, never logged in
+    stranger = connect(port)
+
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(EXIT_TIMEOUT) == 0
+
+    for sock in (alice, bob):
+        assert b'Server is shutting down' in read_all(sock)
+        sock.close()
+    read_all(stranger)
+    stranger.close()
+
+
+def test_messages_survive_shutdown(server, tmp_path):
+    process, port = server
+    alice = connect(port, 'REGISTER alice pw')
+    bob = connect(port, 'REGISTER bob pw')
+    read_until(alice, b'logged in!\n')
+    read_until(bob, b'logged in!\n')
+    for sock, friend in ((alice, 'bob'), (bob, 'alice')):
+        sock.sendall(f'ADD {friend}\n'.encode())
+        read_until(sock, b'friends')
+    bob.sendall(b'EXIT\n')
+    read_all(bob)
+    alice.sendall(b'bob: see you later\n')
+    read_until(alice, b'queue')
+
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(EXIT_TIMEOUT) == 0
+    alice.close()
+
+    restarted = start_server(port, '--db', str(tmp_path / 'users.db'))
+    try:
+        bob = connect(port, 'LOGIN bob pw')
+        assert b'alice: see you later' in read_until(bob, b'see you later')
+        bob.close()
+
+    finally:
+        stop_server(restarted)
@@ -0,0 +1,123 @@
+import pytest
+
+import framing
+from framing import BinaryFramer, LineFramer, negotiate
+from framing import BINARY_MAGIC, BINARY_VERSION, HELLO, HEADER, COMPRESSED, ZLIB_FLAG
+from framing import REPLY, USER_ID
+from server import Client, Message
+
+
+def test_line_framer_splits_and_buffers():
+    framer = LineFramer()
+    assert framer.feed(b'HELP\nSTA') == ['HELP']
+    assert framer.feed(b'TUS\n\n') == ['STATUS', '']
+
+
+def test_line_framer_reports_too_long_line_once():
+    framer = LineFramer(max_frame_size=8)
+    assert framer.feed(b'x' * 20) == [None]
+    assert framer.feed(b'yyy\nHELP\n') == ['HELP']
+
+
+def test_binary_frames_survive_any_split():
+    framer = BinaryFramer()
+    data = framer.pack(0x01, b'first') + framer.pack(0x02, b'') + framer.pack(0x03, b'third')
+    frames = []
+    for i in range(len(data)):
+        frames += framer.feed(data[i:i + 1])
+    assert frames == [b'\x01first', b'\x02', b'\x03third']
+
+
+def test_binary_frame_is_compressed_above_threshold():
+    sender = BinaryFramer(compress_threshold=64)
+    payload = b'hello world ' * 100
+    frame = sender.pack(REPLY, payload)
+    header, = HEADER.unpack_from(frame)
+    assert header & COMPRESSED
+    assert len(frame) < len(payload)
+    assert BinaryFramer().feed(frame) == [bytes((REPLY,)) + payload]
+
+    short = sender.pack(REPLY, b'hi')
+    assert not HEADER.unpack_from(short)[0] & COMPRESSED
+
+
+def test_too_long_binary_frame_is_skipped():
+    framer = BinaryFramer(max_frame_size=16)
+    data = HEADER.pack(100) + b'x' * 100 + framer.pack(0x06, b'')
+    assert framer.feed(data[:50]) == [None]
+    assert framer.feed(data[50:]) == [b'\x06']
+
+
+def test_compressed_frame_over_limit_is_rejected():
+    big = BinaryFramer(compress_threshold=1).pack(REPLY, b'\0' * 1000)
+    assert BinaryFramer(max_frame_size=100).feed(big) == [None]
+
+
+def test_negotiate():
+    framer, reply, rest = negotiate(b'LOGIN a b\n')
+    assert isinstance(framer, LineFramer) and reply == b'' and rest == b'LOGIN a b\n'
+
+    # may still turn out to be HELLO
+    assert negotiate(BINARY_MAGIC[:3])[0] is None
+
+    hello = HELLO.pack(BINARY_MAGIC, BINARY_VERSION, ZLIB_FLAG)
+    framer, reply, rest = negotiate(hello + b'tail', compress_threshold=512)
+    assert isinstance(framer, BinaryFramer) and framer.compress_threshold == 512
+    assert reply == hello and rest == b'tail'
+
+    framer, reply, _ = negotiate(hello, compress_threshold=0)
+    assert framer.compress_threshold == 0
+    assert reply == HELLO.pack(BINARY_MAGIC, BINARY_VERSION, 0)
+
+
+def test_message_frame_is_made_once():
+    msg = Message('x' * 2000)
+    compressing = BinaryFramer(compress_threshold=framing.COMPRESS_THRESHOLD)
+    frame = compressing.encode(msg)
+    assert compressing.encode(msg) is frame
+    # peer that doesn't accept compression gets its own plain frame
+    plain = BinaryFramer().encode(msg)
+    assert not HEADER.unpack_from(plain)[0] & COMPRESSED
+    assert msg.frame is frame
+
+
+USERS = {1: 'alice', 2: 'bob'}
+
+
+def unpack(payload: bytes) -> tuple:
+    command, values = Client.COMMANDS.unpack(payload, USERS.get)
+    return command and command.name, values
+
+
+def send(user_id: int, text: str) -> bytes:
+    return b'\x01' + USER_ID.pack(user_id) + text.encode()
+
+
+def string(value: str) -> bytes:
+    data = value.encode()
+    return len(data).to_bytes(2, 'big') + data
+
+
+def test_binary_args_are_decoded():
+    assert unpack(send(2, 'hi there')) == ('send', ['bob', 'hi there'])
+    assert unpack(b'\x03' + USER_ID.pack(1)) == ('add', ['alice'])
+    assert unpack(b'\x09' + string('dev')) == ('join', ['dev'])
+    assert unpack(b'\x0c' + bytes(8) + 'zażółć'.encode()) == ('search', [None, 'zażółć'])
+
+
+@pytest.mark.parametrize('payload', [
+    send(2, 'hi\nbob: forged'),
+    send(2, 'hi\r'),
+    send(3, 'unknown user'),
+    send(2, ''),
+    b'\x03' + USER_ID.pack(1) + b'x',  # too many arguments
+    b'\x09' + string('dev\n'),
+    b'\x09' + string('a b'),
+    b'\x09' + b'\x00\x10dev',  # length past the end
+    b'\x0c' + bytes(8) + b'two\nlines',
+    b'\x0c' + bytes(8) + b'\xff\xfe',
+    b'\x7f',  # unknown opcode
+    b'',
+])
+def test_bad_binary_args_are_rejected(payload):
+    assert unpack(payload) == (None, None)
@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+
+import migrations
+from database import Database
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    # schema server created before migrations existed, no schema_version
+    path = str(tmp_path / 'users.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(migrations.MIGRATIONS[0][1])
+    conn.executemany('INSERT INTO users(username, password) VALUES (?, ?);',
+                     [('alice', 'x'), ('bob', 'y'), ('carol', 'z')])
+    conn.executemany('INSERT INTO friends(user1, user2) VALUES (?, ?);',
+                     [(1, 2), (2, 1), (1, 2), (1, None), (3, 1)])
+    conn.executemany('INSERT INTO messages(body, addressee) VALUES (?, ?);',
+                     [('bob: hi', 1), ('alice: yo', 2), ('bob: again', 1)])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_baseline_is_migrated_to_latest(baseline_db):
+    db = Database(baseline_db)
+    assert db.migrate() == migrations.latest_version() == 5
+
+    assert db.get_users() == [(1, 'alice'), (2, 'bob'), (3, 'carol')]
+    # duplicates and incomplete rows are dropped with the composite key
+    assert sorted(db.get_friendships()) == [(1, 2), (2, 1), (3, 1)]
+    assert db.get_messages(1, 0, 10) == [(1, 'bob: hi'), (3, 'bob: again')]
+    assert db.count_messages(2) == 1
+
+    with db.connection() as conn:
+        created = conn.execute('SELECT created FROM messages;').fetchall()
+        assert all(value is not None for value, in created)
+        versions = conn.execute('SELECT version FROM schema_version;').fetchall()
+        assert versions == [(1,), (2,), (3,), (4,), (5,)]
+        mode, = conn.execute('PRAGMA auto_vacuum;').fetchone()
+        assert mode == migrations.INCREMENTAL_VACUUM
+    db.close()
+
+
+def test_migrated_db_is_usable(baseline_db):
+    db = Database(baseline_db)
+    db.migrate()
+
+    room_id = db.add_room('dev', 1)
+    db.store_messages([('#dev alice: hi', 2)], [(1, None, room_id, 'hi', 0.0)])
+    assert db.get_messages(2, 1, 10)[-1][1] == '#dev alice: hi'
+    assert [row[3] for row in db.get_room_history(room_id, 2 ** 62, 10)] == ['hi']
+    assert [row[3] for row in db.search_history(1, '"hi"', 2 ** 62, 10)] == ['hi']
+    db.close()
+
+
+def test_migrate_is_idempotent(baseline_db):
+    db = Database(baseline_db)
+    db.migrate()
+    db.close()
+
+    db = Database(baseline_db)
+    assert db.migrate() == migrations.latest_version()
+    with db.connection() as conn:
+        count, = conn.execute('SELECT COUNT(*) FROM schema_version;').fetchone()
+        assert count == len(migrations.MIGRATIONS)
+    db.close()
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+import offline_writer
+from offline_writer import OfflineWriter
+from storage import BusyError
+
+
+class FakeStorage:
+    # records batches; store_messages raises queued errors first and
+    # waits while release is clear
+    def __init__(self):
+        self.batches = []
+        self.errors = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def store_messages(self, messages, history=(), trim=(), max_messages=0):
+        self.release.wait()
+        if self.errors:
+            raise self.errors.pop(0)
+        self.batches.append((list(messages), list(history)))
+        return 0
+
+    def count_messages(self, addressee_id):
+        return 0
+
+    def rows(self) -> list:
+        return [row for messages, _ in self.batches for row in messages]
+
+
+@pytest.fixture
+def db():
+    return FakeStorage()
+
+
+def test_messages_are_written_in_batches(db):
+    writer = OfflineWriter(db, batch_size=10, flush_interval=0.5)
+    for i in range(25):
+        writer.store(str(i), i % 3)
+    writer.flush()
+    writer.close()
+
+    assert [len(messages) for messages, _ in db.batches] == [10, 10, 5]
+    assert db.rows() == [(str(i), i % 3) for i in range(25)]
+
+
+def test_room_post_and_history_share_batch(db):
+    writer = OfflineWriter(db, flush_interval=0.5)
+    writer.store_many('#dev a: hi', [1, 2, 3])
+    writer.append_history(1, None, 7, 'hi')
+    writer.close()
+
+    messages, history = db.batches[0]
+    assert messages == [('#dev a: hi', 1), ('#dev a: hi', 2), ('#dev a: hi', 3)]
+    assert [entry[:4] for entry in history] == [(1, None, 7, 'hi')]
+
+
+def test_sender_learns_about_failed_batch(db):
+    writer = OfflineWriter(db)
+    results = []
+    db.errors.append(RuntimeError('disk full'))
+    writer.store('lost', 1, results.append)
+    writer.flush()
+    writer.store('kept', 1, results.append)
+    writer.close()
+
+    assert results == [False, True]
+    assert db.rows() == [('kept', 1)]
+
+
+def test_busy_storage_is_retried(db, monkeypatch):
+    monkeypatch.setattr(offline_writer, 'RETRY_DELAY', 0.001)
+    retries = offline_writer.WRITE_RETRIES_TOTAL.get()
+    writer = OfflineWriter(db)
+    results = []
+    db.errors += [BusyError('database is locked')] * 3
+    writer.store('hi', 1, results.append)
+    writer.close()
+
+    assert results == [True]
+    assert db.rows() == [('hi', 1)]
+    assert offline_writer.WRITE_RETRIES_TOTAL.get() == retries + 3
+
+
+def test_full_queue_never_blocks_and_keeps_order(db):
+    writer = OfflineWriter(db, queue_size=4, batch_size=3)
+    db.release.clear()
+    for i in range(100):
+        writer.store(str(i), 1)
+    assert writer.overflow
+
+    flushed = threading.Event()
+    writer.after_flush(flushed.set)
+    assert not flushed.is_set()
+    db.release.set()
+    assert flushed.wait(5)
+    writer.close()
+
+    assert db.rows() == [(str(i), 1) for i in range(100)]
+    assert not writer.overflow
+
+
+def test_flush_waits_for_commit(db):
+    writer = OfflineWriter(db, flush_interval=0.05)
+    writer.store('hi', 1)
+    writer.flush()
+    assert db.rows() == [('hi', 1)]
+    writer.close()
@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+
+from graph import SocialGraph
+from memory_storage import MemoryStorage
+from presence import Presence
+
+BATCH_INTERVAL = 0.05
+TIMEOUT = 5.0
+
+
+class FakeQueue:
+    closed = False
+
+
+class FakeClient:
+    # session that records presence messages
+    def __init__(self, username: str):
+        self.username = username
+        self.msg_queue = FakeQueue()
+        self.sent = []
+        self.received = threading.Event()
+
+    def send_msg_nowait(self, msg):
+        self.sent.append(msg)
+        self.received.set()
+        return msg
+
+    def wait(self) -> list:
+        assert self.received.wait(TIMEOUT)
+        self.received.clear()
+        sent, self.sent = self.sent, []
+        return sent
+
+
+@pytest.fixture
+def graph():
+    graph = SocialGraph(MemoryStorage())
+    ids = {username: graph.add_user(username, 'pw') for username in ('alice', 'bob', 'carol')}
+    # alice watches bob and carol
+    graph.add_friend(ids['alice'], ids['bob'])
+    graph.add_friend(ids['alice'], ids['carol'])
+    return graph
+
+
+@pytest.fixture
+def presence(graph):
+    presence = Presence(graph, batch_interval=BATCH_INTERVAL, max_sessions=2)
+    yield presence
+    presence.close()
+
+
+def test_changes_are_sent_together_to_every_session(presence):
+    alice, alice2 = FakeClient('alice'), FakeClient('alice')
+    presence.add(alice)
+    presence.add(alice2)
+    presence.add(FakeClient('bob'))
+    presence.add(FakeClient('carol'))
+
+    expected = ['Friend bob is now ONLINE\nFriend carol is now ONLINE']
+    assert alice.wait() == expected
+    assert alice2.wait() == expected
+
+
+def test_latest_state_wins(presence):
+    alice = FakeClient('alice')
+    presence.add(alice)
+    bob = FakeClient('bob')
+    presence.add(bob)
+    presence.remove(bob)
+    presence.add(FakeClient('carol'))
+
+    assert alice.wait() == ['Friend bob is now OFFLINE\nFriend carol is now ONLINE']
+
+
+def test_only_first_and_last_session_change_presence(presence):
+    alice = FakeClient('alice')
+    presence.add(alice)
+    bob, bob2 = FakeClient('bob'), FakeClient('bob')
+    assert presence.add(bob) == (True, [])
+    assert alice.wait() == ['Friend bob is now ONLINE']
+
+    assert presence.add(bob2) == (False, [])
+    assert presence.remove(bob)
+    assert not presence.remove(bob)
+    assert presence.is_online('bob')
+    presence.remove(bob2)
+    assert alice.wait() == ['Friend bob is now OFFLINE']
+    assert not presence.is_online('bob')
+
+
+def test_oldest_session_is_replaced(presence):
+    sessions = [FakeClient('bob') for _ in range(3)]
+    presence.add(sessions[0])
+    presence.add(sessions[1])
+    assert presence.add(sessions[2]) == (False, [sessions[0]])
+    assert presence.local['bob'] == (sessions[1], sessions[2])
+    assert presence.session_count == 2
+
+
+def test_user_on_other_worker_stays_online(presence):
+    alice = FakeClient('alice')
+    presence.add(alice)
+    presence.set_remote('bob', 1, True)
+    assert alice.wait() == ['Friend bob is now ONLINE']
+
+    bob = FakeClient('bob')
+    presence.add(bob)
+    presence.remove(bob)
+    presence.set_remote('bob', 1, False)
+    assert alice.wait() == ['Friend bob is now OFFLINE']
+    assert presence.remote_workers('bob') == ()
+
+
+def test_watchers_offline_get_nothing(presence):
+    changes = []
+    presence.on_change = lambda username, online: changes.append((username, online))
+    bob = FakeClient('bob')
+    presence.add(bob)
+    presence.remove(bob)
+    assert changes == [('bob', True), ('bob', False)]
+    assert presence.pending == {}
@@ -0,0 +1,97 @@
+import pytest
+
+import ratelimit
+from ratelimit import RateLimiter, Throttle
+from server import Server
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    bucket = RateLimiter('test', 2.0, burst=3).bucket('alice')
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+    clock.now += 0.5
+    assert bucket.take()
+    assert not bucket.take()
+
+    # refill stops at burst
+    clock.now += 60
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+
+def test_burst_defaults_to_seconds_of_rate(clock):
+    limiter = RateLimiter('test', 10.0)
+    assert limiter.burst == 10.0 * ratelimit.BURST_SECONDS
+
+
+def test_disabled_limit_has_no_buckets(clock):
+    limiter = RateLimiter('test', 0)
+    assert limiter.bucket('alice') is None
+    throttle = Throttle((limiter.bucket('alice'),), (limiter.bucket('alice'),))
+    assert throttle.commands == () and throttle.bytes == ()
+    assert throttle.allow_command()
+    assert throttle.read_delay(10 ** 6) == 0.0
+
+
+def test_keys_share_buckets(clock):
+    limiter = RateLimiter('test', 1.0, burst=1)
+    assert limiter.bucket('alice') is limiter.bucket('alice')
+    assert limiter.bucket('alice').take()
+    assert limiter.bucket('bob').take()
+    assert not limiter.bucket('alice').take()
+
+
+def test_refused_command_gives_tokens_back(clock):
+    address = RateLimiter('address', 1.0, burst=5).bucket('127.0.0.1')
+    user = RateLimiter('user', 1.0, burst=1).bucket('alice')
+    throttle = Throttle((address,))
+    throttle.extend((user,))
+
+    assert throttle.allow_command()
+    assert not throttle.allow_command()
+    # only the accepted command was paid for by address
+    assert address.tokens == 4
+
+
+def test_read_delay_waits_for_the_slowest_limit(clock):
+    address = RateLimiter('address', 100.0, burst=100).bucket('127.0.0.1')
+    user = RateLimiter('user', 10.0, burst=10).bucket('alice')
+    throttle = Throttle(bytes=(address, user))
+
+    assert throttle.read_delay(10) == 0.0
+    # user's bucket is 20 bytes in debt now
+    assert throttle.read_delay(20) == pytest.approx(2.0)
+    clock.now += 2.0
+    assert throttle.read_delay(5) == pytest.approx(0.5)
+
+
+def test_idle_buckets_are_pruned(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'MAX_IDLE_BUCKETS', 3)
+    limiter = RateLimiter('test', 1.0, burst=1)
+    busy = limiter.bucket('busy')
+    busy.take()
+    for key in ('a', 'b'):
+        limiter.bucket(key)
+
+    clock.now += 0.5
+    limiter.bucket('c')
+    assert set(limiter.buckets) == {'busy', 'c'}
+    assert limiter.bucket('busy') is busy
+
+
+def test_per_user_limits_are_opt_in():
+    assert not Server.COMMAND_RATE and not Server.BYTE_RATE
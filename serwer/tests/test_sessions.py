@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+from conftest import free_port, start_server, stop_server, read_until, connect
+
+MESSAGES = 30
+
+
+@pytest.fixture(params=['threads', 'asyncio'])
+def slow_server(request, tmp_path):
+    # tiny outbound queues and lingering senders, so messages spill
+    port = free_port()
+    db_path = str(tmp_path / 'users.db')
+    process = start_server(port, '--mode', request.param, '--db', db_path,
+                           '--outbound-limit-bytes', '50', '--send-linger-us', '50000')
+    yield port, db_path
+    stop_server(process)
+
+
+def chat_lines(data: bytes) -> list:
+    return [line for line in data.decode().splitlines() if line.startswith('bob: msg')]
+
+
+def test_spilled_messages_reach_every_session_once(slow_server):
+    port, db_path = slow_server
+    alice = connect(port, 'REGISTER alice pw')
+    bob = connect(port, 'REGISTER bob pw')
+    read_until(alice, b'logged in!\n')
+    read_until(bob, b'logged in!\n')
+    for sock, friend in ((alice, 'bob'), (bob, 'alice')):
+        sock.sendall(f'ADD {friend}\n'.encode())
+        read_until(sock, b'friends')
+    alice2 = connect(port, 'LOGIN alice pw')
+    read_until(alice2, b'logged in\n')
+    # login is answered before the session is registered, once it
+    # answers a command it is
+    alice2.sendall(b'PING\n')
+    read_until(alice2, b'PONG')
+
+    bob.sendall(''.join(f'alice: msg {i}\n' for i in range(MESSAGES)).encode())
+    expected = [f'bob: msg {i}' for i in range(MESSAGES)]
+    for sock in (alice, alice2):
+        got = chat_lines(read_until(sock, expected[-1].encode(), timeout=10))
+        assert got == expected
+
+    # every spilled message was delivered and deleted once
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM messages;').fetchone() == (0,)
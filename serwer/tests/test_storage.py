@@ -0,0 +1,160 @@
+import pytest
+
+from database import Database
+from memory_storage import MemoryStorage
+from storage import DuplicateError, SQLITE_STORAGE, MEMORY_STORAGE
+
+CREATED = 1700000000.0
+
+
+def open_storage(engine: str, tmp_path):
+    if engine == SQLITE_STORAGE:
+        db = Database(str(tmp_path / 'users.db'))
+    else:
+        db = MemoryStorage(str(tmp_path / 'snapshot.log'))
+    db.migrate()
+    return db
+
+
+@pytest.fixture(params=[SQLITE_STORAGE, MEMORY_STORAGE])
+def db(request, tmp_path):
+    db = open_storage(request.param, tmp_path)
+    yield db
+    db.close()
+
+
+def add_users(db, *usernames: str) -> list:
+    return [db.add_user(username, 'pw') for username in usernames]
+
+
+def test_users_friends_and_rooms(db):
+    alice, bob = add_users(db, 'alice', 'bob')
+    with pytest.raises(DuplicateError):
+        db.add_user('alice', 'other')
+    assert db.get_user_id('bob') == bob
+    assert db.get_username(alice) == 'alice'
+    assert db.get_user_id('carol') is None
+
+    db.add_friend(alice, bob)
+    with pytest.raises(DuplicateError):
+        db.add_friend(alice, bob)
+    assert (alice, bob) in db.get_friendships()
+    db.delete_friend(alice, bob)
+    assert (alice, bob) not in db.get_friendships()
+
+    room = db.add_room('dev', alice)
+    with pytest.raises(DuplicateError):
+        db.add_room('dev', bob)
+    db.add_room_member(room, bob)
+    with pytest.raises(DuplicateError):
+        db.add_room_member(room, bob)
+    assert db.get_room_id('dev') == room
+    assert (room, bob) in db.get_room_members()
+
+
+def test_messages_are_paged_and_deleted_in_order(db):
+    alice, bob = add_users(db, 'alice', 'bob')
+    db.store_messages([(f'msg {i}', alice) for i in range(5)] + [('other', bob)])
+
+    page = db.get_messages(alice, 0, 3)
+    assert [body for _, body in page] == ['msg 0', 'msg 1', 'msg 2']
+    rest = db.get_messages(alice, page[-1][0], 10)
+    assert [body for _, body in rest] == ['msg 3', 'msg 4']
+
+    db.delete_messages(alice, page[-1][0])
+    assert db.count_messages(alice) == 2
+    assert db.count_messages(bob) == 1
+
+
+def test_trim_keeps_newest_messages(db):
+    alice, bob = add_users(db, 'alice', 'bob')
+    db.store_messages([(f'msg {i}', alice) for i in range(10)])
+    assert db.get_over_quota(5) == [alice]
+
+    # limited trim deletes only the oldest ones
+    assert db.trim_messages(alice, 5, 2) == 2
+    assert db.trim_messages(alice, 5, -1) == 3
+    assert [body for _, body in db.get_messages(alice, 0, 10)] == \
+        [f'msg {i}' for i in range(5, 10)]
+    assert db.get_over_quota(5) == []
+
+    # trimmed together with the write that went over quota
+    assert db.store_messages([('new', alice), ('other', bob)], trim=(alice,),
+                             max_messages=3) == 3
+    assert [body for _, body in db.get_messages(alice, 0, 10)] == \
+        ['msg 8', 'msg 9', 'new']
+    assert db.count_messages(bob) == 1
+
+
+def test_expired_messages_are_deleted_in_batches(db):
+    alice, = add_users(db, 'alice')
+    db.store_messages([(f'msg {i}', alice) for i in range(5)])
+    assert db.delete_expired(0.0, 10) == 0
+    assert db.delete_expired(float('inf'), 3) == 3
+    assert db.delete_expired(float('inf'), 3) == 2
+    assert db.count_messages(alice) == 0
+
+
+def store_history(db) -> tuple:
+    alice, bob, carol = add_users(db, 'alice', 'bob', 'carol')
+    room = db.add_room('dev', alice)
+    db.store_messages([], history=[
+        (alice, bob, None, 'hello bob', CREATED),
+        (bob, alice, None, 'Hello big world', CREATED + 1),
+        (carol, None, room, 'hello room', CREATED + 2),
+        (carol, bob, None, 'hello from carol', CREATED + 3),
+        (bob, alice, None, 'big hello world', CREATED + 4),
+    ])
+    return alice, bob, carol, room
+
+
+def test_history_is_newest_first(db):
+    alice, bob, carol, room = store_history(db)
+    rows = db.get_direct_history(bob, alice, 2 ** 62, 10)
+    assert [body for _, _, _, body, _ in rows] == \
+        ['big hello world', 'Hello big world', 'hello bob']
+    assert rows[0][1:3] == (bob, None)
+
+    older = db.get_direct_history(alice, bob, rows[0][0], 1)
+    assert [body for _, _, _, body, _ in older] == ['Hello big world']
+    assert [body for _, _, _, body, _ in db.get_room_history(room, 2 ** 62, 10)] == \
+        ['hello room']
+
+
+def test_search_matches_phrases_in_own_conversations(db):
+    alice, bob, carol, room = store_history(db)
+
+    def search(user_id: int, query: str, before_id: int = 2 ** 62, limit: int = 10) -> list:
+        return [body for _, _, _, body, _ in db.search_history(user_id, query, before_id, limit)]
+
+    assert search(alice, '"hello"') == \
+        ['big hello world', 'hello room', 'Hello big world', 'hello bob']
+    assert search(alice, '"big world"') == ['Hello big world']
+    assert search(alice, '"world" "big"') == ['big hello world', 'Hello big world']
+    assert search(alice, '"hello"', limit=1) == ['big hello world']
+    # carol's conversation with bob isn't alice's
+    assert search(alice, '"carol"') == []
+    assert search(bob, '"carol"') == ['hello from carol']
+
+
+def test_memory_snapshot_is_replayed(tmp_path):
+    db = open_storage(MEMORY_STORAGE, tmp_path)
+    alice, bob = add_users(db, 'alice', 'bob')
+    db.add_friend(alice, bob)
+    db.store_messages([(f'msg {i}', alice) for i in range(4)],
+                      history=[(alice, bob, None, 'hello bob', CREATED)])
+    db.delete_messages(alice, db.get_messages(alice, 0, 1)[0][0])
+    db.close()
+
+    db = open_storage(MEMORY_STORAGE, tmp_path)
+    try:
+        assert db.get_user_id('bob') == bob
+        assert (alice, bob) in db.get_friendships()
+        assert [body for _, body in db.get_messages(alice, 0, 10)] == \
+            ['msg 1', 'msg 2', 'msg 3']
+        assert [row[3] for row in db.search_history(bob, '"bob"', 2 ** 62, 10)] == ['hello bob']
+        # ids continue after the replayed ones
+        assert db.add_user('carol', 'pw') > bob
+
+    finally:
+        db.close()